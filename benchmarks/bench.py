@@ -0,0 +1,133 @@
+"""Benchmarks for pattern set construction, matching, and traversal.
+
+Run with ``python benchmarks/bench.py``. See ``--help`` for the options
+controlling the generated patterns and terms. Results can be saved with
+``--save results.json``, and compared against saved results with
+``--compare results.json``.
+"""
+
+from __future__ import absolute_import, division, print_function
+import argparse
+import json
+import os
+import sys
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from pinyon import Engine
+from pinyon.term.sexpr import sexpr_context
+
+from generate import Generator
+
+
+TYPES = ['static', 'dynamic', 'lazy', 'compiled', 'bottomup', 'hybrid',
+         'auto']
+TRAVERSALS = ['normal', 'path', 'arity', 'copyable']
+
+
+def best_of(func, repeat):
+    """Best time of `repeat` calls of `func`"""
+
+    times = []
+    for i in range(repeat):
+        start = default_timer()
+        func()
+        times.append(default_timer() - start)
+    return min(times)
+
+
+def run(args):
+    gen = Generator(symbols=args.symbols, depth=args.depth,
+                    fanout=args.fanout, nvars=args.nvars,
+                    var_density=args.var_density,
+                    nonlinearity=args.nonlinearity, seed=args.seed)
+    eng = Engine(sexpr_context)
+    raw = gen.patterns(args.patterns)
+    patterns = [eng.pattern(p, v) for (p, v) in raw]
+    terms = gen.terms(args.terms, raw, args.match_fraction)
+
+    results = {}
+    for type in args.types:
+        results[type + '.build'] = best_of(
+            lambda: eng.patternset(patterns, type), args.repeat)
+        pset = eng.patternset(patterns, type)
+        results[type + '.match_all'] = best_of(
+            lambda: [pset.match_all(t) for t in terms], args.repeat)
+        results[type + '.match_one'] = best_of(
+            lambda: [pset.match_one(t) for t in terms], args.repeat)
+    for variant in TRAVERSALS:
+        results['traverse.' + variant] = best_of(
+            lambda: [list(sexpr_context.traverse(t, variant)) for t in terms],
+            args.repeat)
+    return results
+
+
+def report(results, baseline=None):
+    width = max(len(k) for k in results)
+    header = '{0:<{1}}  {2:>12}'.format('benchmark', width, 'seconds')
+    if baseline is not None:
+        header += '  {0:>12}  {1:>8}'.format('baseline', 'ratio')
+    print(header)
+    print('-' * len(header))
+    for key in sorted(results):
+        line = '{0:<{1}}  {2:>12.6f}'.format(key, width, results[key])
+        if baseline is not None and key in baseline:
+            line += '  {0:>12.6f}  {1:>7.2f}x'.format(
+                baseline[key], results[key] / baseline[key])
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--patterns', type=int, default=50,
+                        help='number of patterns')
+    parser.add_argument('--terms', type=int, default=2000,
+                        help='number of terms to match')
+    parser.add_argument('--symbols', type=int, default=10,
+                        help='number of function symbols')
+    parser.add_argument('--depth', type=int, default=4,
+                        help='maximum depth of patterns')
+    parser.add_argument('--fanout', type=int, default=2,
+                        help='maximum arity of function symbols')
+    parser.add_argument('--nvars', type=int, default=3,
+                        help='number of variables per pattern')
+    parser.add_argument('--var-density', type=float, default=0.3,
+                        help='probability of a subpattern being a variable')
+    parser.add_argument('--nonlinearity', type=float, default=0.1,
+                        help='probability of a variable being repeated')
+    parser.add_argument('--match-fraction', type=float, default=0.5,
+                        help='fraction of terms that are pattern instances')
+    parser.add_argument('--types', default=','.join(TYPES),
+                        help='comma separated pattern set types')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of repetitions, the best is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='FILE',
+                        help='save results as json')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare against results saved with --save')
+    args = parser.parse_args(argv)
+    args.types = [t for t in args.types.split(',') if t]
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        baseline = saved['results']
+        ignore = ('save', 'compare')
+        differ = sorted(k for (k, v) in vars(args).items()
+                        if k not in ignore and saved['args'].get(k) != v)
+        if differ:
+            print("Warning: baseline was run with different options: "
+                  "{0}\n".format(', '.join(differ)))
+    report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2,
+                      sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Synthetic pattern sets and terms for benchmarking.
+
+Terms use the ``pinyon.term.sexpr`` representation. Heads are generated
+functions of a fixed arity, leaves are small integers.
+"""
+
+from __future__ import absolute_import, division, print_function
+import random
+
+
+def make_symbols(n, fanout):
+    """Make `n` function symbols, with arities from 1 to `fanout`"""
+
+    def make(i):
+        def op(*args):
+            return sum(args)
+        op.__name__ = 'op{0}'.format(i)
+        return op, 1 + i % fanout
+    return [make(i) for i in range(n)]
+
+
+class Generator(object):
+    """Generator of random patterns and terms.
+
+    Parameters
+    ----------
+    symbols : int
+        Number of function symbols.
+    depth : int
+        Maximum depth of generated patterns. Terms are generated up to
+        twice this depth.
+    fanout : int
+        Maximum arity of function symbols.
+    nvars : int
+        Number of distinct variables available to each pattern.
+    var_density : float
+        Probability that a subterm of a pattern is a variable.
+    nonlinearity : float
+        Probability that a variable repeats one already used in the pattern.
+    leaves : int
+        Number of distinct leaf values.
+    seed : int, optional
+    """
+
+    def __init__(self, symbols=10, depth=4, fanout=2, nvars=3,
+                 var_density=0.3, nonlinearity=0.1, leaves=3, seed=0):
+        self.symbols = make_symbols(symbols, fanout)
+        self.depth = depth
+        self.vars = tuple('v{0}'.format(i) for i in range(nvars))
+        self.var_density = var_density
+        self.nonlinearity = nonlinearity
+        self.leaves = list(range(leaves))
+        self.random = random.Random(seed)
+
+    def term(self, depth=None):
+        """A random term, up to `depth` deep"""
+
+        rng = self.random
+        depth = 2 * self.depth if depth is None else depth
+        if depth == 0 or rng.random() < 0.2:
+            return rng.choice(self.leaves)
+        func, arity = rng.choice(self.symbols)
+        return (func,) + tuple(self.term(depth - 1) for i in range(arity))
+
+    def pattern(self):
+        """A random pattern, returned as a tuple of `(pat, vars)`"""
+
+        rng = self.random
+        used = []
+
+        def gen(depth):
+            if depth < self.depth and rng.random() < self.var_density:
+                if used and rng.random() < self.nonlinearity:
+                    return rng.choice(used)
+                free = [v for v in self.vars if v not in used]
+                if free:
+                    used.append(rng.choice(free))
+                    return used[-1]
+            if depth == 0 or rng.random() < 0.1:
+                return rng.choice(self.leaves)
+            func, arity = rng.choice(self.symbols)
+            return (func,) + tuple(gen(depth - 1) for i in range(arity))
+        return gen(self.depth), self.vars
+
+    def instance(self, pat, vars):
+        """A random term matching the pattern `pat`"""
+
+        subs = {}
+
+        def gen(p):
+            if p in vars:
+                if p not in subs:
+                    subs[p] = self.term(self.depth)
+                return subs[p]
+            elif isinstance(p, tuple):
+                return (p[0],) + tuple(gen(a) for a in p[1:])
+            return p
+        return gen(pat)
+
+    def patterns(self, n):
+        """A list of `n` random `(pat, vars)`"""
+
+        return [self.pattern() for i in range(n)]
+
+    def terms(self, n, patterns=(), match_fraction=0.5):
+        """A list of `n` random terms.
+
+        About `match_fraction` of the terms are instances of a random pattern
+        from `patterns`, the rest are fully random."""
+
+        rng = self.random
+        out = []
+        for i in range(n):
+            if patterns and rng.random() < match_fraction:
+                out.append(self.instance(*rng.choice(patterns)))
+            else:
+                out.append(self.term())
+        return out
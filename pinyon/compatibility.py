@@ -5,10 +5,15 @@ import sys
 PY3 = sys.version_info[0] == 3
 
 if PY3:
-    from collections import Iterator
+    try:
+        from collections.abc import Iterator
+    except ImportError:
+        from collections import Iterator
     from functools import reduce
+    from queue import Queue
 else:
     class Iterator(object):
         def next(self):
             return type(self).__next__(self)
     reduce = reduce
+    from Queue import Queue
@@ -1,14 +1,21 @@
 from __future__ import absolute_import, division, print_function
 
-from .compatibility import reduce, Iterator
+from .compatibility import reduce, PY3
 from .matching import (Traverser, Pattern, PatternSet, StaticPatternSet,
-        DynamicPatternSet)
+        DynamicPatternSet, LazyPatternSet, BottomUpPatternSet,
+        CompiledPatternSet, HybridPatternSet, select_patternset)
+from .matching.hybrid import MAX_STATES
+from .matching.static import cached_patternset
+from .rewrite import RuleSet, rewrite
 from .util import copy_doc
 
 
 class Engine(object):
     """Main entry point for Pinyon"""
 
+    # Rule set built by the last `rewrite` given a list of rules
+    _rules = None
+
     def __init__(self, context):
         self.context = context
 
@@ -17,21 +24,118 @@ class Engine(object):
         return Pattern(self.context, pat, vars)
 
     @copy_doc(PatternSet, True)
-    def patternset(self, patterns, type='static'):
-        if type == 'dynamic':
+    def patternset(self, patterns, type='static', cache_dir=None,
+                   max_states=MAX_STATES):
+        if type == 'auto':
+            return select_patternset(self.context, patterns, max_states)
+        elif type == 'hybrid':
+            return HybridPatternSet(self.context, patterns, max_states)
+        elif type == 'static' and cache_dir is not None:
+            return cached_patternset(self.context, patterns, cache_dir)
+        elif type == 'dynamic':
             return DynamicPatternSet(self.context, patterns)
+        elif type == 'lazy':
+            return LazyPatternSet(self.context, patterns)
+        elif type == 'bottomup':
+            return BottomUpPatternSet(self.context, patterns)
+        elif type == 'compiled':
+            return CompiledPatternSet(self.context, patterns)
         else:
             return StaticPatternSet(self.context, patterns)
 
+    def ruleset(self, rules, type='static'):
+        """Create a set of rewrite rules.
 
-class Context(object):
-    """Abstracting the interface for a term"""
+        Parameters
+        ----------
+        rules : list
+            A list of `(lhs, rhs)` pairs, where `lhs` is a `Pattern`, and
+            `rhs` a term that may contain the variables of the pattern.
+        type : str, optional
+            The type of pattern set to match the left hand sides with.
+        """
 
-    def __init__(self, head=None, args=None, subs=None, rebuild=None):
+        lhs = [l for (l, r) in rules]
+        rhs = [r for (l, r) in rules]
+        return RuleSet(self.patternset(lhs, type), rhs)
+
+    @copy_doc(rewrite)
+    def rewrite(self, term, rules, strategy='innermost', memo=None):
+        if not isinstance(rules, RuleSet):
+            rules = self._cached_ruleset(rules)
+        return rewrite(rules, term, strategy, memo)
+
+    def _cached_ruleset(self, rules):
+        """The rule set of a list of rules, reused while the same rules are
+        given, so repeated rewrites don't rebuild it and a memo passed to
+        them stays with one rule set."""
+        rules = list(rules)
+        cached = self._rules
+        if (cached is not None and len(cached[0]) == len(rules) and
+                all(l1 is l2 and r1 is r2 for ((l1, r1), (l2, r2))
+                    in zip(cached[0], rules))):
+            return cached[1]
+        ruleset = self.ruleset(rules)
+        self._rules = (rules, ruleset)
+        return ruleset
+
+
+class Context(object):
+    """Abstracting the interface for a term
+
+    Parameters
+    ----------
+    head, args, subs, rebuild : callable
+        The term interface, see the README.
+    traverser : callable, optional
+        Called as ``traverser(context, term, variant)`` to make the traversals
+        returned by `traverse`, for term types that can be traversed faster
+        than through `args`. The traversal must provide the same interface as
+        `Traverser`. Defaults to `PreorderTraversal`.
+    hash : callable or bool, optional
+        Structural hashes of terms, used to reject unequal subterms matched
+        by the same variable of a nonlinear pattern without comparing them.
+        If `True`, Merkle style hashes are computed from `head` and `args`,
+        once per subterm in each match. Terms that cache a structural hash
+        themselves can give a hash function instead. Defaults to `None`,
+        where subterms are only compared with ``==``.
+    head_args : callable, optional
+        Returns a tuple of ``(head(term), args(term))``, found at once. Used
+        by traversals and matchers instead of separate calls to `head` and
+        `args`, when both are needed for the same term.
+    child : callable, optional
+        Called as ``child(term, i)``, returns ``args(term)[i]`` without
+        making the arguments. Used by `get` and `index`.
+    """
+
+    # Defaults for contexts pickled before these were added
+    traverser = None
+    hash = None
+    head_args = None
+    child = None
+
+    def __init__(self, head=None, args=None, subs=None, rebuild=None,
+                 traverser=None, hash=None, head_args=None, child=None):
         self.head = head
         self.args = args
         self.subs = subs
         self.rebuild = rebuild
+        self.traverser = traverser
+        self.hash = hash
+        self.head_args = head_args
+        self.child = child
+
+    # Contexts are compared by their callbacks, so that a context is equal to
+    # a pickled and unpickled copy of itself.
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.head, self.args, self.subs, self.rebuild,
+                     self.traverser, self.hash, self.head_args, self.child))
 
     def index(self, term, inds):
         """Get a subterm from its path index"""
@@ -39,6 +143,8 @@ class Context(object):
 
     def get(self, term, ind):
         """Get the `ind`th subterm of `term`."""
+        if self.child is not None:
+            return self.child(term, ind)
         return self.args(term)[ind]
 
     def traverse(self, term, variant="normal"):
@@ -51,69 +157,31 @@ class Context(object):
             Specify a variation of preorder traversal. Options are:
             - ``"normal"``: yields ``term``
             - ``"path"``: yields ``(term, path_index)``
+            - ``"tracked"``: yields ``term``, keeping its path index, found
+              with the ``path`` attribute of the traversal
             - ``"arity"``: yields ``(term, arity)``
-            - ``"copyable"``: a copyable, stack based implementation, good for
-              backtracking. Yields ``term``
+            - ``"copyable"``: yields ``term``. Kept for backwards
+              compatibility, as all traversals can be copied for
+              backtracking.
         """
 
-        if variant == 'copyable':
+        if self.traverser is not None:
+            return self.traverser(self, term, variant)
+        elif variant == 'copyable':
             return Traverser(self, term)
-        else:
-            return PreorderTraversal(self, term, variant)
-
-
-# TODO: It would be really nice to get rid of one of the traversal
-# implementations. The stack based implementation (`Traverser`, imported from
-# matching/core.py) is only used by the dynamic pattern sets, but a way to
-# store the iteration state is necessary for backtracking. Conversely, the
-# recursive algorithm is only necessary for the static pattern sets, as the
-# path index of the current term is much faster to find in a recursive fashion.
-# I'm fairly certain there must be a way to eliminate one of these...
-class PreorderTraversal(Iterator):
-    """Preorder traversal of a generic term"""
-
-    def __init__(self, context, node, variant="normal"):
-        self._skip_flag = False
-
-        args = context.args
-        if variant == "path":
-            # Yield (node, path index)
-            def _traverse(self, node, cur_path=()):
-                yield node, cur_path
-                if self._skip_flag:
-                    self._skip_flag = False
-                    return
-                for i, t in enumerate(args(node)):
-                    for st, path in _traverse(self, t, cur_path + (i,)):
-                        yield st, path
-        elif variant == "arity":
-            # Yield (node, path index)
-            def _traverse(self, node):
-                childs = args(node)
-                yield node, len(childs)
-                if self._skip_flag:
-                    self._skip_flag = False
-                    return
-                for t in childs:
-                    for res in _traverse(self, t):
-                        yield res
-        elif variant is "normal":
-            # Yield node
-            def _traverse(self, node):
-                yield node
-                if self._skip_flag:
-                    self._skip_flag = False
-                    return
-                for t in args(node):
-                    for st in _traverse(self, t):
-                        yield st
-        self._pt = _traverse(self, node)
-
-    def skip(self):
-        self._skip_flag = True
-
-    def __next__(self):
-        return next(self._pt)
+        return PreorderTraversal(self, term, variant)
+
+
+class PreorderTraversal(Traverser):
+    """Preorder traversal of a generic term, as an iterator.
+
+    The same as `Traverser`, except that on python 2 `next` follows the
+    iterator protocol instead of advancing the traversal."""
+
+    __slots__ = ()
 
     def __iter__(self):
         return self
+
+    if not PY3:
+        next = Traverser.__next__
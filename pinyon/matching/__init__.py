@@ -1,3 +1,10 @@
-from .core import Pattern, PatternSet, Traverser, VAR
+from .core import Pattern, PatternSet, Traverser, VAR, MatchStats
 from .dynamic import DynamicPatternSet
-from .static import StaticPatternSet
+from .static import StaticPatternSet, LazyPatternSet
+from .bottomup import BottomUpPatternSet
+from .compiled import CompiledPatternSet
+from .index import TermIndex
+from .incremental import MatchSession
+from .hybrid import HybridPatternSet, select_patternset
+from .parallel import ParallelMatcher
+from .vectorized import VectorizedMatcher, automata_tables
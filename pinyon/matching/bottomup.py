@@ -0,0 +1,226 @@
+from __future__ import absolute_import, division, print_function
+
+from .core import PatternSet, subterm_equal
+from ..util import copy_doc
+
+
+# Id of the subpattern representing a variable, which matches any term
+WILD = 0
+
+
+class BottomUpPatternSet(PatternSet):
+    """A set of patterns, matched with a bottom up tree automata.
+
+    Every node of a term is labeled with a state, computed from the head of
+    the node and the states of its children. A state is the set of
+    subpatterns matching at that node, so labeling a whole term takes a single
+    pass, and finds the matches at every position in the term at once.
+
+    The transitions of the automata are computed on demand, and cached.
+
+    Attributes
+    ----------
+    patterns : list
+        A list of `Pattern`s included in the `PatternSet`.
+    """
+
+    def __init__(self, context, patterns):
+        self.context = context
+        patterns = list(patterns)
+        if not all(self.context == p.context for p in patterns):
+            raise ValueError("All patterns in a PatternSet must have the same"
+                             "context")
+        # Subpatterns are hash-consed, mapping `(head, child ids)` to an id.
+        # Nonlinear patterns are linearized here, and checked after matching.
+        self._subpatterns = {}
+        # Map of `(head, arity)` to a list of `(id, child ids)` subpatterns
+        self._candidates = {}
+        # Map of subpattern id to the indices of patterns it's the root of
+        self._rules = {}
+        for i, pat in enumerate(patterns):
+            root = self._intern(pat.pat, pat.vars)
+            self._rules.setdefault(root, []).append(i)
+        # States, and the transitions between them. They're added to by
+        # matches, under the lock of the pattern set.
+        self._states = {}
+        self._members = []
+        self._matches = []
+        self._delta = {}
+        self._state(frozenset([WILD]))
+        # The patterns never change, the tables are the net
+        self._publish(patterns, None)
+
+    def _replace(self, patterns):
+        raise AttributeError("The patterns of a BottomUpPatternSet can't be "
+                             "changed")
+
+    def _intern(self, pat, vars):
+        """Add a subpattern, returning its id"""
+
+        if pat in vars:
+            return WILD
+        head = self.context.head(pat)
+        children = tuple(self._intern(a, vars) for a in self.context.args(pat))
+        key = (head, children)
+        ind = self._subpatterns.get(key)
+        if ind is None:
+            ind = self._subpatterns[key] = len(self._subpatterns) + 1
+            self._candidates.setdefault((head, len(children)), []).append(
+                    (ind, children))
+        return ind
+
+    def _state(self, members):
+        """Get the id of the state for a set of subpatterns"""
+
+        state = self._states.get(members)
+        if state is None:
+            state = self._states[members] = len(self._members)
+            self._members.append(members)
+            rules = set()
+            for m in members:
+                rules.update(self._rules.get(m, ()))
+            self._matches.append(tuple(sorted(rules)))
+        return state
+
+    def _transition(self, head, states):
+        """Find the state of a node from its head, and its children's states"""
+
+        try:
+            key = (head, states)
+            state = self._delta.get(key)
+            hashable = True
+        except TypeError:
+            # Unhashable heads only match variables
+            state, hashable = 0, False
+        if state is None:
+            members = set([WILD])
+            for ind, children in self._candidates.get((head, len(states)), ()):
+                for c, s in zip(children, states):
+                    if c not in self._members[s]:
+                        break
+                else:
+                    members.add(ind)
+            # New states are numbered in order, one at a time
+            with self._writing():
+                state = self._state(frozenset(members))
+            if hashable:
+                self._delta[key] = state
+        return state
+
+    def _label(self, term):
+        """Label every node in term with its state.
+
+        Returns a list of ``(term, parent, position, state)`` for each node in
+        preorder, where `parent` is the index of the parent node in the list
+        (-1 for the root), and `position` is the index of the node among its
+        parent's arguments."""
+
+        head = self.context.head
+        args = self.context.args
+        nodes = []
+        kids = []
+        stack = [(term, -1, None)]
+        while stack:
+            t, parent, pos = stack.pop()
+            ind = len(nodes)
+            nodes.append([t, parent, pos, None])
+            kids.append([])
+            if parent >= 0:
+                kids[parent].append(ind)
+            childs = args(t)
+            for j in range(len(childs) - 1, -1, -1):
+                stack.append((childs[j], ind, j))
+        # Children always come after their parent in preorder
+        for ind in range(len(nodes) - 1, -1, -1):
+            node = nodes[ind]
+            states = tuple(nodes[k][3] for k in kids[ind])
+            node[3] = self._transition(head(node[0]), states)
+        return nodes
+
+    def _root_state(self, term):
+        """Find the state of the root of a term.
+
+        Subterms are labeled once per object, so shared subterms are only
+        visited once however many times they appear."""
+
+        head = self.context.head
+        args = self.context.args
+        # Maps id(term) to (term, state). The term is kept to keep its id
+        # valid.
+        states = {}
+        stack = [(term, None)]
+        while stack:
+            t, childs = stack.pop()
+            if childs is not None:
+                key = tuple(states[id(c)][1] for c in childs)
+                states[id(t)] = (t, self._transition(head(t), key))
+            elif id(t) not in states:
+                childs = args(t)
+                stack.append((t, childs))
+                stack.extend((c, None) for c in childs)
+        return states[id(term)][1]
+
+    @copy_doc(PatternSet.match_iter)
+    def match_iter(self, term):
+        patterns = self.patterns
+        state = self._root_state(term)
+        equal = subterm_equal(self.context)
+        for i in self._matches[state]:
+            pat = patterns[i]
+            subs = _process_match(self.context, pat, term, equal)
+            if subs is not None:
+                yield pat, subs
+
+    def match_subterms(self, term):
+        """Finds all matchings for every subterm of term in the PatternSet.
+
+        Paramters
+        ---------
+        term : term
+
+        Returns
+        -------
+        List containing tuples of `(path, pat, subs)`, where `path` is the
+        path index of the matching subterm, `pat` is the pattern being
+        matched, and `subs` is a dictionary mapping the variables in the
+        pattern to their matching values in the subterm. Matches are ordered
+        by a preorder traversal of term."""
+
+        nodes = self._label(term)
+        equal = subterm_equal(self.context)
+        out = []
+        for ind, (t, parent, pos, state) in enumerate(nodes):
+            rules = self._matches[state]
+            if not rules:
+                continue
+            path = _path(nodes, ind)
+            for i in rules:
+                pat = self.patterns[i]
+                subs = _process_match(self.context, pat, t, equal)
+                if subs is not None:
+                    out.append((path, pat, subs))
+        return out
+
+
+def _path(nodes, ind):
+    """Find the path index of a node from its parent links"""
+
+    path = []
+    while ind > 0:
+        _, ind, pos, _ = nodes[ind]
+        path.append(pos)
+    return tuple(reversed(path))
+
+
+def _process_match(context, pat, term, equal):
+    """Find the substitution for a match of `pat` at `term`, checking that
+    nonlinear variables match equal subterms with `equal`. Returns `None` if
+    the match is invalid."""
+
+    subs = {}
+    for var, paths in pat._path_lookup.items():
+        subs[var] = first = context.index(term, paths[0])
+        for p in paths[1:]:
+            if not equal(context.index(term, p), first):
+                return None
+    return subs
@@ -0,0 +1,207 @@
+from __future__ import absolute_import, division, print_function
+from itertools import count
+
+from .core import VAR, PatternSet
+from .static import StaticPatternSet, initial_mset
+from ..util import copy_doc
+
+
+class CompiledPatternSet(StaticPatternSet):
+    """A set of patterns, matched with code generated from a static automata.
+
+    The deterministic automata built by `StaticPatternSet` is compiled into a
+    Python function of nested ``if`` statements and dictionary dispatches,
+    with the variable captures and nonlinear checks inlined. This avoids
+    interpreting the automata on every match. States reached from more than
+    one state get a function of their own, called from each, so that the
+    code stays linear in the size of the automata.
+
+    Unlike `StaticPatternSet`, transitions are keyed on both the head and the
+    arity of a term.
+
+    Attributes
+    ----------
+    patterns : list
+        A list of `Pattern`s included in the `PatternSet`.
+    source : str
+        The source code of the generated matching function.
+    """
+
+    def _publish(self, patterns, net):
+        # The generated function is part of the snapshot, compiled before
+        # it's published
+        matcher, source = compile_automata(self.context, patterns,
+                                           self._cache)
+        self.source = source
+        StaticPatternSet._publish(self, patterns, net, matcher)
+
+    def __getstate__(self):
+        # The generated function can't be pickled, compile it again instead
+        state = StaticPatternSet.__getstate__(self)
+        state['_snapshot'] = state['_snapshot'][:2]
+        del state['source']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._publish(*self._snapshot)
+
+    @copy_doc(PatternSet.match_iter)
+    def match_iter(self, t):
+        patterns, net, matcher = self._snapshot
+        for i, subs in matcher(t):
+            yield patterns[i], subs
+
+    match_many = PatternSet.match_many
+
+
+# Maximum indentation level of generated code, after which the rest of a
+# branch is continued in the function of its state.
+MAX_DEPTH = 40
+
+
+def compile_automata(context, patterns, cache):
+    """Compile the static automata into a Python function.
+
+    Parameters
+    ----------
+    context : Context
+    patterns : list
+        A list of `Pattern`s the automata was built from.
+    cache : dict
+        The transition cache of the automata, as filled by `build_automata`.
+
+    Returns
+    -------
+    A tuple of `(func, source)`. `func` takes a term and returns a list of
+    `(index, subs)` for each matching pattern, and `source` is the generated
+    source code."""
+
+    lookup = {'head': context.head, 'args': context.args,
+              'head_args': context.head_args, 'index': context.index}
+    var_names = {}
+    names = count()
+    funcs = []
+    # Maps `(key, pending paths, captured paths)` to the name of the
+    # function of a state, made on first use
+    state_funcs = {}
+
+    def const(prefix, value):
+        name = '_{0}{1}'.format(prefix, next(names))
+        lookup[name] = value
+        return name
+
+    def var_name(var):
+        if var not in var_names:
+            var_names[var] = const('v', var)
+        return var_names[var]
+
+    def leaf(lines, depth, mset, env):
+        indent = '    ' * depth
+        rules = sorted(set(i.rule for i in mset.items))
+        lines.append(indent + 'out = []')
+        for rule in rules:
+            checks = []
+            items = []
+            for var, paths in patterns[rule]._path_lookup.items():
+                terms = [env.get(p) or 'index(t, {0!r})'.format(p)
+                         for p in paths]
+                items.append('{0}: {1}'.format(var_name(var), terms[0]))
+                checks.extend('{0} == {1}'.format(terms[0], t)
+                              for t in terms[1:])
+            append = 'out.append(({0}, {{{1}}}))'.format(rule,
+                                                         ', '.join(items))
+            if checks:
+                lines.append(indent + 'if {0}:'.format(' and '.join(checks)))
+                lines.append(indent + '    ' + append)
+            else:
+                lines.append(indent + append)
+        lines.append(indent + 'return out')
+
+    def call(lines, depth, key, mset, pending, env):
+        """Continue in the function of a state, passing it the pending
+        subterms, and the captured ones it may need"""
+        rules = set(i.rule for i in mset.items)
+        needed = set(p for r in rules
+                     for ps in patterns[r]._path_lookup.values() for p in ps)
+        # The root is always passed, as `t`
+        captured = sorted(p for p in env if p in needed and p)
+        live = ['t'] + [env[p] for p in captured]
+        live.extend(n for (n, p) in pending)
+        sig = (key, tuple(pending), tuple(captured))
+        func = state_funcs.get(sig)
+        if func is None:
+            # Passed as a single tuple, as python before 3.7 limits the
+            # number of arguments
+            func = state_funcs[sig] = '_f{0}'.format(next(names))
+            body = ['def {0}(e):'.format(func),
+                    '    {0}, = e'.format(', '.join(live))]
+            funcs.append(body)
+            gen(body, 1, key, mset, pending,
+                dict((p, env[p]) for p in captured), True)
+        lines.append('    ' * depth + 'return {0}(({1},))'.format(
+            func, ', '.join(live)))
+
+    def gen(lines, depth, key, mset, pending, env, entry=False):
+        if not entry and (shared[key] or depth > MAX_DEPTH):
+            return call(lines, depth, key, mset, pending, env)
+        trans = cache[key]
+        if not trans:
+            return leaf(lines, depth, mset, env)
+        indent = '    ' * depth
+        (name, path), pending = pending[-1], pending[:-1]
+        env = dict(env)
+        env[path] = name
+        var_branch = None
+        dispatch = {}
+        branches = []
+        for t, k, m in trans:
+            if t[0] is VAR:
+                var_branch = (k, m)
+            else:
+                dispatch[t] = len(branches)
+                branches.append((t[1], k, m))
+        if branches:
+            d = const('d', dispatch)
+            if context.head_args is not None:
+                lines.append(indent + 'h, c = head_args({0})'.format(name))
+            else:
+                lines.append(indent + 'c = args({0})'.format(name))
+                lines.append(indent + 'h = head({0})'.format(name))
+            lines.append(indent + 'k = {0}.get((h, len(c)))'.format(d))
+            for i, (arity, k, m) in enumerate(branches):
+                lines.append(indent + 'if k == {0}:'.format(i))
+                # Name subterms by their path, so that names are reused
+                # across branches. This keeps the number of locals small.
+                children = []
+                for j in range(arity):
+                    p = path + (j,)
+                    children.append(('t_' + '_'.join(map(str, p)), p))
+                if children:
+                    lines.append(indent + '    {0}, = c'.format(
+                        ', '.join(n for (n, p) in children)))
+                gen(lines, depth + 1, k, m,
+                    pending + list(reversed(children)), env)
+        if var_branch is not None:
+            gen(lines, depth, var_branch[0], var_branch[1], pending, env)
+        else:
+            lines.append(indent + 'return []')
+
+    root = initial_mset(context, patterns)
+    # Whether each state is reached from more than one state. The automata
+    # is a DAG, inlining shared states could make the code exponential.
+    shared = {root.key: False}
+    stack = [root.key]
+    while stack:
+        for t, k, m in cache[stack.pop()]:
+            if k in shared:
+                shared[k] = True
+            else:
+                shared[k] = False
+                stack.append(k)
+    main = ['def match(t):']
+    funcs.append(main)
+    gen(main, 1, root.key, root, [('t', ())], {}, True)
+    source = '\n\n'.join('\n'.join(f) for f in funcs) + '\n'
+    exec(compile(source, '<pinyon-compiled>', 'exec'), lookup)
+    return lookup['match'], source
@@ -1,5 +1,7 @@
 from __future__ import absolute_import, division, print_function
-from collections import deque
+from copy import copy
+from operator import eq
+from threading import Lock, RLock
 
 
 class Pattern(object):
@@ -35,6 +37,10 @@ class Pattern(object):
         self._varlist = varlist
 
 
+# Guards making the lock of each pattern set
+_lock_init = Lock()
+
+
 class PatternSet(object):
     """A set of patterns.
 
@@ -46,8 +52,110 @@ class PatternSet(object):
     context : Context
     patterns : list
         A list of `Pattern`s included in the `PatternSet`.
+
+    Notes
+    -----
+    Pattern sets are safe to match against from many threads, while another
+    thread updates them. Everything a match reads is kept in a single
+    snapshot tuple, starting with the patterns and the net or automata.
+    Snapshots are never modified. Updates build a new one under a lock, and
+    publish it with a single assignment, so a match runs without locking on
+    the snapshot it started with.
     """
 
+    # Instrumentation is off by default, see `instrument`
+    _instrumented = False
+
+    @property
+    def patterns(self):
+        return self._snapshot[0]
+
+    @patterns.setter
+    def patterns(self, patterns):
+        with self._writing():
+            self._replace(list(patterns))
+
+    def _replace(self, patterns):
+        """Publish a new list of patterns, on assignment to `patterns`.
+
+        Pattern sets with a net override this to rebuild it. By default only
+        the patterns are replaced, for subclasses keeping no net."""
+        snapshot = self.__dict__.get('_snapshot', (None, None))
+        self._snapshot = (patterns,) + snapshot[1:]
+
+    @property
+    def _net(self):
+        return self._snapshot[1]
+
+    def _publish(self, patterns, net, *extra):
+        """Replace the snapshot read by matches. Each snapshot has its own
+        list of patterns, so that changing it leaves the others alone."""
+        self._snapshot = (list(patterns), net) + extra
+
+    def _writing(self):
+        """The lock serializing updates, made on first use"""
+        lock = self.__dict__.get('_lock')
+        if lock is None:
+            with _lock_init:
+                lock = self.__dict__.setdefault('_lock', RLock())
+        return lock
+
+    def __getstate__(self):
+        # Locks can't be pickled, a new one is made when needed
+        state = self.__dict__.copy()
+        state.pop('_lock', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def instrument(self, enable=True, hook=None):
+        """Turn counting of the work done by the matcher on or off.
+
+        When on, every call to `match_iter` (and the methods built on it)
+        counts its work in a `MatchStats`. Once a call finishes, its counts
+        are stored in the `last_stats` attribute, and added to the `stats`
+        attribute, which accumulates the counts since instrumentation was
+        turned on. Turning it off keeps both. Instrumentation has nearly no
+        cost when off.
+
+        Counting is supported by `StaticPatternSet`, `LazyPatternSet`,
+        `DynamicPatternSet` and `HybridPatternSet`, other pattern sets raise
+        a `NotImplementedError`. While counting, `StaticPatternSet.match_many`
+        matches each term on its own, so that its work is counted too.
+
+        Parameters
+        ----------
+        enable : bool, optional
+            Whether to turn instrumentation on or off.
+        hook : callable, optional
+            Called as ``hook(pset, stats)`` after each call finishes, with
+            the counts for that call. Useful to feed an external profiler.
+        """
+
+        if enable:
+            # Only counted through `_match_iter`, which sets overriding
+            # `match_iter` don't use
+            if any('match_iter' in vars(c) for c in type(self).__mro__
+                   if c is not PatternSet):
+                raise NotImplementedError("{0} doesn't support counting"
+                                          .format(type(self).__name__))
+            self._hook = hook
+            self.stats = MatchStats()
+            self.last_stats = None
+        self._instrumented = enable
+
+    def _instrumented_iter(self, term):
+        stats = MatchStats()
+        try:
+            for res in self._match_iter(term, stats):
+                yield res
+        finally:
+            self.last_stats = stats
+            self.stats += stats
+            if self._hook is not None:
+                self._hook(self, stats)
+
     def match_iter(self, term):
         """A generator that lazily finds matchings for term from the PatternSet.
 
@@ -60,7 +168,12 @@ class PatternSet(object):
         Tuples of `(pat, subs)`, where `pat` is the pattern being matched, and
         `subs` is a dictionary mapping the variables in the pattern to their
         matching values in the term."""
-        pass
+
+        # Subclasses implement `_match_iter`, or override `match_iter`. This
+        # keeps the uninstrumented path free of any bookkeeping.
+        if self._instrumented:
+            return self._instrumented_iter(term)
+        return self._match_iter(term, None)
 
     def match_all(self, term):
         """Finds all matchings for term in the PatternSet.
@@ -97,44 +210,287 @@ class PatternSet(object):
             return pat, subs
         return None, None
 
+    def match_many(self, terms):
+        """Finds all matchings for every term in a batch of terms.
+
+        Work is shared between terms in the batch. Terms that are repeated
+        (by identity) are only matched once.
+
+        Paramters
+        ---------
+        terms : iterable
+            An iterable of terms.
+
+        Returns
+        -------
+        A list with an entry for each term, containing a list of tuples of
+        `(pat, subs)` as returned by `match_all`."""
+
+        memo = {}
+        out = []
+        for term in terms:
+            hit = memo.get(id(term))
+            if hit is None:
+                # Also store the term, to keep it alive while its id is a key
+                hit = memo[id(term)] = (term, self.match_all(term))
+            out.append(list(hit[1]))
+        return out
+
+
+class MatchStats(object):
+    """Counters of the work done by a matcher.
+
+    Attributes
+    ----------
+    nodes : int
+        Nodes of the term visited.
+    transitions : int
+        Transitions taken in the automata or net.
+    captures : int
+        Subterms captured by variables.
+    choice_points : int
+        Choice points pushed for backtracking.
+    backtracks : int
+        Times the matcher backtracked to a choice point.
+    rejected : int
+        Candidate matches rejected, due to nonlinear variables.
+    head_calls : int
+        Calls to `Context.head`.
+    args_calls : int
+        Calls to `Context.args`.
+    """
+
+    __slots__ = ('nodes', 'transitions', 'captures', 'choice_points',
+                 'backtracks', 'rejected', 'head_calls', 'args_calls')
+
+    def __init__(self, **counts):
+        for k in self.__slots__:
+            setattr(self, k, counts.pop(k, 0))
+        if counts:
+            raise TypeError("Unknown counters: {0}".format(
+                ', '.join(sorted(counts))))
+
+    def __iadd__(self, other):
+        for k in self.__slots__:
+            setattr(self, k, getattr(self, k) + getattr(other, k))
+        return self
+
+    def __eq__(self, other):
+        return (isinstance(other, MatchStats) and
+                self.as_dict() == other.as_dict())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "MatchStats({0})".format(', '.join(
+            '{0}={1}'.format(k, getattr(self, k)) for k in self.__slots__))
+
+    def as_dict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+
+def counting_context(context, stats):
+    """A copy of `context` that counts calls to `head` and `args` in
+    `stats`. A call to `head_args` counts as one of each."""
+
+    head, args, head_args = context.head, context.args, context.head_args
+
+    def counted_head(term):
+        stats.head_calls += 1
+        return head(term)
+
+    def counted_args(term):
+        stats.args_calls += 1
+        return args(term)
+
+    def counted_head_args(term):
+        stats.head_calls += 1
+        stats.args_calls += 1
+        return head_args(term)
+
+    ctx = copy(context)
+    ctx.head = counted_head
+    ctx.args = counted_args
+    if head_args is not None:
+        ctx.head_args = counted_head_args
+    return ctx
+
+
+def subterm_equal(context):
+    """A function comparing two subterms for equality.
+
+    Used to check the subterms matched by the same variable of a nonlinear
+    pattern. If `context.hash` is set, structural hashes are compared first,
+    and terms are only compared with ``==`` if their hashes are equal. Make a
+    new function for each match, as Merkle hashes (``context.hash = True``)
+    are cached by the identity of the subterms."""
+
+    hasher = context.hash
+    if not hasher:
+        return eq
+    elif hasher is True:
+        hasher = merkle_hasher(context)
+
+    def equal(a, b):
+        if a is b:
+            return True
+        try:
+            if hasher(a) != hasher(b):
+                return False
+        except TypeError:
+            # Unhashable parts, can only compare
+            pass
+        return a == b
+    return equal
+
+
+def merkle_hasher(context):
+    """A function computing Merkle style structural hashes of terms.
+
+    The hash of a term combines the hash of its head with the hashes of its
+    arguments. The hash of each subterm is computed once, and cached by
+    identity for the lifetime of the returned function."""
+
+    head_args = context.head_args
+    if head_args is None:
+        head, args = context.head, context.args
+
+        def head_args(t):
+            return head(t), args(t)
+    # Maps id(term) to (term, hash). The term is kept to keep its id valid.
+    cache = {}
+
+    def merkle(term):
+        hit = cache.get(id(term))
+        if hit is not None:
+            return hit[1]
+        stack = [(term, None)]
+        while stack:
+            t, found = stack.pop()
+            if found is not None:
+                h, a = found
+                h = hash((h, tuple(cache[id(c)][1] for c in a)))
+                cache[id(t)] = (t, h)
+            elif id(t) not in cache:
+                found = head_args(t)
+                stack.append((t, found))
+                stack.extend((c, None) for c in found[1])
+        return cache[id(term)][1]
+    return merkle
+
 
 class Token(object):
     """A token object.
 
-    Used to express certain objects in the traversal of a term or pattern."""
+    Used to express certain objects in the traversal of a term or pattern.
+    Tokens are compared by identity, so they're pickled by reference to the
+    module level name `ref`."""
 
-    def __init__(self, name):
+    def __init__(self, name, ref):
         self.name = name
+        self.ref = ref
 
     def __repr__(self):
         return self.name
 
+    def __reduce__(self):
+        return self.ref
+
 
 # A variable to represent *all* variables in a discrimination net
-VAR = Token('?')
+VAR = Token('?', 'VAR')
 # Represents the end of the traversal of an expression. We can't use `None`,
 # 'False', etc... here, as anything may be an argument to a function.
-END = Token('end')
+END = Token('end', 'END')
+
+
+# The traversal variants keeping paths
+_tracked = ('path', 'tracked')
+
+
+def _unlink_path(cell):
+    """Make a path of `(index, parent)` cells into a tuple"""
+    path = []
+    while cell:
+        i, cell = cell
+        path.append(i)
+    path.reverse()
+    return tuple(path)
 
 
 class Traverser(object):
     """Stack based preorder traversal of terms.
 
-    This provides a copyable traversal object, which can be used to store
-    choice points when backtracking."""
+    The traversal can be iterated over, or driven manually with `next` and
+    `skip`, with `term` the current term. Subterms are found without
+    recursion, so terms of any depth can be traversed.
 
-    def __init__(self, context, term, stack=None):
-        self.term = term
+    The stack of pending terms is a linked list of `(term, rest)` cells,
+    which is never mutated. Copies share it, so copying is constant time.
+    Paths are kept the same way, as `(index, parent)` cells, and only made
+    into tuples when asked for.
+
+    Parameters
+    ----------
+    context : Context
+    term : term
+    variant : str, optional
+        What iterating over the traversal yields. Options are:
+        - ``"normal"``: yields ``term``
+        - ``"path"``: yields ``(term, path_index)``
+        - ``"tracked"``: yields ``term``, keeping its path index, found with
+          `path`
+        - ``"arity"``: yields ``(term, arity)``
+        - ``"copyable"``: same as ``"normal"``. All traversals can be copied,
+          to store choice points when backtracking.
+    """
+
+    __slots__ = ('context', 'term', 'variant', '_args_of', '_head_args',
+                 '_stack', '_paths', '_path', '_head', '_args', '_fresh')
+
+    def __init__(self, context, term, variant='normal'):
         self.context = context
-        if not stack:
-            self._stack = deque([END])
-        else:
-            self._stack = stack
+        self.term = term
+        self.variant = variant
+        self._args_of = context.args
+        self._head_args = context.head_args
+        self._stack = (END, None)
+        # Paths of the terms on the stack, kept only when needed. Each is a
+        # linked list of `(index, parent)` cells, ending with `()` at the
+        # root.
+        self._paths = (None, None) if variant in _tracked else None
+        self._path = ()
+        # Arguments of the current term, once computed. With a `head_args`
+        # hook, the head is found along with them.
+        self._head = None
+        self._args = None
+        # Whether the current term has yet to be yielded by iteration
+        self._fresh = True
 
     def __iter__(self):
-        while self.term is not END:
-            yield self.term
-            self.next()
+        # Not `return self`, as `next` advances the traversal instead of
+        # following the python 2 iterator protocol.
+        return iter(self.__next__, END)
+
+    def __next__(self):
+        if self._fresh:
+            self._fresh = False
+        elif self.term is not END:
+            self._next()
+            self._fresh = False
+        term = self.term
+        if term is END:
+            raise StopIteration
+        variant = self.variant
+        if variant == 'path':
+            return term, _unlink_path(self._path)
+        elif variant == 'arity':
+            args = self._args
+            if args is None:
+                args = self._load()
+            return term, len(args)
+        return term
 
     def copy(self):
         """Copy the traverser in its current state.
@@ -142,27 +498,89 @@ class Traverser(object):
         This allows the traversal to be pushed onto a stack, for easy
         backtracking."""
 
-        return Traverser(self.context, self.term, deque(self._stack))
+        new = object.__new__(type(self))
+        new.context = self.context
+        new.term = self.term
+        new.variant = self.variant
+        new._args_of = self._args_of
+        new._head_args = self._head_args
+        new._stack = self._stack
+        new._paths = self._paths
+        new._path = self._path
+        new._head = self._head
+        new._args = self._args
+        new._fresh = self._fresh
+        return new
 
     def next(self):
         """Proceed to the next term in the preorder traversal."""
 
-        subterms = self.context.args(self.term)
+        subterms = self._args
+        if subterms is None:
+            subterms = self._args_of(self.term)
         if not subterms:
-            # No subterms, pop off stack
-            self.term = self._stack.pop()
+            return self.skip()
+        stack = self._stack
+        for i in range(len(subterms) - 1, 0, -1):
+            stack = (subterms[i], stack)
+        self._stack = stack
+        self.term = subterms[0]
+        paths = self._paths
+        if paths is not None:
+            path = self._path
+            for i in range(len(subterms) - 1, 0, -1):
+                paths = ((i, path), paths)
+            self._paths = paths
+            self._path = (0, path)
+        self._args = None
+        self._fresh = True
+
+    # Iteration uses `_next`, as subclasses may override `next`
+    _next = next
+
+    def _load(self):
+        """Find and keep the arguments of the current term, along with its
+        head if the context has a `head_args` hook"""
+
+        if self._head_args is None:
+            args = self._args = self._args_of(self.term)
         else:
-            self.term = subterms[0]
-            self._stack.extend(reversed(subterms[1:]))
+            self._head, args = self._head_args(self.term)
+            self._args = args
+        return args
 
     @property
     def current(self):
-        return self.context.head(self.term)
+        head_args = self._head_args
+        if head_args is None:
+            return self.context.head(self.term)
+        if self._args is None:
+            # Find the arguments along with the head, as they're usually
+            # needed next. See `_load`, the head is kept whenever the
+            # arguments are.
+            self._head, self._args = head_args(self.term)
+        return self._head
 
     @property
     def arity(self):
-        return len(self.context.args(self.term))
+        args = self._args
+        if args is None:
+            args = self._load()
+        return len(args)
+
+    @property
+    def path(self):
+        """The path index of the current term, for the ``"path"`` and
+        ``"tracked"`` variants"""
+        if self._paths is None:
+            raise ValueError("Paths are only kept by the 'path' and "
+                             "'tracked' variants")
+        return _unlink_path(self._path)
 
     def skip(self):
         """Skip over all subterms of the current level in the traversal"""
-        self.term = self._stack.pop()
+        self.term, self._stack = self._stack
+        if self._paths is not None:
+            self._path, self._paths = self._paths
+        self._args = None
+        self._fresh = True
@@ -1,7 +1,6 @@
 from __future__ import absolute_import, division, print_function
-from collections import deque
 
-from .core import VAR, END, PatternSet
+from .core import VAR, END, PatternSet, counting_context, subterm_equal
 from ..util import copy_doc
 
 
@@ -19,14 +18,35 @@ class DynamicPatternSet(PatternSet):
 
     def __init__(self, context, patterns):
         self.context = context
-        self._net = Node()
-        self.patterns = []
-        for p in patterns:
-            self.add(p)
+        self._replace(list(patterns))
+
+    def _replace(self, patterns):
+        net = Node()
+        for ind, pat in enumerate(patterns):
+            if self.context != pat.context:
+                raise ValueError("All patterns in a PatternSet must have the "
+                                 "same context")
+            # Not published yet, so built in place
+            curr_node = net
+            for t in self._edges(pat):
+                curr_node = curr_node.edges.setdefault(t, Node())
+            curr_node.patterns.append(ind)
+        self._publish(patterns, net)
+
+    def _edges(self, pat):
+        """The edges from the root of the net to the leaf of a pattern"""
+
+        vars = pat.vars
+        heads = map(self.context.head, self.context.traverse(pat.pat))
+        # Variables are all the same edge, in the POT of the term
+        return [VAR if t in vars else t for t in heads]
 
     def add(self, pat):
         """Add a pat to the DynamicPatternSet.
 
+        The nodes on the path to the new pattern are copied, the rest of the
+        net is shared with the previous one.
+
         Parameters
         ----------
         pat : Pattern
@@ -35,32 +55,63 @@ class DynamicPatternSet(PatternSet):
         if self.context != pat.context:
             raise ValueError("All patterns in a PatternSet must have the same"
                              "context")
-        vars = pat.vars
-        curr_node = self._net
-        ind = len(self.patterns)
-        # List of variables, in order they appear in the POT of the term
-        for t in map(self.context.head, self.context.traverse(pat.pat)):
-            prev_node = curr_node
-            if t in vars:
-                t = VAR
-            if t in curr_node.edges:
-                curr_node = curr_node.edges[t]
-            else:
-                curr_node.edges[t] = Node()
-                curr_node = curr_node.edges[t]
-        # We've reached a leaf node. Add the term index to this leaf.
-        prev_node.edges[t].patterns.append(ind)
-        self.patterns.append(pat)
-
-    @copy_doc(PatternSet.match_iter)
-    def match_iter(self, term):
-        S = self.context.traverse(term, 'copyable')
-        for m, syms in _match(S, self._net):
+        with self._writing():
+            patterns, net = self._snapshot
+            ind = len(patterns)
+            net = curr_node = _copy_node(net)
+            for t in self._edges(pat):
+                child = curr_node.edges.get(t)
+                child = Node() if child is None else _copy_node(child)
+                curr_node.edges[t] = child
+                curr_node = child
+            # We've reached a leaf node. Add the term index to this leaf.
+            curr_node.patterns.append(ind)
+            self._publish(patterns + [pat], net)
+
+    def remove(self, pat):
+        """Remove a pat from the DynamicPatternSet.
+
+        Branches of the net that no longer lead to any pattern are pruned.
+        As the indices of the patterns after it change, the whole net is
+        copied.
+
+        Parameters
+        ----------
+        pat : Pattern
+        """
+
+        with self._writing():
+            patterns, net = self._snapshot
+            ind = patterns.index(pat)
+            net = _renumber(net, ind)
+            # Walk down the net, recording the path to the leaf
+            nodes = [net]
+            edges = self._edges(pat)
+            for t in edges:
+                nodes.append(nodes[-1].edges[t])
+            # Prune empty branches, from the leaf up
+            for node, t in zip(reversed(nodes[:-1]), reversed(edges)):
+                child = node.edges[t]
+                if child.edges or child.patterns:
+                    break
+                del node.edges[t]
+            self._publish(patterns[:ind] + patterns[ind + 1:], net)
+
+    def _match_iter(self, term, stats):
+        context = self.context
+        if stats is not None:
+            context = counting_context(context, stats)
+        patterns, net = self._snapshot
+        S = context.traverse(term, 'copyable')
+        equal = subterm_equal(self.context)
+        for m, syms in _match(S, net, stats):
             for i in m:
-                pat = self.patterns[i]
-                subs = _process_match(pat, syms)
+                pat = patterns[i]
+                subs = _process_match(pat, syms, equal)
                 if subs is not None:
                     yield pat, subs
+                elif stats is not None:
+                    stats.rejected += 1
 
 
 class Node(tuple):
@@ -73,6 +124,9 @@ class Node(tuple):
         patterns = patterns if patterns else []
         return tuple.__new__(cls, (edges, patterns))
 
+    def __getnewargs__(self):
+        return tuple(self)
+
     @property
     def edges(self):
         """A dictionary, where the keys are edges, and the values are nodes"""
@@ -84,35 +138,69 @@ class Node(tuple):
         return self[1]
 
 
-def _match(S, N):
-    """Structural matching of term S to discrimination net node N."""
+def _copy_node(node):
+    """A copy of a node, sharing its children"""
 
-    stack = deque()
+    return Node(dict(node.edges), list(node.patterns))
+
+
+def _renumber(net, ind):
+    """A copy of a whole net, with the pattern at index `ind` removed, and the
+    indices of all patterns after it shifted down by one"""
+
+    new = Node()
+    stack = [(net, new)]
+    while stack:
+        old, copied = stack.pop()
+        copied.patterns.extend(i - 1 if i > ind else i for i in old.patterns
+                               if i != ind)
+        for t, child in old.edges.items():
+            copied.edges[t] = Node()
+            stack.append((child, copied.edges[t]))
+    return new
+
+
+def _match(S, N, stats=None):
+    """Structural matching of term S to discrimination net node N.
+
+    If `stats` is a `MatchStats`, the work done is counted in it."""
+
+    stack = []
     restore_state_flag = False
-    # matches are stored in a tuple, because all mutations result in a copy,
-    # preventing operations from changing matches stored on the stack.
-    matches = ()
+    # matches are stored as a linked list of `(term, rest)` cells, newest
+    # first. Capturing only adds a cell, so the matches stored with each
+    # choice point share their tail with the current ones.
+    matches = None
     while True:
         if S.term is END:
-            yield N.patterns, matches
+            yield N.patterns, _unlink(matches)
+        elif stats is not None:
+            stats.nodes += 1
         try:
             # This try-except block is to catch hashing errors from un-hashable
             # types. This allows for variables to be matched with un-hashable
             # objects.
             n = N.edges.get(S.current, None)
             if n and not restore_state_flag:
+                # Copying the traversal is constant time, see `Traverser`
                 stack.append((S.copy(), N, matches))
                 N = n
                 S.next()
+                if stats is not None:
+                    stats.choice_points += 1
+                    stats.transitions += 1
                 continue
         except TypeError:
             pass
         n = N.edges.get(VAR, None)
         if n:
             restore_state_flag = False
-            matches = matches + (S.term,)
+            matches = (S.term, matches)
             S.skip()
             N = n
+            if stats is not None:
+                stats.transitions += 1
+                stats.captures += 1
             continue
         try:
             # Backtrack here
@@ -120,9 +208,23 @@ def _match(S, N):
             restore_state_flag = True
         except:
             return
+        if stats is not None:
+            stats.backtracks += 1
+
+
+def _unlink(cells):
+    """Convert a linked list of `(item, rest)` cells to a tuple, oldest
+    first"""
+
+    out = []
+    while cells is not None:
+        item, cells = cells
+        out.append(item)
+    out.reverse()
+    return tuple(out)
 
 
-def _process_match(pat, syms):
+def _process_match(pat, syms, equal):
     """Process a match to determine if it is correct, and to find the correct
     substitution that will convert the term into the pattern.
 
@@ -131,6 +233,8 @@ def _process_match(pat, syms):
     pat : Pattern
     syms : iterable
         Iterable of subterms that match a corresponding variable.
+    equal : callable
+        Compares subterms matched by the same variable, see `subterm_equal`.
 
     Returns
     -------
@@ -143,7 +247,7 @@ def _process_match(pat, syms):
     if not len(varlist) == len(syms):
         raise RuntimeError("length of varlist doesn't match length of syms.")
     for v, s in zip(varlist, syms):
-        if v in subs and subs[v] != s:
+        if v in subs and not equal(subs[v], s):
             return None
         else:
             subs[v] = s
@@ -0,0 +1,302 @@
+from __future__ import absolute_import, division, print_function
+
+from .core import VAR, PatternSet, counting_context, subterm_equal
+from .dynamic import DynamicPatternSet
+from .static import (StaticPatternSet, Frontier, build_automata, _states,
+        _process_match)
+
+
+# Default number of states of the static automata built by
+# `HybridPatternSet` and `select_patternset`
+MAX_STATES = 10000
+
+
+class HybridPatternSet(PatternSet):
+    """A set of patterns, matched with a static automata of bounded size.
+
+    The static automata is built breadth first, up to `max_states` states.
+    Each state past the budget is replaced by a dynamic discrimination net of
+    the patterns that may still match there. Terms are matched with the
+    static prefix, and those reaching a frontier are then matched with its
+    net, from the start of the term.
+
+    Attributes
+    ----------
+    patterns : list
+        A list of `Pattern`s included in the `PatternSet`.
+    max_states : int
+        Maximum number of states in the static part of the automata.
+    build_stats : dict
+        Statistics from the construction of the automata. See
+        `build_automata` for details.
+    """
+
+    def __init__(self, context, patterns, max_states=MAX_STATES):
+        self.context = context
+        patterns = list(patterns)
+        if not all(self.context == p.context for p in patterns):
+            raise ValueError("All patterns in a PatternSet must have the same"
+                             "context")
+        self.max_states = max_states
+        # Transitions of the static states, reused when patterns change
+        self._cache = {}
+        self._rebuild(patterns)
+
+    def add(self, pat):
+        """Add a pattern to the HybridPatternSet.
+
+        Parameters
+        ----------
+        pat : Pattern
+        """
+
+        if self.context != pat.context:
+            raise ValueError("All patterns in a PatternSet must have the same"
+                             "context")
+        with self._writing():
+            self._rebuild(self.patterns + [pat])
+
+    def remove(self, pat):
+        """Remove a pattern from the HybridPatternSet.
+
+        Parameters
+        ----------
+        pat : Pattern
+        """
+
+        with self._writing():
+            patterns = list(self.patterns)
+            patterns.remove(pat)
+            self._rebuild(patterns)
+
+    def _replace(self, patterns):
+        if not all(self.context == p.context for p in patterns):
+            raise ValueError("All patterns in a PatternSet must have the same"
+                             "context")
+        # The cached transitions are numbered by pattern, start over
+        self._cache = {}
+        self._rebuild(patterns)
+
+    def _rebuild(self, patterns):
+        """Build the automata and nets for `patterns`, and publish them"""
+
+        stats = {}
+        net = build_automata(self.context, patterns, stats, self._cache,
+                             max_states=self.max_states)
+        self._finish(patterns, net, stats)
+
+    def _finish(self, patterns, net, stats):
+        """Give the frontiers of a built automata their nets, and publish
+        it"""
+
+        # Frontiers with the same patterns share a net
+        subnets = {}
+        for state in _states(net):
+            if isinstance(state, Frontier):
+                subnet = subnets.get(state.rules)
+                if subnet is None:
+                    subnet = subnets[state.rules] = DynamicPatternSet(
+                        self.context, [patterns[i] for i in state.rules])
+                state.subnet = subnet
+        self.build_stats = stats
+        self._publish(patterns, net)
+
+    def _match_iter(self, t, stats):
+        patterns, net = self._snapshot
+        net = self._match(t, stats, net)
+        if isinstance(net, Frontier):
+            for res in net.subnet._match_iter(t, stats):
+                yield res
+            return
+        inds, data = net
+        if inds:
+            equal = subterm_equal(self.context)
+        for i in inds:
+            pat = patterns[i]
+            subs = _process_match(pat, data, equal)
+            if subs is not None:
+                yield pat, subs
+            elif stats is not None:
+                stats.rejected += 1
+
+    def _match(self, t, stats, net):
+        """Run the static part of the automata, starting at `net`.
+
+        Returns the `Frontier` reached, or a tuple of the indices of the
+        matching patterns and the subterms captured at each path."""
+
+        context = self.context
+        if stats is not None:
+            context = counting_context(context, stats)
+        head = context.head
+        # With a fused `head_args`, the traversal finds the head along with
+        # the arguments it needs anyway
+        fused = context.head_args is not None
+        pot = context.traverse(t, 'tracked')
+        path_lookup = {}
+        for term in pot:
+            if isinstance(net, Frontier):
+                return net
+            if stats is not None:
+                stats.nodes += 1
+            var_val = net.get(VAR, None)
+            val = net.get(pot.current if fused else head(term), None)
+            if val is not None:
+                net = val
+                if var_val is not None:
+                    path_lookup[pot.path] = term
+                if stats is not None:
+                    stats.transitions += 1
+                    stats.captures += var_val is not None
+                continue
+            if var_val is not None:
+                net = var_val
+                path_lookup[pot.path] = term
+                pot.skip()
+                if stats is not None:
+                    stats.transitions += 1
+                    stats.captures += 1
+                continue
+            return (), {}
+        if isinstance(net, Frontier):
+            return net
+        return net, path_lookup
+
+
+def select_patternset(context, patterns, max_states=MAX_STATES,
+                      matches=10000):
+    """Choose and build the kind of pattern set best suited to `patterns`.
+
+    The cost of each kind is estimated first, without building anything, by
+    `estimate_costs`. Only the cheapest kind is built. If it's a static or
+    hybrid automata, it's built breadth first up to `max_states` states. If
+    that turns out to be the whole automata, a `StaticPatternSet` is made
+    from it, and otherwise a `HybridPatternSet`, reusing what was built.
+
+    Parameters
+    ----------
+    context : Context
+    patterns : list
+        A list of `Pattern`s.
+    max_states : int, optional
+        The budget of states for the static automata.
+    matches : int, optional
+        The expected number of terms to be matched, over which building the
+        pattern set is paid for.
+
+    Returns
+    -------
+    The pattern set. Its `decision` attribute is the kind chosen, one of
+    ``'static'``, ``'dynamic'`` or ``'hybrid'``, and its `estimates`
+    attribute the dict returned by `estimate_costs`.
+    """
+
+    patterns = list(patterns)
+    estimates = estimate_costs(context, patterns, max_states, matches)
+    costs = estimates['costs']
+    decision = min(costs, key=costs.get)
+
+    if decision == 'dynamic':
+        pset = DynamicPatternSet(context, patterns)
+    else:
+        build_stats = {}
+        cache = {}
+        net = build_automata(context, patterns, build_stats, cache,
+                             max_states=max_states)
+        if build_stats['frontier']:
+            pset = HybridPatternSet.__new__(HybridPatternSet)
+            pset.context = context
+            pset.max_states = max_states
+            pset._cache = cache
+            pset._finish(patterns, net, build_stats)
+            decision = 'hybrid'
+        else:
+            # The automata is complete
+            pset = StaticPatternSet.__new__(StaticPatternSet)
+            pset.context = context
+            pset.build_stats = build_stats
+            pset._cache = cache
+            pset._publish(patterns, net)
+            decision = 'static'
+    pset.decision = decision
+    pset.estimates = estimates
+    return pset
+
+
+def estimate_costs(context, patterns, max_states=MAX_STATES, matches=10000):
+    """Estimate the cost of each kind of pattern set, without building any.
+
+    The estimates come from a single traversal of the patterns, collecting
+    the heads and arities found at each path, and where variables are:
+
+    - A *conflict* is a path where one pattern has a variable and another a
+      head. It's a choice point of the dynamic net, which may backtrack to
+      it, and a place where the static automata splits its states.
+    - The static automata is estimated to have a state per distinct head at
+      each path, doubled for every conflict, and each state costs a pass
+      over the patterns to build. It matches in a single pass.
+    - The dynamic net is built in a pass over the patterns. A match is
+      estimated to go through each conflict on the way to a pattern once
+      more.
+    - The hybrid automata builds `max_states` states. The dynamic nets for
+      the rest, and the terms matched past them, are in proportion to the
+      states not built.
+
+    Costs are in units of work per node of a term, summed over building the
+    pattern set and `matches` matches.
+
+    Parameters
+    ----------
+    context : Context
+    patterns : list
+        A list of `Pattern`s.
+    max_states : int, optional
+        The budget of states for the static automata.
+    matches : int, optional
+        The expected number of terms to be matched.
+
+    Returns
+    -------
+    A dict of ``"size"`` (number of nodes in all patterns), ``"states"``
+    (estimated number of static states), ``"choice_points"`` (number of
+    conflicts), ``"max_choice_depth"`` (largest number of conflicts in a
+    single pattern), and ``"costs"``, a dict of the cost of each kind. The
+    static kind is only included if its states fit in `max_states`.
+    """
+
+    size = 0
+    heads = {}
+    var_paths = set()
+    pattern_paths = []
+    for pat in patterns:
+        paths = []
+        for term, path in context.traverse(pat.pat, 'path'):
+            size += 1
+            paths.append(path)
+            if term in pat.vars:
+                var_paths.add(path)
+            else:
+                key = (context.head(term), len(context.args(term)))
+                try:
+                    heads.setdefault(path, set()).add(key)
+                except TypeError:
+                    heads.setdefault(path, set()).add(id(key[0]))
+        pattern_paths.append(paths)
+
+    conflicts = var_paths.intersection(heads)
+    depth = max([sum(p in conflicts for p in paths)
+                 for paths in pattern_paths] or [0])
+    prefixes = 1 + sum(len(h) for h in heads.values())
+    # Capped, so that the doubling stays cheap to compute
+    states = prefixes * 2 ** min(len(conflicts), 64)
+    npats = max(len(patterns), 1)
+
+    costs = {'dynamic': size + matches * (1 + depth)}
+    if states <= max_states:
+        costs['static'] = states * npats + matches
+    else:
+        unbuilt = 1 - max_states / states
+        costs['hybrid'] = (max_states * npats + unbuilt * size +
+                           matches * (1 + unbuilt * depth))
+    return {'size': size, 'states': states, 'choice_points': len(conflicts),
+            'max_choice_depth': depth, 'costs': costs}
@@ -0,0 +1,170 @@
+from __future__ import absolute_import, division, print_function
+
+from .bottomup import BottomUpPatternSet, _process_match
+from .core import subterm_equal
+
+
+class _Node(object):
+    """A node of a term in a `MatchSession`, with its cached automata state,
+    and matches"""
+
+    __slots__ = ('term', 'state', 'args', 'matches')
+
+    def __init__(self, term, state, args):
+        self.term = term
+        self.state = state
+        self.args = args
+        # Found on first use, see `MatchSession.matches`
+        self.matches = None
+
+
+class MatchSession(object):
+    """Incremental matching of a term, through a series of local edits.
+
+    Every node of the term is labeled with its state in the bottom up
+    automata of a `BottomUpPatternSet`, and the labels are kept. After the
+    subterm at a path is replaced, only the new subterm and the nodes on the
+    path from it to the root are labeled again, the states of all other
+    nodes are reused. Matches found at each node are cached the same way.
+
+    Paths are tuples of argument indices, as used by `Context.index`.
+
+    Parameters
+    ----------
+    patternset : BottomUpPatternSet
+    term : term
+        The term to start from.
+    """
+
+    def __init__(self, patternset, term):
+        if not isinstance(patternset, BottomUpPatternSet):
+            raise TypeError("MatchSession requires a BottomUpPatternSet")
+        self.patternset = patternset
+        self.context = patternset.context
+        self._root = self._build(term)
+
+    @property
+    def term(self):
+        """The current term"""
+        return self._root.term
+
+    def _build(self, term):
+        """Label every node of a term, returning the root `_Node`.
+
+        A subterm appearing many times as the same object gets a single
+        `_Node`, so shared subterms are only labeled once."""
+
+        head = self.context.head
+        args = self.context.args
+        transition = self.patternset._transition
+        # Maps id(term) to its `_Node`, which keeps the term alive
+        nodes = {}
+        # Postorder, children are labeled before their parent
+        stack = [(term, None)]
+        while stack:
+            t, childs = stack.pop()
+            if childs is not None:
+                kids = [nodes[id(c)] for c in childs]
+                state = transition(head(t), tuple(k.state for k in kids))
+                nodes[id(t)] = _Node(t, state, kids)
+            elif id(t) not in nodes:
+                childs = args(t)
+                stack.append((t, childs))
+                stack.extend((c, None) for c in childs)
+        return nodes[id(term)]
+
+    def _walk(self, path):
+        """The nodes from the root to the node at `path`"""
+
+        nodes = [self._root]
+        for i in path:
+            try:
+                nodes.append(nodes[-1].args[i])
+            except IndexError:
+                raise IndexError("No subterm at path {0}".format(path))
+        return nodes
+
+    def replace(self, path, new):
+        """Replace the subterm at a path, and update the labels.
+
+        Parameters
+        ----------
+        path : tuple
+            The path index of the subterm to replace.
+        new : term
+            The subterm to put in its place.
+
+        Returns
+        -------
+        The new term.
+        """
+
+        head = self.context.head
+        rebuild = self.context.rebuild
+        transition = self.patternset._transition
+        nodes = self._walk(path)
+        node = self._build(new)
+        # Rebuild the path from the edit up, sharing all other nodes
+        for parent, i in zip(reversed(nodes[:-1]), reversed(path)):
+            kids = list(parent.args)
+            kids[i] = node
+            h = head(parent.term)
+            term = rebuild(h, [k.term for k in kids])
+            node = _Node(term, transition(h, tuple(k.state for k in kids)),
+                         kids)
+        self._root = node
+        return node.term
+
+    def subterm(self, path=()):
+        """The subterm at a path"""
+        return self._walk(path)[-1].term
+
+    def match_all(self, path=()):
+        """Find all matchings of the subterm at a path.
+
+        Parameters
+        ----------
+        path : tuple, optional
+            The path index of the subterm. Defaults to the whole term.
+
+        Returns
+        -------
+        List containing tuples of `(pat, subs)`, as `PatternSet.match_all`.
+        """
+
+        return list(self._matches(self._walk(path)[-1]))
+
+    def matches(self):
+        """Find all matchings of every subterm, as
+        `BottomUpPatternSet.match_subterms`. Only the nodes that changed since
+        the last call are matched again.
+
+        Returns
+        -------
+        List containing tuples of `(path, pat, subs)`, ordered by a preorder
+        traversal of the term.
+        """
+
+        out = []
+        stack = [(self._root, ())]
+        while stack:
+            node, path = stack.pop()
+            out.extend((path, pat, subs) for (pat, subs) in
+                       self._matches(node))
+            for i in range(len(node.args) - 1, -1, -1):
+                stack.append((node.args[i], path + (i,)))
+        return out
+
+    def _matches(self, node):
+        if node.matches is None:
+            pset = self.patternset
+            patterns = pset.patterns
+            equal = subterm_equal(self.context)
+            found = []
+            for i in pset._matches[node.state]:
+                pat = patterns[i]
+                subs = _process_match(self.context, pat, node.term, equal)
+                if subs is not None:
+                    found.append((pat, subs))
+            node.matches = tuple(found)
+        return node.matches
@@ -0,0 +1,216 @@
+from __future__ import absolute_import, division, print_function
+
+from .core import VAR, Pattern, subterm_equal
+from .dynamic import DynamicPatternSet, Node, _process_match, _unlink
+
+
+class TermIndex(object):
+    """An index of stored terms, for retrieval by matching.
+
+    The terms are stored in a discrimination net of `Node`s, like
+    `DynamicPatternSet`, with an edge per subterm in preorder. As a query may
+    have to skip a whole stored subterm, edges are keyed by both the head and
+    the number of arguments. Variables of stored terms all share the `VAR`
+    edge.
+
+    Two kinds of retrieval are supported: `instances` finds the stored terms
+    matched by a query pattern, and `generalizations` finds the stored terms
+    that match a query term.
+
+    Parameters
+    ----------
+    context : Context
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self._net = Node()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        stack = [self._net]
+        while stack:
+            node = stack.pop()
+            for entry in node.patterns:
+                yield entry.pat
+            stack.extend(node.edges.values())
+
+    def _edges(self, term, vars):
+        """The edges from the root of the net to the leaf of a term"""
+
+        context = self.context
+        head = context.head
+        return [VAR if t in vars else (head(t), n)
+                for (t, n) in context.traverse(term, 'arity')]
+
+    def _find(self, node, term, vars):
+        vars = set(vars)
+        for i, entry in enumerate(node.patterns):
+            if entry.pat == term and set(entry.vars) == vars:
+                return i
+        return None
+
+    def insert(self, term, vars=()):
+        """Add a term to the index. Terms already stored are ignored.
+
+        Parameters
+        ----------
+        term : term
+        vars : tuple, optional
+            The variables in `term`.
+        """
+
+        node = self._net
+        for t in self._edges(term, vars):
+            node = node.edges.setdefault(t, Node())
+        if self._find(node, term, vars) is None:
+            node.patterns.append(Pattern(self.context, term, vars))
+            self._size += 1
+
+    def delete(self, term, vars=()):
+        """Remove a term from the index.
+
+        Branches of the net that no longer lead to any term are pruned.
+        Raises a `KeyError` if the term isn't stored.
+
+        Parameters
+        ----------
+        term : term
+        vars : tuple, optional
+            The variables in `term`, as given to `insert`.
+        """
+
+        edges = self._edges(term, vars)
+        nodes = [self._net]
+        for t in edges:
+            try:
+                nodes.append(nodes[-1].edges[t])
+            except (KeyError, TypeError):
+                raise KeyError(term)
+        leaf = nodes[-1]
+        i = self._find(leaf, term, vars)
+        if i is None:
+            raise KeyError(term)
+        del leaf.patterns[i]
+        self._size -= 1
+        # Prune empty branches, from the leaf up
+        for node, t in zip(reversed(nodes[:-1]), reversed(edges)):
+            child = node.edges[t]
+            if child.edges or child.patterns:
+                break
+            del node.edges[t]
+
+    def instances(self, pattern, vars=()):
+        """Find all stored terms that are instances of a pattern.
+
+        A stored variable is only an instance of a variable of the pattern.
+
+        Parameters
+        ----------
+        pattern : term
+        vars : tuple, optional
+            The variables in `pattern`.
+
+        Returns
+        -------
+        A list of the stored terms.
+        """
+
+        edges = self._edges(pattern, vars)
+        found = []
+        stack = [(0, self._net)]
+        while stack:
+            i, node = stack.pop()
+            if i == len(edges):
+                found.extend(e.pat for e in node.patterns)
+                continue
+            t = edges[i]
+            if t is VAR:
+                # Any stored subterm is an instance of a variable
+                stack.extend((i + 1, n) for n in _skip(node))
+                continue
+            try:
+                node = node.edges.get(t)
+            except TypeError:
+                continue
+            if node is not None:
+                stack.append((i + 1, node))
+
+        pat = Pattern(self.context, pattern, vars)
+        if found and len(set(pat._varlist)) < len(pat._varlist):
+            # The net doesn't tell apart the subterms skipped for each
+            # variable. Check those of nonlinear variables are equal.
+            pset = DynamicPatternSet(self.context, [pat])
+            found = [t for t in found if pset.match_one(t)[0] is not None]
+        return found
+
+    def generalizations(self, term):
+        """Find all stored terms that match a term.
+
+        A stored variable matches any subterm.
+
+        Parameters
+        ----------
+        term : term
+
+        Returns
+        -------
+        A list of tuples of `(stored, subs)`, where `stored` is a stored term,
+        and `subs` is a dict mapping its variables to the subterms of `term`
+        they match.
+        """
+
+        # Not at the top, as `pinyon.term.flat` imports this package
+        from ..term.flat import _find_ends
+
+        context = self.context
+        head = context.head
+        nodes, keys, arities = [], [], []
+        for t, n in context.traverse(term, 'arity'):
+            nodes.append(t)
+            keys.append((head(t), n))
+            arities.append(n)
+        ends = _find_ends(arities)
+
+        equal = subterm_equal(context)
+        found = []
+        # Captured subterms are a linked list of `(term, rest)` cells, newest
+        # first, shared between branches
+        stack = [(0, self._net, None)]
+        while stack:
+            i, node, captured = stack.pop()
+            if i == len(nodes):
+                if node.patterns:
+                    syms = _unlink(captured)
+                    for entry in node.patterns:
+                        subs = _process_match(entry, syms, equal)
+                        if subs is not None:
+                            found.append((entry.pat, subs))
+                continue
+            var = node.edges.get(VAR)
+            if var is not None:
+                stack.append((ends[i], var, (nodes[i], captured)))
+            try:
+                child = node.edges.get(keys[i])
+            except TypeError:
+                continue
+            if child is not None:
+                stack.append((i + 1, child, captured))
+        return found
+
+
+def _skip(node):
+    """Find the nodes reached by skipping one stored subterm from `node`"""
+
+    stack = [(node, 1)]
+    while stack:
+        node, todo = stack.pop()
+        if not todo:
+            yield node
+            continue
+        for t, child in node.edges.items():
+            stack.append((child, todo - 1 + (0 if t is VAR else t[1])))
+
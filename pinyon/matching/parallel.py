@@ -0,0 +1,124 @@
+from __future__ import absolute_import, division, print_function
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+
+
+class ParallelMatcher(object):
+    """Match large batches of terms against a pattern set in parallel.
+
+    The pattern set is sent to each worker process once, when the pool
+    starts, so later changes to it aren't seen by the matcher. Terms are
+    then streamed to the workers in chunks, which are
+    matched with `PatternSet.match_many`. Only `pending` chunks are sent
+    ahead of the results being consumed, so memory use is bounded however
+    many terms are matched.
+
+    The pattern set, its patterns and context, as well as the terms and
+    their matches, must be picklable.
+
+    Parameters
+    ----------
+    pset : PatternSet
+    processes : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+    chunksize : int, optional
+        Number of terms sent to a worker at a time.
+    pending : int, optional
+        Largest number of chunks sent to the workers and not yet consumed.
+        Defaults to twice the number of processes.
+    """
+
+    def __init__(self, pset, processes=None, chunksize=1000, pending=None):
+        if chunksize < 1:
+            raise ValueError("chunksize must be at least 1")
+        if pending is None:
+            pending = 2 * (processes or cpu_count())
+        if pending < 1:
+            raise ValueError("pending must be at least 1")
+        self.patternset = pset
+        self.chunksize = chunksize
+        self.pending = pending
+        # The patterns the workers got, which their indices refer to
+        self._patterns = list(pset.patterns)
+        self._pool = Pool(processes, _init_worker, (pset,))
+
+    def imatch(self, terms):
+        """Lazily find all matchings for every term in an iterable of terms.
+
+        Yields a list of `(pat, subs)` for each term, in the same order as
+        the input terms."""
+
+        patterns = self._patterns
+        pending = deque()
+        for chunk in _chunks(terms, self.chunksize):
+            pending.append(self._pool.apply_async(_match_chunk, (chunk,)))
+            if len(pending) < self.pending:
+                continue
+            for matches in pending.popleft().get():
+                yield [(patterns[i], subs) for (i, subs) in matches]
+        while pending:
+            for matches in pending.popleft().get():
+                yield [(patterns[i], subs) for (i, subs) in matches]
+
+    def match_many(self, terms):
+        """Find all matchings for every term in an iterable of terms.
+
+        Returns a list containing a list of `(pat, subs)` for each term, in
+        the same order as the input terms."""
+
+        return list(self.imatch(terms))
+
+    def close(self):
+        """Shut down the worker processes"""
+
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _chunks(iterable, n):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+# State of each worker process, set once by `_init_worker`
+_worker_pset = None
+_worker_index = None
+
+
+def _init_worker(pset):
+    global _worker_pset, _worker_index
+    _worker_pset = pset
+    # Maps the id of each pattern to its positions, as the same pattern may
+    # be in the pattern set more than once
+    _worker_index = {}
+    for i, p in enumerate(pset.patterns):
+        _worker_index.setdefault(id(p), []).append(i)
+
+
+def _match_chunk(terms):
+    """Match a chunk of terms, returning `(pattern index, subs)` for each
+    match, as patterns are copies in the workers."""
+
+    out = []
+    for matches in _worker_pset.match_many(terms):
+        # Repeats of a pattern in a term's matches are its next positions
+        seen = {}
+        found = []
+        for pat, subs in matches:
+            inds = _worker_index[id(pat)]
+            k = seen.get(id(pat), 0)
+            seen[id(pat)] = k + 1
+            found.append((inds[min(k, len(inds) - 1)], subs))
+        out.append(found)
+    return out
@@ -1,6 +1,13 @@
 from __future__ import absolute_import, division, print_function
-
-from .core import VAR, PatternSet
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+from timeit import default_timer
+
+from .core import (VAR, Pattern, PatternSet, counting_context,
+        subterm_equal)
 from ..util import copy_doc
 
 
@@ -14,57 +21,496 @@ class StaticPatternSet(PatternSet):
     ----------
     patterns : list
         A list of `Pattern`s included in the `PatternSet`.
+    build_stats : dict
+        Statistics from the construction of the automata. See
+        `build_automata` for details.
     """
 
     def __init__(self, context, patterns):
         self.context = context
-        self.patterns = patterns
+        patterns = list(patterns)
         if not all(self.context == p.context for p in patterns):
             raise ValueError("All patterns in a PatternSet must have the same"
                              "context")
-        self._net = build_automata(self.context, self.patterns)
+        self._cache = {}
+        self._rebuild(patterns)
+
+    def add(self, pat):
+        """Add a pattern to the StaticPatternSet.
+
+        Only the states of the automata that are affected by the new pattern
+        are computed, the rest are reused from the existing automata.
+
+        Parameters
+        ----------
+        pat : Pattern
+        """
+
+        if self.context != pat.context:
+            raise ValueError("All patterns in a PatternSet must have the same"
+                             "context")
+        with self._writing():
+            self._rebuild(self.patterns + [pat])
 
-    @copy_doc(PatternSet.match_iter)
-    def match_iter(self, t):
-        inds, data = self._match(t)
+    def remove(self, pat):
+        """Remove a pattern from the StaticPatternSet.
+
+        Only the states of the automata that contained the removed pattern
+        are dropped, the rest are reused from the existing automata.
+
+        Parameters
+        ----------
+        pat : Pattern
+        """
+
+        with self._writing():
+            patterns = list(self.patterns)
+            ind = patterns.index(pat)
+            del patterns[ind]
+            self._cache = renumber_cache(self._cache, ind)
+            self._rebuild(patterns)
+
+    def _replace(self, patterns):
+        if not all(self.context == p.context for p in patterns):
+            raise ValueError("All patterns in a PatternSet must have the same"
+                             "context")
+        # The cached transitions are numbered by pattern, start over
+        self._cache = {}
+        self._rebuild(patterns)
+
+    def _rebuild(self, patterns):
+        """Build the automata for `patterns`, and publish it"""
+
+        stats = {}
+        net = build_automata(self.context, patterns, stats, self._cache)
+        self.build_stats = stats
+        self._publish(patterns, net)
+
+    def save(self, filename):
+        """Save the automata and the patterns to a file.
+
+        The file can be loaded with `StaticPatternSet.load`. Patterns and the
+        context must be picklable.
+
+        Parameters
+        ----------
+        filename : str
+        """
+
+        patterns, net = self._snapshot[:2]
+        data = {'version': CACHE_VERSION,
+                'fingerprint': fingerprint(self.context, patterns),
+                'patterns': [(p.pat, p.vars, p._path_lookup, p._varlist)
+                             for p in patterns],
+                'build_stats': self.build_stats,
+                'net': net}
+        # Write to a temporary file first, so that readers never see a
+        # partially written file.
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            getattr(os, 'replace', os.rename)(temp, filename)
+        except:
+            os.remove(temp)
+            raise
+
+    @classmethod
+    def load(cls, filename, context, patterns=None):
+        """Load a StaticPatternSet saved with `StaticPatternSet.save`.
+
+        The automata isn't built again. Note that the transition cache used by
+        `add` and `remove` isn't saved, so the first update after loading
+        builds the whole automata.
+
+        Parameters
+        ----------
+        filename : str
+        context : Context
+        patterns : list, optional
+            The `Pattern`s the file was saved from. If provided, they're used
+            instead of the patterns stored in the file, after checking that
+            their fingerprint matches. Otherwise the stored patterns are
+            loaded, without recomputing their metadata.
+        """
+
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        if data.get('version') != CACHE_VERSION:
+            raise ValueError("Unsupported pattern set file version")
+        if patterns is None:
+            patterns = [_load_pattern(context, *p) for p in data['patterns']]
+        elif fingerprint(context, patterns) != data['fingerprint']:
+            raise ValueError("Patterns don't match the saved pattern set")
+        pset = cls.__new__(cls)
+        pset.context = context
+        pset.build_stats = dict(data['build_stats'], loaded=filename)
+        pset._cache = {}
+        pset._publish(list(patterns), data['net'])
+        return pset
+
+    def _match_iter(self, t, stats):
+        snapshot = self._snapshot
+        inds, data = self._match(t, stats, snapshot)
+        if inds:
+            equal = subterm_equal(self.context)
+        patterns = snapshot[0]
         for i in inds:
-            pat = self.patterns[i]
-            subs = _process_match(pat, data)
+            pat = patterns[i]
+            subs = _process_match(pat, data, equal)
             if subs is not None:
                 yield pat, subs
-
-    def _match(self, t):
+            elif stats is not None:
+                stats.rejected += 1
+
+    @copy_doc(PatternSet.match_many)
+    def match_many(self, terms):
+        if self._instrumented:
+            # Subterms are walked without counting, match each term instead
+            return PatternSet.match_many(self, terms)
+        memo = {}
+        out = []
+        patterns, net = self._snapshot[:2]
+        # Shared by all terms, as are their subterms through `memo`
+        equal = subterm_equal(self.context)
+        for t in terms:
+            res = self._walk(net, t, memo)
+            matches = []
+            if res is not None and isinstance(res[0], tuple):
+                inds, captures = res
+                data = dict(captures)
+                for i in inds:
+                    pat = patterns[i]
+                    subs = _process_match(pat, data, equal)
+                    if subs is not None:
+                        matches.append((pat, subs))
+            out.append(matches)
+        return out
+
+    def _walk(self, net, term, memo):
+        """Run the automata over a single subterm, starting in state `net`.
+
+        Returns a tuple of the state after the subterm, and a list of `(path,
+        subterm)` captured from it (with paths relative to `term`), or `None`
+        if matching fails. Results are memoized on the identity of the state
+        and the subterm, so repeated subterms are only walked once per
+        state."""
+
+        head_args = self.context.head_args
+        if head_args is not None:
+            h, args = head_args(term)
+        else:
+            args = self.context.args(term)
+        if args:
+            key = (id(net), id(term))
+            hit = memo.get(key)
+            if hit is not None and hit[0] is term:
+                return hit[1]
+        if head_args is None:
+            h = self.context.head(term)
+        var_val = net.get(VAR, None)
+        val = net.get(h, None)
+        if val is None:
+            # Leaves and variable captures are cheap, and aren't memoized
+            return None if var_val is None else (var_val, [((), term)])
+        captures = [((), term)] if var_val is not None else []
+        if not args:
+            return val, captures
+        for i, arg in enumerate(args):
+            # Reaching a leaf before the end of the term is a failed match
+            res = self._walk(val, arg, memo) if isinstance(val, dict) else None
+            if res is None:
+                break
+            val = res[0]
+            for p, t in res[1]:
+                captures.append(((i,) + p, t))
+        else:
+            res = (val, captures)
+        # Also store the term, to keep it alive while its id is a key
+        memo[key] = (term, res)
+        return res
+
+    def _match(self, t, stats=None, snapshot=None):
         """Performs the actual matching operation"""
 
-        net = self._net
-        head = self.context.head
-        pot = self.context.traverse(t, 'path')
+        net = (snapshot or self._snapshot)[1]
+        context = self.context
+        if stats is not None:
+            context = counting_context(context, stats)
+        head = context.head
+        # With a fused `head_args`, the traversal finds the head along with
+        # the arguments it needs anyway
+        fused = context.head_args is not None
+        pot = context.traverse(t, 'tracked')
         path_lookup = {}
-        for term, ind in pot:
+        for term in pot:
+            if stats is not None:
+                stats.nodes += 1
             var_val = net.get(VAR, None)
-            val = net.get(head(term), None)
+            val = net.get(pot.current if fused else head(term), None)
             if val is not None:
                 net = val
                 if var_val is not None:
-                    path_lookup[ind] = term
+                    path_lookup[pot.path] = term
+                if stats is not None:
+                    stats.transitions += 1
+                    stats.captures += var_val is not None
                 continue
             if var_val is not None:
                 net = var_val
+                path_lookup[pot.path] = term
                 pot.skip()
-                path_lookup[ind] = term
+                if stats is not None:
+                    stats.transitions += 1
+                    stats.captures += 1
                 continue
             return [], {}
         return net, path_lookup
 
 
-def _process_match(pat, cache):
+class LazyPatternSet(StaticPatternSet):
+    """A set of patterns, matched with a lazily constructed automata.
+
+    Behaves the same as `StaticPatternSet`, except that the transitions out of
+    each state of the automata are only computed the first time a match
+    reaches that state. Construction is nearly free, and the cost of building
+    the automata is proportional to the terms actually matched, instead of the
+    worst case of the pattern set.
+
+    Attributes
+    ----------
+    patterns : list
+        A list of `Pattern`s included in the `PatternSet`.
+    build_stats : dict
+        Statistics on the parts of the automata built so far.
+    """
+
+    def __init__(self, context, patterns):
+        self.context = context
+        patterns = list(patterns)
+        if not all(self.context == p.context for p in patterns):
+            raise ValueError("All patterns in a PatternSet must have the same"
+                             "context")
+        self._reset(patterns)
+
+    def _replace(self, patterns):
+        if not all(self.context == p.context for p in patterns):
+            raise ValueError("All patterns in a PatternSet must have the same"
+                             "context")
+        self._reset(patterns)
+
+    def _reset(self, patterns):
+        # Hash index of known states, mapping `MSet.key` to the state. States
+        # are added by matches, so each snapshot has its own.
+        states = {}
+        net = self._state(states, initial_mset(self.context, patterns))
+        self._publish(patterns, net, states)
+
+    def add(self, pat):
+        """Add a pattern to the LazyPatternSet.
+
+        As states are built on demand, this discards the existing states
+        instead of patching them.
+
+        Parameters
+        ----------
+        pat : Pattern
+        """
+
+        if self.context != pat.context:
+            raise ValueError("All patterns in a PatternSet must have the same"
+                             "context")
+        with self._writing():
+            self._reset(self.patterns + [pat])
+
+    def remove(self, pat):
+        """Remove a pattern from the LazyPatternSet.
+
+        Parameters
+        ----------
+        pat : Pattern
+        """
+
+        with self._writing():
+            patterns = list(self.patterns)
+            patterns.remove(pat)
+            self._reset(patterns)
+
+    match_many = PatternSet.match_many
+
+    @property
+    def build_stats(self):
+        states = list(self._snapshot[2].values())
+        expanded = [s for s in states if isinstance(s, LazyState) and
+                    s.transitions is not None]
+        return {'states': len(states),
+                'expanded': len(expanded),
+                'transitions': sum(len(s.transitions) for s in expanded)}
+
+    def _state(self, states, mset):
+        """Get the state for a matching set from `states`, creating it if
+        needed"""
+
+        key = mset.key
+        state = states.get(key)
+        if state is None:
+            if next_terms(mset):
+                state = LazyState(mset)
+            else:
+                state = tuple(sorted(set(m.rule for m in mset.items)))
+            # Concurrent matches may race to add the same state, only one
+            # is kept
+            state = states.setdefault(key, state)
+        return state
+
+    def _expand(self, states, state):
+        """Compute and cache the transitions out of a state"""
+
+        transitions = {}
+        mset = state.mset
+        for t in next_terms(mset):
+            new = delta(self.context, mset, t)
+            if new:
+                transitions[t[0]] = self._state(states, new)
+        # Published whole, concurrent matches compute the same transitions
+        state.transitions = transitions
+        return transitions
+
+    def _match(self, t, stats=None, snapshot=None):
+        """Performs the actual matching operation"""
+
+        patterns, state, states = snapshot or self._snapshot
+        context = self.context
+        if stats is not None:
+            context = counting_context(context, stats)
+        head = context.head
+        # With a fused `head_args`, the traversal finds the head along with
+        # the arguments it needs anyway
+        fused = context.head_args is not None
+        pot = context.traverse(t, 'tracked')
+        path_lookup = {}
+        for term in pot:
+            if stats is not None:
+                stats.nodes += 1
+            if isinstance(state, tuple):
+                # Reached a leaf before the end of the term
+                return [], {}
+            net = state.transitions
+            if net is None:
+                net = self._expand(states, state)
+            var_val = net.get(VAR, None)
+            val = net.get(pot.current if fused else head(term), None)
+            if val is not None:
+                state = val
+                if var_val is not None:
+                    path_lookup[pot.path] = term
+                if stats is not None:
+                    stats.transitions += 1
+                    stats.captures += var_val is not None
+                continue
+            if var_val is not None:
+                state = var_val
+                path_lookup[pot.path] = term
+                pot.skip()
+                if stats is not None:
+                    stats.transitions += 1
+                    stats.captures += 1
+                continue
+            return [], {}
+        if not isinstance(state, tuple):
+            # Reached the end of the term before a leaf
+            return [], {}
+        return state, path_lookup
+
+
+class LazyState(object):
+    """A state in a lazily constructed automata.
+
+    `transitions` is `None` until the state is first reached, after which it
+    is a dictionary mapping heads to the next state."""
+
+    __slots__ = ('mset', 'transitions')
+
+    def __init__(self, mset):
+        self.mset = mset
+        self.transitions = None
+
+
+# Version of the format written by `StaticPatternSet.save`
+CACHE_VERSION = 1
+
+
+def fingerprint(context, patterns):
+    """A stable fingerprint of a set of patterns.
+
+    Two sets of patterns with the same fingerprint build the same automata.
+    Raises an error if the patterns or the context can't be pickled."""
+
+    # Variables may be given as a set, which pickles in hash order, so they
+    # are sorted first
+    data = (CACHE_VERSION, context.head, context.args,
+            [(flatten_with_arity(context, p), _sorted_vars(p.vars),
+              p._varlist) for p in patterns])
+    return hashlib.sha1(pickle.dumps(data, 2)).hexdigest()
+
+
+def _sorted_vars(vars):
+    try:
+        return tuple(sorted(vars))
+    except TypeError:
+        # Variables of types that can't be compared
+        return tuple(sorted(vars, key=repr))
+
+
+def cached_patternset(context, patterns, cache_dir):
+    """Create a StaticPatternSet, reusing a saved automata from `cache_dir`.
+
+    The automata is saved in `cache_dir` under the fingerprint of the
+    patterns, and loaded from there instead of being built when the
+    fingerprint matches. If the patterns can't be fingerprinted, the automata
+    is built without caching."""
+
+    try:
+        fp = fingerprint(context, patterns)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return StaticPatternSet(context, patterns)
+    filename = os.path.join(cache_dir, fp + '.pinyon')
+    if os.path.exists(filename):
+        try:
+            return StaticPatternSet.load(filename, context, patterns)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            # Corrupt or out of date, rebuild it
+            pass
+    pset = StaticPatternSet(context, patterns)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    pset.save(filename)
+    return pset
+
+
+def _load_pattern(context, pat, vars, path_lookup, varlist):
+    """Recreate a `Pattern` from saved metadata, without rebuilding it"""
+
+    p = Pattern.__new__(Pattern)
+    p.context = context
+    p.pat = pat
+    p.vars = vars
+    p._path_lookup = path_lookup
+    p._varlist = varlist
+    return p
+
+
+def _process_match(pat, cache, equal):
+    """Find the substitution for a match of `pat`, from the subterms captured
+    at each path in `cache`. Nonlinear variables are checked with `equal`,
+    see `subterm_equal`. Returns `None` if the match is invalid."""
+
     path_lookup = pat._path_lookup
     subs = {}
     for var, paths in path_lookup.items():
         subs[var] = first = cache[paths[0]]
         for p in paths[1:]:
-            new = cache[p]
-            if new != first:
+            if not equal(cache[p], first):
                 return None
     return subs
 
@@ -81,6 +527,9 @@ class MSet(tuple):
     def __new__(cls, items):
         return tuple.__new__(cls, (items,))
 
+    def __getnewargs__(self):
+        return tuple(self)
+
     def __str__(self):
         data = ",\n".join(str(i) for i in self.items)
         return "MSet([\n{0}])".format(data)
@@ -89,6 +538,14 @@ class MSet(tuple):
     def items(self):
         return self[0]
 
+    @property
+    def key(self):
+        """A canonical, hashable form of the matching set.
+
+        Two matching sets are equivalent if and only if their keys are
+        equal."""
+        return frozenset(self.items)
+
     def is_equivalent(self, other):
         """Determines if two matching sets are equivalent"""
 
@@ -114,7 +571,10 @@ class MItem(tuple):
     """Represents a single item in a matching set."""
 
     def __new__(cls, suffix, rule):
-        return tuple.__new__(cls, (suffix, rule))
+        return tuple.__new__(cls, (tuple(suffix), rule))
+
+    def __getnewargs__(self):
+        return tuple(self)
 
     @property
     def suffix(self):
@@ -161,37 +621,110 @@ def delta(context, M, s):
             func, arity = con_pat.suffix[0]
             if func is VAR:
                 continue
-            suffix = [(func, arity)] + [(VAR, 0)]*arity + var_pat.suffix[1:]
+            suffix = ((func, arity),) + ((VAR, 0),)*arity + var_pat.suffix[1:]
             new = MItem(suffix, var_pat.rule)
             set2.append(new)
-    return MSet(set1 + set2)
+    # Drop duplicate items, as they don't change the matching set
+    items = []
+    seen = set()
+    for i in set1 + set2:
+        if i not in seen:
+            seen.add(i)
+            items.append(i)
+    return MSet(items)
 
 
-def build_automata(context, patterns):
-    """Construct the deterministic automata"""
+def initial_mset(context, patterns):
+    """The matching set for the start state of the automata"""
 
     temp = (flatten_with_arity(context, p) for p in patterns)
-    L = [MSet([MItem(p, i) for (i, p) in enumerate(temp)])]
+    return MSet([MItem(p, i) for (i, p) in enumerate(temp)])
+
+
+def build_automata(context, patterns, stats=None, cache=None, minimize=False,
+                   max_states=None):
+    """Construct the deterministic automata
+
+    Parameters
+    ----------
+    context : Context
+    patterns : list
+        A list of `Pattern`s to build the automata from.
+    stats : dict, optional
+        If provided, is updated with statistics about the construction:
+        ``"states"`` (number of states), ``"transitions"`` (number of
+        transitions), ``"computed"`` (number of states whose transitions
+        weren't found in `cache`), and ``"seconds"`` (time taken). If
+        minimizing, also ``"minimized_states"``, the approximate size in bytes
+        of the states before and after minimization, ``"bytes"`` and
+        ``"minimized_bytes"``.
+    cache : dict, optional
+        A cache of the transitions out of each state, mapping `MSet.key` to a
+        list of ``((head, arity), key, MSet)`` for each next state. States
+        found in the cache aren't recomputed, and new states are added to it.
+        After construction the cache only contains states in the automata.
+    minimize : bool, optional
+        Whether to merge equivalent states with `minimize_automata`, and
+        compact `cache` with `compact_cache`. Default is False, as automata
+        of generated patterns rarely have equivalent states, and pattern sets
+        rebuild theirs on every `add` and `remove`.
+    max_states : int, optional
+        If provided, only the first `max_states` states found (breadth first)
+        are expanded. States found after that are left as `Frontier`s, and
+        their number is added to `stats` as ``"frontier"``. By default the
+        whole automata is built.
+    """
+
+    start = default_timer()
+    L = [initial_mset(context, patterns)]
+    keys = [L[0].key]
+    # Hash index of known states, mapping `MSet.key` to the state index
+    index = {keys[0]: 0}
     paths = [{}]
+    computed = 0
+    expanded = None
 
     for ind, mset in enumerate(L):
-        for t in next_terms(mset):
-            new = delta(context, mset, t)
-            if new:
-                for new_ind, match_set in enumerate(L):
-                    if match_set.is_equivalent(new):
-                        break
-                else:
-                    L.append(new)
-                    paths.append({})
-                    new_ind = len(L) - 1
-                # TODO: setting for varargs to include (sym, arity) as key?
-                paths[ind][t[0]] = new_ind
-
-    # Replace leaf dicts with sets of the matching patterns
+        if max_states is not None and ind >= max_states:
+            expanded = ind
+            break
+        trans = cache.get(keys[ind]) if cache is not None else None
+        if trans is None:
+            trans = []
+            for t in next_terms(mset):
+                new = delta(context, mset, t)
+                if new:
+                    trans.append((t, new.key, new))
+            computed += 1
+            if cache is not None:
+                cache[keys[ind]] = trans
+        for t, key, new in trans:
+            new_ind = index.get(key)
+            if new_ind is None:
+                L.append(new)
+                keys.append(key)
+                paths.append({})
+                new_ind = index[key] = len(L) - 1
+            # TODO: setting for varargs to include (sym, arity) as key?
+            paths[ind][t[0]] = new_ind
+
+    if cache is not None:
+        for key in set(cache).difference(index):
+            del cache[key]
+
+    transitions = sum(len(lk) for lk in paths)
+
+    # Replace leaf dicts with sets of the matching patterns, and states that
+    # weren't expanded with frontiers
+    frontier = 0
     for i, lk in enumerate(paths):
         if lk == {}:
-            paths[i] = tuple(sorted(set(m.rule for m in L[i].items)))
+            rules = tuple(sorted(set(m.rule for m in L[i].items)))
+            if expanded is not None and i >= expanded and next_terms(L[i]):
+                paths[i] = Frontier(rules)
+                frontier += 1
+            else:
+                paths[i] = rules
 
     # Finalize the automata
     for lk in paths:
@@ -199,4 +732,157 @@ def build_automata(context, patterns):
             for k, v in lk.items():
                 lk[k] = paths[v]
 
-    return paths[0]
+    net = paths[0]
+    if minimize:
+        before = automata_size(net)
+        net = minimize_automata(net)
+        if cache is not None:
+            compact_cache(cache)
+        if stats is not None:
+            stats.update(minimized_states=sum(1 for s in _states(net)),
+                         bytes=before, minimized_bytes=automata_size(net))
+
+    if stats is not None:
+        stats.update(states=len(L), transitions=transitions,
+                     computed=computed, seconds=default_timer() - start)
+        if max_states is not None:
+            stats['frontier'] = frontier
+    return net
+
+
+class Frontier(object):
+    """A state of an automata built with a state budget, that wasn't
+    expanded.
+
+    `rules` is a tuple of the indices of the patterns that may still match
+    from this state. `subnet` is free for the matcher to use, see
+    `HybridPatternSet`."""
+
+    __slots__ = ('rules', 'subnet')
+
+    def __init__(self, rules, subnet=None):
+        self.rules = rules
+        self.subnet = subnet
+
+    def __getstate__(self):
+        return (self.rules, self.subnet)
+
+    def __setstate__(self, state):
+        self.rules, self.subnet = state
+
+
+def _states(net):
+    """Iterate over the distinct states of an automata"""
+
+    seen = set([id(net)])
+    stack = [net]
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, dict):
+            for sub in node.values():
+                if id(sub) not in seen:
+                    seen.add(id(sub))
+                    stack.append(sub)
+
+
+def automata_size(net):
+    """Approximate size in bytes of the states of an automata.
+
+    Only the dicts and tuples making up the states are counted, not the
+    heads and pattern indices they contain."""
+
+    return sum(sys.getsizeof(s) for s in _states(net))
+
+
+def minimize_automata(net):
+    """Merge equivalent states of an automata.
+
+    Two states are equivalent if they're final states matching the same
+    patterns, or if they have transitions on the same heads to equivalent
+    states. The automata is a DAG, so states are merged bottom up, sharing a
+    single dict or tuple for each class of equivalent states. Returns the new
+    start state, the given automata is unchanged."""
+
+    # Canonical state for each original state, by identity. The originals
+    # are alive for the duration, so their ids are stable.
+    canon = {}
+    # Canonical state for each signature of a state
+    unique = {}
+    stack = [(net, False)]
+    while stack:
+        node, ready = stack.pop()
+        if id(node) in canon:
+            continue
+        if not isinstance(node, dict):
+            canon[id(node)] = unique.setdefault(node, node)
+        elif not ready:
+            stack.append((node, True))
+            stack.extend((sub, False) for sub in node.values()
+                         if id(sub) not in canon)
+        else:
+            new = dict((k, canon[id(v)]) for (k, v) in node.items())
+            sig = frozenset((k, id(v)) for (k, v) in new.items())
+            canon[id(node)] = unique.setdefault(sig, new)
+    return canon[id(net)]
+
+
+def compact_cache(cache):
+    """Share equal objects between the entries of a transition cache.
+
+    Each state is found in the cache once as a key, and again as the target
+    of every transition into it, and the same `MItem`s and suffixes appear in
+    many states. After compaction there's a single key, `MSet`, `MItem`, and
+    suffix object for each distinct value. Updates `cache` in place."""
+
+    suffixes = {}
+    items = {}
+    keys = {}
+    msets = {}
+
+    def item(i):
+        new = items.get(i)
+        if new is None:
+            suffix = suffixes.setdefault(i.suffix, i.suffix)
+            new = items[i] = i if suffix is i.suffix else MItem(suffix, i.rule)
+        return new
+
+    def key(k):
+        new = keys.get(k)
+        if new is None:
+            new = keys[k] = frozenset([item(i) for i in k])
+        return new
+
+    def mset(k, m):
+        new = msets.get(k)
+        if new is None:
+            new = msets[k] = MSet([item(i) for i in m.items])
+        return new
+
+    for k in list(cache):
+        trans = cache.pop(k)
+        trans[:] = [(t, key(k2), mset(key(k2), m)) for (t, k2, m) in trans]
+        cache[key(k)] = trans
+
+
+def renumber_cache(cache, rule):
+    """Update a transition cache after removing the pattern at index `rule`.
+
+    States containing `rule` are dropped, and rules after it are shifted down
+    by one. Returns a new cache."""
+
+    def renumber_key(key):
+        return frozenset(MItem(i.suffix, i.rule - 1) if i.rule > rule else i
+                         for i in key)
+
+    def renumber_mset(mset):
+        return MSet([MItem(i.suffix, i.rule - 1) if i.rule > rule else i
+                     for i in mset.items])
+
+    new = {}
+    for key, trans in cache.items():
+        if any(i.rule == rule for i in key):
+            continue
+        new[renumber_key(key)] = [(t, renumber_key(k), renumber_mset(m))
+                                  for (t, k, m) in trans]
+    return new
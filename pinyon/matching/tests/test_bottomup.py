@@ -0,0 +1,71 @@
+from pinyon.matching import Pattern, BottomUpPatternSet
+from pinyon.term.sexpr import sexpr_context
+
+
+def inc(x):
+    return x + 1
+
+
+def add(x, y):
+    return x + y
+
+
+def double(x):
+    return x * 2
+
+
+a, b, c = vars = tuple("abc")
+p1 = Pattern(sexpr_context, (add, a, 1), vars)
+p2 = Pattern(sexpr_context, (add, (inc, a), (inc, a)), vars)
+p3 = Pattern(sexpr_context, (add, (inc, b), (inc, a)), vars)
+p4 = Pattern(sexpr_context, (add, a, a), vars)
+p5 = Pattern(sexpr_context, (sum, [c, b, a]), vars)
+p6 = Pattern(sexpr_context, (list, a), vars)
+p7 = Pattern(sexpr_context, (inc, a), vars)
+
+patterns = [p1, p2, p3, p4, p5, p6]
+pset = BottomUpPatternSet(sexpr_context, patterns)
+
+
+def test_match_all():
+    assert pset.match_all((add, 2, 1)) == [(p1, {'a': 2})]
+    assert pset.match_all((add, 1, 1)) == [(p1, {'a': 1}), (p4, {'a': 1})]
+    assert pset.match_all((add, (inc, 1), (inc, 1))) == [
+        (p2, {'a': 1}), (p3, {'a': 1, 'b': 1}), (p4, {'a': (inc, 1)})]
+    assert pset.match_all((add, [1], [1])) == [(p4, {'a': [1]})]
+    assert pset.match_all((sum, [1, 2, 3])) == [
+        (p5, {'a': 3, 'b': 2, 'c': 1})]
+    assert pset.match_all((add, 2, 3)) == []
+    assert pset.match_all((add, 2, 3, 4)) == []
+    assert pset.match_one((inc, 1)) == (None, None)
+
+
+def test_match_subterms():
+    ps = BottomUpPatternSet(sexpr_context, patterns + [p7])
+    term = (double, (add, (inc, 1), (inc, (add, 2, 1))))
+    assert ps.match_subterms(term) == [
+        ((0,), p3, {'a': (add, 2, 1), 'b': 1}),
+        ((0, 0), p7, {'a': 1}),
+        ((0, 1), p7, {'a': (add, 2, 1)}),
+        ((0, 1, 0), p1, {'a': 2})]
+    # Every subterm matches a lone variable
+    ps = BottomUpPatternSet(sexpr_context, [Pattern(sexpr_context, a, vars)])
+    assert [m[0] for m in ps.match_subterms(term)] == [
+        (), (0,), (0, 0), (0, 0, 0), (0, 1), (0, 1, 0), (0, 1, 0, 0),
+        (0, 1, 0, 1)]
+
+
+def test_transitions_are_cached():
+    ps = BottomUpPatternSet(sexpr_context, patterns)
+    ps.match_all((add, (inc, 1), (inc, 1)))
+    ndelta = len(ps._delta)
+    ps.match_all((add, (inc, 1), (inc, 1)))
+    assert len(ps._delta) == ndelta
+
+
+def test_deep_term():
+    term = 1
+    for i in range(2000):
+        term = (inc, term)
+    ps = BottomUpPatternSet(sexpr_context, [p7])
+    assert len(ps.match_subterms(term)) == 2000
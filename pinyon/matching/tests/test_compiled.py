@@ -0,0 +1,64 @@
+from pinyon.matching import Pattern, CompiledPatternSet
+from pinyon.matching import compiled
+from pinyon.term.sexpr import sexpr_context
+
+from pinyon.matching.tests.test_patternsets import (patterns, match_tester,
+        add, inc, p1, p4, p6, a, vars)
+
+
+def test_compiled_matching():
+    pset = CompiledPatternSet(sexpr_context, patterns)
+    assert pset.source.startswith('def match(t):')
+    match_tester(pset)
+    # Arity is part of the transition
+    assert pset.match_all((add, 1, 1, 1)) == []
+    assert pset.match_all((list, 1, 2)) == []
+
+
+def test_compiled_add_remove():
+    pset = CompiledPatternSet(sexpr_context, [p1, p4])
+    assert pset.match_all((list, 1)) == []
+    pset.add(p6)
+    assert pset.match_all((list, 1)) == [(p6, {'a': 1})]
+    pset.remove(p1)
+    assert pset.match_all((add, 2, 1)) == []
+    assert pset.match_all((add, 1, 1)) == [(p4, {'a': 1})]
+
+
+def test_compiled_deep_pattern(monkeypatch):
+    monkeypatch.setattr(compiled, 'MAX_DEPTH', 3)
+    pat = a
+    term = 1
+    for i in range(10):
+        pat = (add, (inc, pat), i)
+        term = (add, (inc, term), i)
+    p = Pattern(sexpr_context, pat, vars)
+    pset = CompiledPatternSet(sexpr_context, [p])
+    assert 'def _f' in pset.source
+    assert pset.match_all(term) == [(p, {'a': 1})]
+    assert pset.match_all((add, (inc, term), 1)) == []
+
+
+def test_compiled_shared_states():
+    from pinyon.matching import StaticPatternSet
+    # Each argument is matched independently, so many paths through the
+    # automata lead to the same states
+    n = 6
+    vs = tuple('v%d' % i for i in range(n))
+    pats = [Pattern(sexpr_context, (add,) + tuple((inc, 1) if j == k else v
+                                                  for j, v in enumerate(vs)),
+                    vs) for k in range(n)]
+    pats.append(Pattern(sexpr_context, (add,) + tuple((inc, v) for v in vs),
+                        vs))
+    pset = CompiledPatternSet(sexpr_context, pats)
+    static = StaticPatternSet(sexpr_context, pats)
+    # Code is generated once per state, not once per path to it
+    assert len(pset.source.splitlines()) < 10 * len(pset._cache)
+
+    def key(match):
+        return pats.index(match[0])
+
+    for i in range(2 ** n):
+        term = (add,) + tuple((inc, (i >> j) & 1) for j in range(n))
+        assert (sorted(pset.match_all(term), key=key) ==
+                sorted(static.match_all(term), key=key))
@@ -0,0 +1,77 @@
+from pinyon import Engine
+from pinyon.matching import (Pattern, StaticPatternSet, DynamicPatternSet,
+        HybridPatternSet, select_patternset)
+from pinyon.matching.static import Frontier, _states
+from pinyon.term.sexpr import sexpr_context
+
+from pinyon.matching.tests.test_patternsets import (patterns, match_tester,
+        add, inc, p1, p4, p6, a, vars)
+
+
+def test_hybrid_matching():
+    for max_states in [1, 2, 5, 1000]:
+        pset = HybridPatternSet(sexpr_context, patterns, max_states)
+        match_tester(pset)
+        frontier = pset.build_stats['frontier']
+        assert frontier == sum(isinstance(s, Frontier)
+                               for s in _states(pset._net))
+        assert (frontier == 0) == (max_states == 1000)
+    pset = HybridPatternSet(sexpr_context, patterns, 1)
+    pset.instrument()
+    assert pset.match_all((add, 2, 1)) == [(p1, {'a': 2})]
+    assert pset.last_stats.rejected == 1
+
+
+def test_hybrid_add_remove():
+    pset = HybridPatternSet(sexpr_context, [p1, p4], 1)
+    assert pset.match_all((list, 1)) == []
+    pset.add(p6)
+    assert pset.match_all((list, 1)) == [(p6, {'a': 1})]
+    pset.remove(p1)
+    assert pset.match_all((add, 1, 1)) == [(p4, {'a': 1})]
+
+
+def test_select_patternset():
+    pset = select_patternset(sexpr_context, patterns)
+    assert isinstance(pset, StaticPatternSet)
+    assert pset.decision == 'static'
+    assert pset.build_stats['frontier'] == 0
+    assert pset.estimates['choice_points'] == 2
+    assert pset.estimates['max_choice_depth'] == 2
+    assert set(pset.estimates['costs']) == set(['static', 'dynamic'])
+    match_tester(pset)
+
+    pset = select_patternset(sexpr_context, patterns, max_states=2)
+    assert isinstance(pset, HybridPatternSet)
+    assert pset.decision == 'hybrid'
+    assert set(pset.estimates['costs']) == set(['hybrid', 'dynamic'])
+    # The automata built while selecting is kept
+    assert pset.build_stats['frontier'] > 0
+    assert pset.build_stats['computed'] == 2
+    match_tester(pset)
+    pset.add(p6)
+    assert pset.build_stats['computed'] <= 2
+
+    # The estimate is above the budget, but the whole automata fits
+    pset = select_patternset(sexpr_context, patterns, max_states=20)
+    assert pset.estimates['states'] > 20
+    assert pset.decision == 'static'
+    match_tester(pset)
+
+    # Without variables next to heads, the dynamic net never backtracks
+    pats = [Pattern(sexpr_context, (add, (inc, a), 1), vars),
+            Pattern(sexpr_context, (add, 1, (inc, a)), vars)]
+    pset = select_patternset(sexpr_context, pats, max_states=2)
+    assert isinstance(pset, DynamicPatternSet)
+    assert pset.decision == 'dynamic'
+    assert pset.estimates['choice_points'] == 0
+    assert pset.estimates['max_choice_depth'] == 0
+    assert pset.match_all((add, 1, (inc, 2))) == [(pats[1], {'a': 2})]
+    # Few matches don't pay for building the automata
+    pset = select_patternset(sexpr_context, patterns, matches=1)
+    assert pset.decision == 'dynamic'
+
+    eng = Engine(sexpr_context)
+    assert eng.patternset(patterns, 'auto').decision == 'static'
+    pset = eng.patternset(patterns, 'hybrid', max_states=2)
+    assert isinstance(pset, HybridPatternSet) and pset.max_states == 2
@@ -0,0 +1,48 @@
+import pytest
+
+from pinyon.matching import (MatchSession, BottomUpPatternSet,
+        DynamicPatternSet)
+from pinyon.term.sexpr import sexpr_context
+
+from pinyon.matching.tests.test_bottomup import (pset, patterns, add, inc,
+        p1, p3, p7)
+
+
+def test_match_session():
+    term = (add, (inc, 1), (add, 2, 1))
+    session = MatchSession(pset, term)
+    assert session.term == term
+    assert session.match_all() == []
+    assert session.match_all((1,)) == [(p1, {'a': 2})]
+    assert session.matches() == pset.match_subterms(term)
+
+    root = session._root
+    new = session.replace((1,), (inc, 1))
+    assert new == session.term == (add, (inc, 1), (inc, 1))
+    # Only the path to the edit is new
+    assert session._root.args[0] is root.args[0]
+    assert session.subterm((1,)) == (inc, 1)
+    assert session.match_all() == pset.match_all(new)
+    assert session.matches() == pset.match_subterms(new)
+
+    session.replace((0, 0), 2)
+    assert session.term == (add, (inc, 2), (inc, 1))
+    assert session.match_all() == [(p3, {'a': 1, 'b': 2})]
+    session.replace((), (add, 3, 1))
+    assert session.match_all() == [(p1, {'a': 3})]
+
+    with pytest.raises(IndexError):
+        session.replace((3,), 1)
+    with pytest.raises(TypeError):
+        MatchSession(DynamicPatternSet(sexpr_context, patterns), term)
+
+
+def test_match_session_caches_matches():
+    pats = BottomUpPatternSet(sexpr_context, [p7])
+    term = (add, (inc, 1), (inc, (inc, 2)))
+    session = MatchSession(pats, term)
+    assert [m[0] for m in session.matches()] == [(0,), (1,), (1, 0)]
+    cached = session._root.args[1].matches
+    session.replace((0, 0), 3)
+    assert session._root.args[1].matches is cached
+    assert session.matches() == pats.match_subterms(session.term)
@@ -0,0 +1,73 @@
+import pytest
+
+from pinyon.matching import TermIndex
+from pinyon.term.sexpr import sexpr_context
+
+from pinyon.matching.tests.test_patternsets import add, inc, a, b, vars
+
+
+terms = [(add, 1, 2), (add, 1, 1), (add, (inc, 1), (inc, 1)),
+         (add, (inc, 1), 2), (inc, (add, 1, 2)), (add, 1), 1]
+
+
+def test_index_instances():
+    index = TermIndex(sexpr_context)
+    for t in terms:
+        index.insert(t)
+    index.insert((add, 1, 2))
+    assert len(index) == len(terms)
+    assert sorted(map(repr, index)) == sorted(map(repr, terms))
+
+    def instances(pat, vars=vars):
+        return sorted(map(repr, index.instances(pat, vars)))
+
+    assert instances((add, a, 2)) == sorted(map(repr, [(add, 1, 2),
+                                                       (add, (inc, 1), 2)]))
+    # Nonlinear variables
+    assert instances((add, a, a)) == sorted(map(repr, [(add, 1, 1),
+                                            (add, (inc, 1), (inc, 1))]))
+    assert instances((add, (inc, a), b)) == sorted(map(repr, [
+        (add, (inc, 1), (inc, 1)), (add, (inc, 1), 2)]))
+    # Arity is part of the key
+    assert instances((add, a)) == [repr((add, 1))]
+    assert len(index.instances(a, vars)) == len(terms)
+    assert index.instances((add, 3, a), vars) == []
+
+
+def test_index_generalizations():
+    index = TermIndex(sexpr_context)
+    index.insert((add, a, 1), vars)
+    index.insert((add, a, a), vars)
+    index.insert((add, (inc, a), b), vars)
+    index.insert((add, 1, 1))
+    index.insert(a, vars)
+
+    def general(term):
+        return sorted(index.generalizations(term), key=repr)
+
+    assert general((add, 1, 1)) == sorted([
+        ((add, a, 1), {'a': 1}), ((add, a, a), {'a': 1}),
+        ((add, 1, 1), {}), (a, {'a': (add, 1, 1)})], key=repr)
+    assert general((add, (inc, 2), 3)) == sorted([
+        ((add, (inc, a), b), {'a': 2, 'b': 3}),
+        (a, {'a': (add, (inc, 2), 3)})], key=repr)
+    assert general(3) == [(a, {'a': 3})]
+    # Stored variables are only instances of variables
+    assert index.instances((add, 1, b), vars) == [(add, 1, 1)]
+
+
+def test_index_delete():
+    index = TermIndex(sexpr_context)
+    for t in terms:
+        index.insert(t)
+    index.insert((add, a, 1), vars)
+    index.delete((add, a, 1), vars)
+    for t in terms:
+        index.delete(t)
+    assert len(index) == 0
+    assert not index._net.edges
+    with pytest.raises(KeyError):
+        index.delete((add, 1, 2))
+    index.insert((add, 1, 2))
+    with pytest.raises(KeyError):
+        index.delete((add, 1, 2), vars=(1,))
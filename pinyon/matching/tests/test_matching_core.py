@@ -1,5 +1,13 @@
+from operator import eq
+
+import pytest
+
 from pinyon.term.sexpr import sexpr_context
-from pinyon.matching.core import Traverser, Pattern
+from pinyon.core import Context
+from pinyon.matching import (StaticPatternSet, DynamicPatternSet,
+                             BottomUpPatternSet)
+from pinyon.matching.core import (Traverser, Pattern, MatchStats,
+        subterm_equal, merkle_hasher)
 
 
 def inc(x):
@@ -35,6 +43,59 @@ def test_traverser():
     assert list(map(sexpr_context.head, t2)) == [add, inc, 1, double, inc, 1]
 
 
+def test_traverser_paths():
+    term = (add, (inc, 1), (double, (inc, 1)))
+    paths = [(), (0,), (0, 0), (1,), (1, 0), (1, 0, 0)]
+    assert [p for (_, p) in sexpr_context.traverse(term, 'path')] == paths
+    t = sexpr_context.traverse(term, 'tracked')
+    assert t.path == ()
+    t.next()
+    t2 = t.copy()
+    t.skip()
+    t.next()
+    assert t.path == (1, 0) and t2.path == (0,)
+    assert [t2.path for _ in t2] == paths[1:]
+    with pytest.raises(ValueError):
+        sexpr_context.traverse(term).path
+    # Paths are shared between siblings, not copied per node
+    deep = 1
+    for i in range(5000):
+        deep = (add, deep, i)
+    t = sexpr_context.traverse(deep, 'tracked')
+    for i in range(5000):
+        t.next()
+    assert t.path == (0,) * 5000
+
+
+def test_traverser_head_args():
+    from pinyon.term import sexpr
+    calls = []
+
+    def head_args(t):
+        calls.append(t)
+        return sexpr.head_args(t)
+
+    ctx = Context(sexpr.head, sexpr.args, sexpr.subs, sexpr.rebuild,
+                  head_args=head_args, child=sexpr.child)
+    term = (add, (inc, 1), (double, (inc, 1)))
+    t = Traverser(ctx, term)
+    assert t.current == add
+    # The arguments were found along with the head
+    t.next()
+    assert calls == [term]
+    assert t.arity == 1
+    assert t.current == inc
+    assert calls == [term, (inc, 1)]
+    t2 = t.copy()
+    t2.skip()
+    assert t2.current == double and t.current == inc
+    assert list(map(sexpr_context.head, t2)) == [double, inc, 1]
+    assert [(sexpr.head(s), n) for (s, n) in ctx.traverse(term, 'arity')] \
+        == [(add, 2), (inc, 1), (1, 0), (double, 1), (inc, 1), (1, 0)]
+    assert ctx.index(term, (1, 0, 0)) == 1
+    assert ctx.get([1, 2], 1) == 2
+
+
 def test_pattern():
     a, b, c = vars = tuple("abc")
 
@@ -53,3 +114,64 @@ def test_pattern():
     p = Pattern(sexpr_context, (add, 1, 2), vars)
     assert p._varlist == []
     assert p._path_lookup == {}
+
+
+def test_match_stats():
+    s = MatchStats(nodes=2, captures=1)
+    assert s.nodes == 2 and s.captures == 1 and s.backtracks == 0
+    s += MatchStats(nodes=1, rejected=3)
+    assert s == MatchStats(nodes=3, captures=1, rejected=3)
+    assert s.as_dict()['rejected'] == 3
+    assert 'nodes=3' in repr(s)
+    try:
+        MatchStats(foo=1)
+        assert False
+    except TypeError:
+        pass
+
+
+class Leaf(object):
+    """A leaf that fails when compared, with a hash by value"""
+
+    def __init__(self, val):
+        self.val = val
+
+    def __hash__(self):
+        return hash(self.val)
+
+    def __eq__(self, other):
+        raise AssertionError("Compared leaves")
+
+
+def test_subterm_equal():
+    t1 = (add, (inc, Leaf(1)), (double, Leaf(2)))
+    t2 = (add, (inc, Leaf(1)), (double, Leaf(3)))
+    t3 = (add, (inc, Leaf(1)), (double, Leaf(2)))
+    h = merkle_hasher(sexpr_context)
+    assert h(t1) == h(t3)
+    assert h(t1) != h(t2)
+
+    hashed = Context(sexpr_context.head, sexpr_context.args,
+                     sexpr_context.subs, sexpr_context.rebuild, hash=True)
+    assert subterm_equal(sexpr_context) is eq
+    equal = subterm_equal(hashed)
+    # Rejected by hash, without comparing
+    assert not equal(t1, t2)
+    assert equal(t1, t1)
+    t = (add, 1, (inc, 2))
+    assert equal(t, (add, 1, (inc, 2)))
+    assert not equal(t, (add, 1, (inc, 3)))
+    # Unhashable subterms are compared
+    assert equal((add, [1], 2), (add, [1], 2))
+
+    ctx = Context(sexpr_context.head, sexpr_context.args)
+    assert subterm_equal(ctx)(t, (add, 1, (inc, 2)))
+
+    pats = [Pattern(hashed, (add, 'a', 'a'), ('a',))]
+    for cls in [StaticPatternSet, DynamicPatternSet, BottomUpPatternSet]:
+        pset = cls(hashed, pats)
+        if cls is not BottomUpPatternSet:
+            # The bottom up automata compares heads itself
+            assert pset.match_all((add, t1, t2)) == []
+        assert pset.match_all((add, t, (add, 1, (inc, 2)))) == [
+            (pats[0], {'a': t})]
@@ -0,0 +1,69 @@
+import pickle
+
+from pinyon.matching import (Pattern, StaticPatternSet, DynamicPatternSet,
+        CompiledPatternSet, ParallelMatcher)
+from pinyon.term.sexpr import sexpr_context
+
+
+def inc(x):
+    return x + 1
+
+
+def add(x, y):
+    return x + y
+
+
+a, b = vars = ('a', 'b')
+patterns = [Pattern(sexpr_context, (add, a, 1), vars),
+            Pattern(sexpr_context, (add, (inc, a), b), vars),
+            Pattern(sexpr_context, (add, a, a), vars)]
+terms = [(add, i % 3, (i + 1) % 3) for i in range(50)]
+terms += [(add, (inc, i), i) for i in range(50)] + [1, (inc, 2)]
+
+
+def test_pickle():
+    ctx = pickle.loads(pickle.dumps(sexpr_context))
+    assert ctx == sexpr_context
+    assert ctx.head is sexpr_context.head
+    assert hash(ctx) == hash(sexpr_context)
+    for cls in [StaticPatternSet, DynamicPatternSet, CompiledPatternSet]:
+        pset = pickle.loads(pickle.dumps(cls(sexpr_context, patterns)))
+        assert pset.context == sexpr_context
+        res = [[(p.pat, s) for (p, s) in r] for r in pset.match_many(terms)]
+        assert res == [[(p.pat, s) for (p, s) in pset.match_all(t)]
+                       for t in terms]
+        # Patterns can still be added with the original context
+        pset.add(Pattern(sexpr_context, (inc, a), vars))
+
+
+def test_parallel_matcher():
+    for cls in [StaticPatternSet, DynamicPatternSet]:
+        pset = cls(sexpr_context, patterns)
+        with ParallelMatcher(pset, processes=2, chunksize=7) as pm:
+            res = pm.match_many(iter(terms))
+        assert res == pset.match_many(terms)
+        # Patterns are the originals, not copies
+        assert res[0][0][0] is patterns[0]
+        # Matching uses the patterns the workers got
+        with ParallelMatcher(pset, processes=2, chunksize=7) as pm:
+            pset.remove(patterns[0])
+            assert pm.match_many(terms) == res
+
+
+def test_parallel_matcher_streams():
+    pset = StaticPatternSet(sexpr_context, patterns + [patterns[0]])
+    consumed = []
+
+    def stream():
+        for i in range(1000):
+            consumed.append(i)
+            yield terms[i % len(terms)]
+    with ParallelMatcher(pset, processes=2, chunksize=10, pending=3) as pm:
+        it = pm.imatch(stream())
+        first = next(it)
+        # Only the chunks in flight were read
+        assert len(consumed) <= 30
+        res = [first] + list(it)
+    assert res == pset.match_many(terms[i % len(terms)] for i in range(1000))
+    # The repeated pattern is found at both its positions
+    assert res[0] == [(patterns[0], {'a': 0}), (patterns[0], {'a': 0})]
@@ -1,4 +1,7 @@
-from pinyon.matching import Pattern, DynamicPatternSet, StaticPatternSet, VAR
+import pytest
+
+from pinyon.matching import (Pattern, DynamicPatternSet, StaticPatternSet,
+        LazyPatternSet, VAR)
 from pinyon.term.sexpr import sexpr_context
 
 
@@ -80,3 +83,368 @@ def test_static_matching():
 
 def test_dynamic_matching():
     match_tester(dynamic_pset)
+
+
+def test_lazy_matching():
+    lazy_pset = LazyPatternSet(sexpr_context, patterns)
+    # Only the start state exists before matching
+    assert lazy_pset.build_stats == {'states': 1, 'expanded': 0,
+                                     'transitions': 0}
+    assert lazy_pset.match_all((list, 1)) == [(p6, {'a': 1})]
+    stats = lazy_pset.build_stats
+    assert stats['expanded'] == 2
+    assert stats['states'] < static_pset.build_stats['states']
+    match_tester(lazy_pset)
+    assert lazy_pset.match_all((add, 1)) == []
+    assert lazy_pset.match_all((inc, 1)) == []
+
+
+def test_MSet_key():
+    from pinyon.matching.static import MSet, MItem
+    m1 = MSet([MItem([(add, 2), (VAR, 0)], 0), MItem([(VAR, 0)], 1)])
+    m2 = MSet([MItem([(VAR, 0)], 1), MItem([(add, 2), (VAR, 0)], 0),
+               MItem([(VAR, 0)], 1)])
+    m3 = MSet([MItem([(VAR, 0)], 1)])
+    assert m1.is_equivalent(m2)
+    assert m1.key == m2.key
+    assert hash(m1.key) == hash(m2.key)
+    assert not m1.is_equivalent(m3)
+    assert m1.key != m3.key
+
+
+def test_build_stats():
+    stats = static_pset.build_stats
+    assert stats['states'] == 16
+    assert stats['transitions'] == 17
+    assert stats['seconds'] >= 0
+    assert 'minimized_states' not in stats
+    # Minimizing is opt in
+    from pinyon.matching.static import build_automata
+    stats = {}
+    build_automata(sexpr_context, patterns, stats, minimize=True)
+    assert stats['minimized_states'] <= stats['states']
+    assert 0 < stats['minimized_bytes'] <= stats['bytes']
+
+
+def test_minimize_automata():
+    from pinyon.matching.static import (minimize_automata, automata_size,
+                                        compact_cache, build_automata)
+    # Two equivalent subautomata, and equal leaves stored separately
+    net = {add: {1: (0,), VAR: (0, 1)},
+           inc: {1: (0,), VAR: (0, 1)},
+           VAR: (0,)}
+    new = minimize_automata(net)
+    assert new == net
+    assert new[add] is new[inc]
+    assert new[add][1] is new[VAR]
+    assert automata_size(new) < automata_size(net)
+    # Already minimal automata are unchanged
+    assert minimize_automata(new) == new
+
+    cache = {}
+    net = build_automata(sexpr_context, patterns, cache=cache,
+                         minimize=False)
+    copy = dict((k, list(v)) for (k, v) in cache.items())
+    compact_cache(cache)
+    assert cache == copy
+    # Every state is a single object, wherever it's found
+    msets = {}
+    for trans in cache.values():
+        for t, k, m in trans:
+            assert msets.setdefault(k, m) is m
+
+
+def test_add_remove():
+    for cls in [StaticPatternSet, LazyPatternSet, DynamicPatternSet]:
+        pset = cls(sexpr_context, [p1, p4, p6])
+        pset.add(p2)
+        pset.add(p3)
+        pset.add(p5)
+        assert pset.patterns == [p1, p4, p6, p2, p3, p5]
+        term = (add, (inc, 1), (inc, 1))
+        matches = pset.match_all(term)
+        assert len(matches) == 3
+        assert (p2, {'a': 1}) in matches
+        assert (p3, {'a': 1, 'b': 1}) in matches
+        assert (p4, {'a': (inc, 1)}) in matches
+        pset.remove(p4)
+        pset.remove(p6)
+        assert pset.patterns == [p1, p2, p3, p5]
+        assert pset.match_all(term) == [(p2, {'a': 1}), (p3, {'a': 1, 'b': 1})]
+        assert pset.match_all((list, 1)) == []
+        assert pset.match_all((add, 2, 1)) == [(p1, {'a': 2})]
+        for p in [p1, p2, p3, p5]:
+            pset.remove(p)
+        pset.add(p6)
+        assert pset.match_all((list, 1)) == [(p6, {'a': 1})]
+
+
+def test_static_add_remove_reuses_states():
+    pset = StaticPatternSet(sexpr_context, patterns[:-1])
+    pset.add(p6)
+    assert pset._net == static_pset._net
+    # Only the start state and states containing the new pattern are built
+    assert pset.build_stats['computed'] == 3
+    assert pset.build_stats['states'] == static_pset.build_stats['states']
+    pset.remove(p5)
+    assert pset._net == StaticPatternSet(sexpr_context, patterns[:4] +
+                                         [p6])._net
+    assert pset.build_stats['computed'] == 1
+
+
+def test_dynamic_remove_prunes():
+    pset = DynamicPatternSet(sexpr_context, patterns)
+    pset.remove(p5)
+    pset.remove(p2)
+    expected = DynamicPatternSet(sexpr_context, [p1, p3, p4, p6])
+    assert pset._net == expected._net
+    pset.remove(p3)
+    assert inc not in pset._net.edges[add].edges
+
+
+def test_concurrent_add_remove():
+    from threading import Thread
+    from pinyon.matching import CompiledPatternSet, HybridPatternSet
+    term = (add, (inc, 1), (inc, 1))
+    # The matches possible with `p4` present, and without
+    with_p4 = [(p2, {'a': 1}), (p3, {'a': 1, 'b': 1}), (p4, {'a': (inc, 1)})]
+    without_p4 = with_p4[:2]
+    for cls in [StaticPatternSet, LazyPatternSet, DynamicPatternSet,
+                CompiledPatternSet, HybridPatternSet]:
+        pset = cls(sexpr_context, patterns)
+        # Updates make a new snapshot, and leave the old one alone
+        before = pset._snapshot
+        pset.remove(p4)
+        assert before[0] == patterns
+        assert pset.patterns == patterns[:3] + patterns[4:]
+        found = []
+
+        def reader():
+            for i in range(200):
+                found.append(sorted(pset.match_all(term), key=_key))
+
+        def writer():
+            for i in range(50):
+                pset.add(p4)
+                pset.remove(p4)
+
+        threads = [Thread(target=reader) for i in range(3)]
+        threads.append(Thread(target=writer))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for res in found:
+            assert res in (with_p4, without_p4)
+        assert pset.match_all(term) == without_p4
+
+
+def _key(match):
+    return patterns.index(match[0])
+
+
+def test_patterns_attribute():
+    from pinyon.matching import (PatternSet, CompiledPatternSet,
+                                 HybridPatternSet, BottomUpPatternSet)
+
+    # Subclasses outside pinyon may set the patterns themselves
+    class Listed(PatternSet):
+        def __init__(self, context, patterns):
+            self.context = context
+            self.patterns = patterns
+
+        def _match_iter(self, term, stats):
+            return ((p, {}) for p in self.patterns if p.pat == term)
+
+    pset = Listed(sexpr_context, [p1, p2])
+    assert pset.patterns == [p1, p2]
+    pset.patterns = [p1]
+    assert pset.match_all((add, a, 1)) == [(p1, {})]
+
+    # Pattern sets with a net rebuild it
+    for cls in [StaticPatternSet, LazyPatternSet, DynamicPatternSet,
+                CompiledPatternSet, HybridPatternSet]:
+        pset = cls(sexpr_context, patterns)
+        before = pset.patterns
+        pset.patterns = [p6, p1]
+        assert pset.patterns == [p6, p1] and before == patterns
+        assert pset.match_all((list, 'a')) == [(p6, {'a': 'a'})]
+        assert pset.match_all((add, 2, 1)) == [(p1, {'a': 2})]
+        assert pset.match_all((add, 1, 1)) == [(p1, {'a': 1})]
+        # Each snapshot has its own list
+        pset.add(p4)
+        assert pset.patterns == [p6, p1, p4]
+    pset = BottomUpPatternSet(sexpr_context, patterns)
+    with pytest.raises(AttributeError):
+        pset.patterns = [p1]
+
+
+def test_token_pickle():
+    import pickle
+    assert pickle.loads(pickle.dumps(VAR)) is VAR
+
+
+def test_static_save_load(tmpdir):
+    filename = str(tmpdir.join('pset.pinyon'))
+    static_pset.save(filename)
+    # Using the stored patterns
+    pset = StaticPatternSet.load(filename, sexpr_context)
+    assert pset._net == static_pset._net
+    assert [(p.pat, p.vars) for p in pset.patterns] == [(p.pat, p.vars)
+                                                        for p in patterns]
+    assert pset.match_all((add, 2, 1))[0][1] == {'a': 2}
+    # Using the original patterns
+    pset = StaticPatternSet.load(filename, sexpr_context, patterns)
+    assert pset.patterns == patterns
+    assert pset.build_stats['loaded'] == filename
+    match_tester(pset)
+    # Updates still work
+    pset.remove(p5)
+    match_tester(pset)
+    # Mismatched patterns are rejected
+    try:
+        StaticPatternSet.load(filename, sexpr_context, patterns[:-1])
+        assert False
+    except ValueError:
+        pass
+
+
+def test_cached_patternset(tmpdir):
+    from pinyon.matching.static import cached_patternset, fingerprint
+    cache_dir = str(tmpdir.join('cache'))
+    pset = cached_patternset(sexpr_context, patterns, cache_dir)
+    assert 'loaded' not in pset.build_stats
+    assert tmpdir.join('cache', fingerprint(sexpr_context, patterns) +
+                       '.pinyon').check()
+    pset = cached_patternset(sexpr_context, patterns, cache_dir)
+    assert 'loaded' in pset.build_stats
+    assert pset._net == static_pset._net
+    match_tester(pset)
+    # Different patterns have a different fingerprint
+    pset = cached_patternset(sexpr_context, patterns[:-1], cache_dir)
+    assert 'loaded' not in pset.build_stats
+    # Unpicklable patterns aren't cached
+    lam = Pattern(sexpr_context, (lambda x: x, a), vars)
+    pset = cached_patternset(sexpr_context, [lam], cache_dir)
+    assert len(tmpdir.join('cache').listdir()) == 2
+
+
+def test_fingerprint_vars():
+    import os
+    import subprocess
+    import sys
+    import pinyon
+    from pinyon.matching.static import fingerprint
+    names = tuple('abcdefgh')
+    fp = fingerprint(sexpr_context,
+                     [Pattern(sexpr_context, (add, a, b), names)])
+    assert fp == fingerprint(sexpr_context, [Pattern(sexpr_context,
+                             (add, a, b), set(reversed(names)))])
+    # Stable across processes, whatever the order of sets there
+    code = '; '.join([
+        "from pinyon.matching import Pattern",
+        "from pinyon.matching.static import fingerprint",
+        "from pinyon.term.sexpr import sexpr_context",
+        "from pinyon.matching.tests.test_patternsets import add",
+        "p = Pattern(sexpr_context, (add, 'a', 'b'), set('abcdefgh'))",
+        "print(fingerprint(sexpr_context, [p]))"])
+    root = os.path.dirname(os.path.dirname(os.path.abspath(pinyon.__file__)))
+    outs = set()
+    for seed in ['1', '2', '3']:
+        env = dict(os.environ, PYTHONHASHSEED=seed, PYTHONPATH=root)
+        outs.add(subprocess.check_output([sys.executable, '-c', code],
+                                         env=env))
+    assert len(outs) == 1
+
+
+def test_match_many():
+    shared = (add, (inc, 1), (inc, 1))
+    terms = [(add, 2, 1), shared, (add, shared, 1), shared, (add, 2, 3),
+             (add, [1], [1]), (add, shared, shared), 1, (add, 1, 2, 3)]
+    psets = [static_pset, dynamic_pset, LazyPatternSet(sexpr_context, patterns)]
+    for pset in psets:
+        res = pset.match_many(terms)
+        assert len(res) == len(terms)
+        for t, r in zip(terms[:-1], res):
+            assert r == pset.match_all(t)
+        assert res[-1] == []
+        # Results for repeated terms aren't shared
+        assert res[1] is not res[3]
+
+
+def test_static_match_many_memoizes_subterms():
+    from pinyon.core import Context
+    from pinyon.term import sexpr
+    heads = []
+
+    def head(t):
+        heads.append(t)
+        return sexpr.head(t)
+
+    ctx = Context(head, sexpr.args, sexpr.subs, sexpr.rebuild)
+    pset = StaticPatternSet(ctx, [Pattern(ctx, p.pat, p.vars)
+                                  for p in patterns])
+    shared = (inc, (add, 1, (inc, 2)))
+    terms = [(add, shared, shared)] * 3 + [(add, shared, 1)]
+    res = pset.match_many(terms)
+    assert [len(r) for r in res] == [3, 3, 3, 1]
+    # Each term is walked once, and shared is walked once from each state
+    # it's found in.
+    assert len([t for t in heads if t is shared]) == 2
+    assert len([t for t in heads if t in terms]) == 2
+
+
+def test_instrument():
+    for cls in [StaticPatternSet, LazyPatternSet, DynamicPatternSet]:
+        pset = cls(sexpr_context, patterns)
+        assert pset.match_all((add, 2, 1)) == [(p1, {'a': 2})]
+        assert not hasattr(pset, 'stats')
+        calls = []
+        pset.instrument(hook=lambda ps, stats: calls.append((ps, stats)))
+        pset.match_all((add, 2, 1))
+        stats = pset.last_stats
+        assert calls == [(pset, stats)]
+        assert stats.nodes >= 3
+        assert stats.transitions >= 3
+        assert stats.captures >= 1
+        # (add, a, a) is rejected
+        assert stats.rejected == 1
+        assert stats.head_calls >= 3
+        assert stats.args_calls >= 1
+        pset.match_all((add, 2, 3))
+        assert pset.stats.transitions == (stats.transitions +
+                                          pset.last_stats.transitions)
+        assert len(calls) == 2
+        # Stats are finished when iteration stops early
+        pset.match_one((add, 1, 1))
+        assert len(calls) == 3
+        pset.instrument(False)
+        total = pset.stats.transitions
+        pset.match_all((add, 2, 1))
+        assert len(calls) == 3
+        # Turning counting off keeps the counts
+        assert pset.stats.transitions == total > 0
+        pset.instrument()
+        assert pset.stats.transitions == 0
+        pset.match_all((add, 2, 1))
+        pset.match_all((add, 2, 3))
+        expected = pset.stats.transitions
+        pset.instrument()
+        pset.match_many([(add, 2, 1), (add, 2, 3)])
+        assert pset.stats.transitions == expected
+
+    from pinyon.matching import CompiledPatternSet, BottomUpPatternSet
+    for cls in [CompiledPatternSet, BottomUpPatternSet]:
+        pset = cls(sexpr_context, patterns)
+        with pytest.raises(NotImplementedError):
+            pset.instrument()
+        pset.instrument(False)
+
+
+def test_instrument_backtracking():
+    pset = DynamicPatternSet(sexpr_context, patterns)
+    pset.instrument()
+    pset.match_all((add, (inc, 1), 1))
+    stats = pset.last_stats
+    assert stats.choice_points > 0
+    assert stats.backtracks > 0
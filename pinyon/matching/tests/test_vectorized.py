@@ -0,0 +1,67 @@
+import pytest
+np = pytest.importorskip('numpy')
+
+from pinyon.matching import (Pattern, StaticPatternSet, LazyPatternSet,
+        VectorizedMatcher, automata_tables, VAR)
+from pinyon.term.flat import FlatTerm, flatten, unflatten
+from pinyon.term.sexpr import sexpr_context
+
+
+def inc(x):
+    return x + 1
+
+
+def add(x, y):
+    return x + y
+
+
+a, b = vars = ('a', 'b')
+patterns = [Pattern(sexpr_context, (add, a, 1), vars),
+            Pattern(sexpr_context, (add, (inc, a), b), vars),
+            Pattern(sexpr_context, (add, a, a), vars),
+            Pattern(sexpr_context, (inc, (inc, a)), vars)]
+terms = [(add, i % 3, (i + 1) % 3) for i in range(30)]
+terms += [(add, (inc, i), i) for i in range(30)]
+terms += [1, (inc, 2), (inc, (inc, (add, 1, 1))), (add, (inc, 1), (inc, 1))]
+
+
+def test_automata_tables():
+    pset = StaticPatternSet(sexpr_context, patterns)
+    symbols, table, accept = automata_tables(pset)
+    assert set(symbols) == set([add, inc, 1])
+    assert table.shape[1] == len(symbols) + 2
+    assert (table[:, -2] == -1).all()
+    # Follow (add, 1, 1) through the tables
+    def step(state, head):
+        nxt = table[state, symbols[head]]
+        return nxt if nxt >= 0 else table[state, -1]
+    state = 0
+    for h in [add, 1, 1]:
+        state = step(state, h)
+    assert accept[state] == (0, 2)
+    assert table[0, -1] == -1
+    with pytest.raises(TypeError):
+        automata_tables(LazyPatternSet(sexpr_context, patterns))
+
+
+def test_match_batch():
+    pset = StaticPatternSet(sexpr_context, patterns)
+    vm = VectorizedMatcher(pset)
+    # Mix flattened and unflattened terms
+    batch = [flatten(t) if i % 2 else t for (i, t) in enumerate(terms)]
+    tree, roots, matches = vm.match_batch(batch)
+    assert len(roots) == len(terms)
+    assert unflatten(FlatTerm(tree, roots[60])) == 1
+    expected = [[] for p in patterns]
+    for i, t in enumerate(terms):
+        for pat, subs in pset.match_all(t):
+            expected[patterns.index(pat)].append((i, subs))
+    for (inds, subs), exp in zip(matches, expected):
+        assert list(inds) == [i for (i, s) in exp]
+        for k, (i, s) in enumerate(exp):
+            got = dict((v, unflatten(FlatTerm(tree, n[k])))
+                       for (v, n) in subs.items())
+            assert got == s
+    tree, roots, matches = vm.match_batch([])
+    assert len(roots) == 0
+    assert all(len(inds) == 0 for (inds, subs) in matches)
@@ -0,0 +1,261 @@
+from __future__ import absolute_import, division, print_function
+from array import array
+
+from .core import VAR
+from .static import StaticPatternSet
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is required for vectorized matching")
+
+
+def automata_tables(pset):
+    """Export the automata of a `StaticPatternSet` as dense integer tables.
+
+    Parameters
+    ----------
+    pset : StaticPatternSet
+        A fully built static pattern set. `LazyPatternSet`s aren't supported.
+
+    Returns
+    -------
+    A tuple of `(symbols, table, accept)`:
+
+    - ``symbols`` is a dict mapping each head with a transition to its column
+      in `table`.
+    - ``table`` is an integer array of shape ``(states, len(symbols) + 2)``,
+      giving the next state for each state and head, or ``-1`` if there's no
+      transition. The column ``-2`` is for heads not in `symbols`, and never
+      has a transition. The column ``-1`` is the `VAR` transition. The start
+      state is ``0``.
+    - ``accept`` is a list with a tuple of the indices of the matching
+      patterns for each final state, and `None` for all other states.
+    """
+
+    _require_numpy()
+    net = pset._net
+    if not isinstance(pset, StaticPatternSet) or not isinstance(net, dict):
+        raise TypeError("Only fully built static pattern sets have tables")
+    symbols = {}
+    # States are found by the identity of their dict, or tuple of patterns
+    states = {id(net): 0}
+    nodes = [net]
+    edges = []
+    for node in nodes:
+        out = []
+        if isinstance(node, dict):
+            for h, sub in node.items():
+                ind = states.get(id(sub))
+                if ind is None:
+                    ind = states[id(sub)] = len(nodes)
+                    nodes.append(sub)
+                if h is not VAR and h not in symbols:
+                    symbols[h] = len(symbols)
+                out.append((h, ind))
+        edges.append(out)
+    table = np.full((len(nodes), len(symbols) + 2), -1, dtype=np.intp)
+    for i, out in enumerate(edges):
+        for h, ind in out:
+            table[i, -1 if h is VAR else symbols[h]] = ind
+    accept = [None if isinstance(n, dict) else n for n in nodes]
+    return symbols, table, accept
+
+
+class VectorizedMatcher(object):
+    """Match batches of terms against a static pattern set with NumPy.
+
+    The automata is exported with `automata_tables`, and all terms in a batch
+    are advanced through it at once, one node per step. Terms are matched in
+    their flattened form, see `pinyon.term.flat`. Requires NumPy.
+
+    Parameters
+    ----------
+    pset : StaticPatternSet
+    """
+
+    def __init__(self, pset):
+        self.patternset = pset
+        self.symbols, self.table, self.accept = automata_tables(pset)
+
+    def match_batch(self, terms):
+        """Find all matchings for a batch of terms.
+
+        Parameters
+        ----------
+        terms : iterable
+            `FlatTerm`s, or terms of the pattern set's context, which are
+            flattened first.
+
+        Returns
+        -------
+        A tuple of `(tree, roots, matches)`. `tree` is a `FlatTree` holding
+        the whole batch, and `roots` an array of the index of each term in it.
+        `matches` has an entry for each pattern in `pset.patterns`, a tuple
+        of `(inds, subs)`: `inds` is an array of the indices of the matching
+        terms in the batch, and `subs` is a dict mapping each variable of the
+        pattern to an array of the nodes in `tree` it's bound to, for each
+        term in `inds`. Use ``FlatTerm(tree, node)`` to get a bound subterm.
+        """
+
+        from ..term.flat import FlatTerm
+        tree, roots, cols = self._concat(terms)
+        ends = _numpy(tree.ends)
+        final = self._run(roots, ends, cols)
+
+        patterns = self.patternset.patterns
+        found = [[] for p in patterns]
+        for state in np.unique(final[final >= 0]):
+            rules = self.accept[state]
+            if not rules:
+                continue
+            inds = np.flatnonzero(final == state)
+            for rule in rules:
+                found[rule].append(inds)
+
+        matches = []
+        for pat, parts in zip(patterns, found):
+            inds = np.sort(np.concatenate(parts)) if parts else \
+                np.empty(0, dtype=np.intp)
+            starts = roots[inds]
+            subs = {}
+            keep = np.ones(len(inds), dtype=bool)
+            for var, paths in pat._path_lookup.items():
+                first = subs[var] = _follow(ends, starts, paths[0])
+                for p in paths[1:]:
+                    other = _follow(ends, starts, p)
+                    # Nonlinear variables, compare the bound subterms
+                    for k in np.flatnonzero(keep):
+                        a, b = int(first[k]), int(other[k])
+                        if FlatTerm(tree, a) != FlatTerm(tree, b):
+                            keep[k] = False
+            if not keep.all():
+                inds = inds[keep]
+                subs = dict((v, s[keep]) for (v, s) in subs.items())
+            matches.append((inds, subs))
+        return tree, roots, matches
+
+    def _concat(self, terms):
+        """Concatenate a batch of terms into a single `FlatTree`.
+
+        Also returns the index of the root of each term, and the column in
+        the transition table of each node."""
+
+        from ..term.flat import FlatTerm, FlatTree, flatten
+        context = self.patternset.context
+        heads, arities, ends = array('l'), array('l'), array('l')
+        # Symbols of all trees in the batch, each tree's added once
+        local = []
+        bases = {}
+        base, shift, roots = [], [], []
+        offset = 0
+        for t in terms:
+            if not isinstance(t, FlatTerm):
+                t = flatten(t, context)
+            tree, i = t
+            end = tree.ends[i]
+            heads.extend(tree.heads[i:end])
+            arities.extend(tree.arities[i:end])
+            ends.extend(tree.ends[i:end])
+            if id(tree) not in bases:
+                bases[id(tree)] = (len(local), tree)
+                local.extend(tree.symbols)
+            base.append(bases[id(tree)][0])
+            shift.append(offset - i)
+            roots.append(offset)
+            offset += end - i
+        sizes = np.diff(np.append(roots, offset)).astype(np.intp)
+
+        # Intern the symbols of the batch, like `flatten`
+        symbols, index, ids = [], {}, []
+        for sym in local:
+            try:
+                key = (type(sym), sym)
+                ind = index.get(key)
+            except TypeError:
+                key = ind = None
+            if ind is None:
+                ind = len(symbols)
+                symbols.append(sym)
+                if key is not None:
+                    index[key] = ind
+            ids.append(ind)
+        unknown = len(self.symbols)
+        columns = np.array([_column(self.symbols, sym, unknown)
+                            for sym in symbols], dtype=np.intp)
+
+        ids = np.array(ids, dtype=np.intp)
+        nodes = _numpy(heads) + np.repeat(np.array(base, dtype=np.intp),
+                                          sizes)
+        batch_heads = ids[nodes]
+        batch_ends = _numpy(ends) + np.repeat(np.array(shift, dtype=np.intp),
+                                              sizes)
+        batch = FlatTree(symbols, _to_array(batch_heads), arities,
+                         _to_array(batch_ends))
+        return batch, np.array(roots, dtype=np.intp), columns[batch_heads]
+
+    def _run(self, roots, ends, cols):
+        """Advance every term through the automata.
+
+        Returns the final state of each term, or ``-1`` if it doesn't reach
+        the end of the term."""
+
+        table = self.table
+        final = np.full(len(roots), -1, dtype=np.intp)
+        todo = np.arange(len(roots))
+        pos = roots.copy()
+        stop = ends[roots]
+        state = np.zeros(len(roots), dtype=np.intp)
+        while len(todo):
+            nxt = table[state, cols[pos]]
+            take = nxt >= 0
+            # Without a transition on the head, take the VAR transition and
+            # skip the subterm
+            state = np.where(take, nxt, table[state, -1])
+            pos = np.where(take, pos + 1, ends[pos])
+            alive = state >= 0
+            done = alive & (pos >= stop)
+            final[todo[done]] = state[done]
+            more = alive & ~done
+            todo, pos, stop, state = todo[more], pos[more], stop[more], \
+                state[more]
+        return final
+
+
+def _column(symbols, head, unknown):
+    try:
+        return symbols.get(head, unknown)
+    except TypeError:
+        return unknown
+
+
+def _numpy(arr):
+    """An integer array as a NumPy array"""
+    return np.frombuffer(arr, dtype='l').astype(np.intp)
+
+
+def _to_array(arr):
+    out = array('l')
+    data = arr.astype('l').tobytes()
+    if hasattr(out, 'frombytes'):
+        out.frombytes(data)
+    else:
+        out.fromstring(data)
+    return out
+
+
+def _follow(ends, starts, path):
+    """The nodes at `path` below each node in `starts`, by index
+    arithmetic"""
+
+    nodes = starts
+    for i in path:
+        nodes = nodes + 1
+        for k in range(i):
+            nodes = ends[nodes]
+    return nodes
@@ -0,0 +1,136 @@
+from __future__ import absolute_import, division, print_function
+
+
+class RuleSet(object):
+    """A set of rewrite rules.
+
+    Parameters
+    ----------
+    pset : PatternSet
+        A pattern set of the left hand sides of the rules.
+    rhs : list
+        The right hand side of the rule for each pattern in `pset.patterns`.
+        Variables of the pattern in the right hand side are replaced by their
+        matching values with `Context.subs`.
+    """
+
+    def __init__(self, pset, rhs):
+        if len(pset.patterns) != len(rhs):
+            raise ValueError("Need a right hand side for every pattern")
+        self.context = pset.context
+        self.patternset = pset
+        self._rhs = {}
+        for pat, r in zip(pset.patterns, rhs):
+            self._rhs.setdefault(id(pat), r)
+
+    def apply(self, term):
+        """Rewrite term once at its root.
+
+        Returns the rewritten term, or `None` if no rule matches."""
+
+        pat, subs = self.patternset.match_one(term)
+        if pat is None:
+            return None
+        return self.context.subs(self._rhs[id(pat)], subs)
+
+
+# Key of the memo for the rules and strategy it was made with. Other keys are
+# the ids of terms.
+_MEMO_RULES = object()
+
+
+def rewrite(rules, term, strategy='innermost', memo=None):
+    """Rewrite a term with a set of rules.
+
+    Parameters
+    ----------
+    rules : RuleSet
+    term : term
+    strategy : str, optional
+        The rewriting strategy. Options are:
+        - ``"innermost"``: rewrite to normal form, reducing the arguments of a
+          term before the term itself.
+        - ``"outermost"``: rewrite to normal form, reducing a term before its
+          arguments.
+        - ``"bottomup"``: a single bottom up pass, rewriting each subterm at
+          most once.
+    memo : dict, optional
+        Cache of rewritten subterms, keyed by identity. Shared subterms are
+        only rewritten once. Pass the same dict to several calls with the same
+        rules and strategy to share the cache between them. Raises
+        `ValueError` if the memo was used with other rules or strategy.
+    """
+
+    if strategy not in ('innermost', 'outermost', 'bottomup'):
+        raise ValueError("Unknown strategy {0!r}".format(strategy))
+    if memo is None:
+        memo = {}
+    used = memo.setdefault(_MEMO_RULES, (rules, strategy))
+    if used[0] is not rules or used[1] != strategy:
+        raise ValueError("memo was used with other rules or strategy")
+    context = rules.context
+    apply = rules.apply
+    # A rewritten term may be rewritten again, to the same normal form
+    normal = strategy != 'bottomup'
+
+    def done(t):
+        hit = memo.get(id(t))
+        # The term is stored too, to keep it alive while its id is a key
+        return hit is not None and hit[0] is t
+
+    def rewrite_args(t):
+        """Rebuild `t` from its rewritten arguments, found in the memo"""
+        args = context.args(t)
+        new_args = [memo[id(a)][1] for a in args]
+        if all(n is a for (n, a) in zip(new_args, args)):
+            return t
+        return context.rebuild(context.head(t), new_args)
+
+    # Terms being rewritten, with their arguments rewritten above them on the
+    # stack, so that deep terms don't overflow the python stack. Each frame
+    # is `[t, keys, expanded]`: `t` is the current term, `keys` the terms
+    # whose result is that of `t`, and `expanded` whether the arguments of
+    # `t` have been pushed.
+    stack = [[term, [term], False]]
+    while stack:
+        frame = stack[-1]
+        t, keys, expanded = frame
+        finished = True
+        if not expanded:
+            if done(t):
+                result = memo[id(t)][1]
+            else:
+                if strategy == 'outermost':
+                    r = apply(t)
+                    while r is not None:
+                        t, r = r, apply(r)
+                    frame[0] = t
+                frame[2] = True
+                stack.extend([a, [a], False] for a in
+                             reversed(context.args(t)) if not done(a))
+                continue
+        else:
+            new = rewrite_args(t)
+            if strategy == 'bottomup':
+                r = apply(new)
+                result = new if r is None else r
+            elif strategy == 'innermost':
+                r = apply(new)
+                if r is None:
+                    result = new
+                else:
+                    keys.append(r)
+                    frame[0], frame[2] = r, False
+                    finished = False
+            elif new is t:
+                result = t
+            else:
+                frame[0], frame[2] = new, False
+                finished = False
+        if finished:
+            stack.pop()
+            for k in keys:
+                memo[id(k)] = (k, result)
+            if normal:
+                memo[id(result)] = (result, result)
+    return memo[id(term)][1]
@@ -0,0 +1,426 @@
+"""A flat, array backed term implementation, for very large terms.
+
+A term is stored as parallel arrays in preorder: the id of the head of each
+node, its arity, and the index one past the end of its subtree. Moving to the
+next node, skipping a subtree, and finding a path are then index arithmetic,
+and no python object is kept per node besides the distinct heads.
+
+Terms are converted to and from another representation with `flatten` and
+`unflatten`. Subterms are `FlatTerm` views into the arrays, made as needed.
+A leaf compares equal to, and hashes the same as, its head, so variables and
+substitutions can be given as plain objects."""
+
+from __future__ import absolute_import, division, print_function
+from array import array
+
+from pinyon.core import Context
+from pinyon.matching.core import END, _tracked, _unlink_path
+from pinyon.term.sexpr import sexpr_context
+
+
+class FlatTree(object):
+    """The arrays backing a flattened term.
+
+    Attributes
+    ----------
+    symbols : list
+        The distinct heads in the term.
+    heads : array
+        The index in `symbols` of the head of each node, in preorder.
+    arities : array
+        The number of arguments of each node.
+    ends : array
+        The index one past the last node in the subtree of each node.
+    """
+
+    __slots__ = ('symbols', 'heads', 'arities', 'ends')
+
+    def __init__(self, symbols, heads, arities, ends=None):
+        self.symbols = symbols
+        self.heads = heads
+        self.arities = arities
+        self.ends = _find_ends(arities) if ends is None else ends
+
+    def __getstate__(self):
+        return (self.symbols, self.heads, self.arities, self.ends)
+
+    def __setstate__(self, state):
+        self.symbols, self.heads, self.arities, self.ends = state
+
+    def __len__(self):
+        return len(self.heads)
+
+
+def _find_ends(arities):
+    """Find the end of the subtree of each node from the arities"""
+
+    ends = array('l', [0]) * len(arities)
+    for i in range(len(arities) - 1, -1, -1):
+        j = i + 1
+        for k in range(arities[i]):
+            j = ends[j]
+        ends[i] = j
+    return ends
+
+
+class FlatTerm(tuple):
+    """A subterm of a flattened term.
+
+    A view of the node at `index` in a `FlatTree`. Subterms are compared
+    structurally."""
+
+    __slots__ = ()
+
+    def __new__(cls, tree, index=0):
+        return tuple.__new__(cls, (tree, index))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    @property
+    def tree(self):
+        return self[0]
+
+    @property
+    def index(self):
+        return self[1]
+
+    @property
+    def head(self):
+        tree, i = self
+        return tree.symbols[tree.heads[i]]
+
+    @property
+    def arity(self):
+        tree, i = self
+        return tree.arities[i]
+
+    @property
+    def end(self):
+        tree, i = self
+        return tree.ends[i]
+
+    def __repr__(self):
+        return "FlatTerm({0!r})".format(unflatten(self))
+
+    def __eq__(self, other):
+        if isinstance(other, FlatTerm):
+            return _equal(self, other)
+        tree, i = self
+        return not tree.arities[i] and tree.symbols[tree.heads[i]] == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        tree, i = self
+        if not tree.arities[i]:
+            return hash(tree.symbols[tree.heads[i]])
+        end = tree.ends[i]
+        symbols = tree.symbols
+        return hash((tuple(symbols[h] for h in tree.heads[i:end]),
+                     tuple(tree.arities[i:end])))
+
+
+# Makes a `FlatTerm` without going through `FlatTerm.__new__`
+_view = tuple.__new__
+
+
+def _equal(a, b):
+    (ta, i), (tb, j) = a, b
+    n = ta.ends[i] - i
+    if tb.ends[j] - j != n or ta.arities[i:i + n] != tb.arities[j:j + n]:
+        return False
+    ha, hb = ta.heads[i:i + n], tb.heads[j:j + n]
+    if ta is tb and ha == hb:
+        return True
+    sa, sb = ta.symbols, tb.symbols
+    return all(sa[x] == sb[y] for (x, y) in zip(ha, hb))
+
+
+class _Builder(object):
+    """Builds the arrays of a new flattened term, one node at a time"""
+
+    def __init__(self):
+        self.symbols = []
+        self.heads = array('l')
+        self.arities = array('l')
+        self._ids = {}
+
+    def symbol(self, h):
+        # Keyed on the type too, so that e.g. `1` and `True` stay distinct
+        try:
+            key = (type(h), h)
+            ind = self._ids.get(key)
+        except TypeError:
+            key = ind = None
+        if ind is None:
+            ind = len(self.symbols)
+            self.symbols.append(h)
+            if key is not None:
+                self._ids[key] = ind
+        return ind
+
+    def node(self, h, arity):
+        self.heads.append(self.symbol(h))
+        self.arities.append(arity)
+
+    def splice(self, term):
+        """Copy in a subterm. Objects that aren't `FlatTerm`s are leaves."""
+
+        if not isinstance(term, FlatTerm):
+            return self.node(term, 0)
+        tree, i = term
+        end = tree.ends[i]
+        symbols = tree.symbols
+        ids = {}
+        for h in tree.heads[i:end]:
+            if h not in ids:
+                ids[h] = self.symbol(symbols[h])
+            self.heads.append(ids[h])
+        self.arities.extend(tree.arities[i:end])
+
+    def finish(self):
+        return FlatTerm(FlatTree(self.symbols, self.heads, self.arities))
+
+
+def flatten(term, context=sexpr_context):
+    """Convert a term into a `FlatTerm`.
+
+    Parameters
+    ----------
+    term : term
+    context : Context, optional
+        The context of `term`. Defaults to `sexpr_context`.
+    """
+
+    head, args = context.head, context.args
+    b = _Builder()
+    stack = [term]
+    while stack:
+        t = stack.pop()
+        a = args(t)
+        b.node(head(t), len(a))
+        stack.extend(reversed(a))
+    return b.finish()
+
+
+def unflatten(term, context=sexpr_context):
+    """Convert a `FlatTerm` back into a term.
+
+    Leaves are converted to their head, and all other nodes are made with
+    `context.rebuild`.
+
+    Parameters
+    ----------
+    term : FlatTerm
+    context : Context, optional
+        The context of the returned term. Defaults to `sexpr_context`.
+    """
+
+    tree, start = term
+    symbols, heads, arities, ends = (tree.symbols, tree.heads, tree.arities,
+                                     tree.ends)
+    rebuild = context.rebuild
+    end = ends[start]
+    values = [None] * (end - start)
+    for i in range(end - 1, start - 1, -1):
+        n = arities[i]
+        if not n:
+            values[i - start] = symbols[heads[i]]
+            continue
+        args = []
+        j = i + 1
+        for k in range(n):
+            args.append(values[j - start])
+            values[j - start] = None
+            j = ends[j]
+        values[i - start] = rebuild(symbols[heads[i]], args)
+    return values[0]
+
+
+def head(term):
+    """Return the head of a flattened term"""
+
+    tree, i = term
+    return tree.symbols[tree.heads[i]]
+
+
+def args(term):
+    """Return the arguments of a flattened term, as `FlatTerm`s"""
+
+    tree, i = term
+    n = tree.arities[i]
+    if not n:
+        return ()
+    ends = tree.ends
+    out = []
+    j = i + 1
+    for k in range(n):
+        out.append(_view(FlatTerm, (tree, j)))
+        j = ends[j]
+    return tuple(out)
+
+
+def subs(term, sub_dict):
+    """Perform direct matching substitution.
+
+    Values that aren't `FlatTerm`s are substituted in as leaves."""
+
+    tree, i = term
+    symbols, heads, arities, ends = (tree.symbols, tree.heads, tree.arities,
+                                     tree.ends)
+    # Only hash whole subterms if there are keys that aren't leaves
+    deep = any(isinstance(k, FlatTerm) and k.arity for k in sub_dict)
+    b = _Builder()
+    end = ends[i]
+    while i < end:
+        n = arities[i]
+        if n and deep:
+            key = FlatTerm(tree, i)
+        else:
+            key = symbols[heads[i]]
+        try:
+            found = (n == 0 or deep) and key in sub_dict
+        except TypeError:
+            found = False
+        if found:
+            b.splice(sub_dict[key])
+            i = ends[i]
+        else:
+            b.node(symbols[heads[i]], n)
+            i += 1
+    return b.finish()
+
+
+def rebuild(func, args):
+    b = _Builder()
+    args = list(args)
+    b.node(func, len(args))
+    for a in args:
+        b.splice(a)
+    return b.finish()
+
+
+class FlatTraverser(object):
+    """Preorder traversal of a `FlatTerm`, by index arithmetic.
+
+    Provides the same interface as `pinyon.matching.Traverser`. Copies are
+    constant time."""
+
+    __slots__ = ('context', 'variant', '_tree', '_i', '_stop', '_path',
+                 '_open', '_fresh')
+
+    def __init__(self, context, term, variant='normal'):
+        tree, i = term
+        self.context = context
+        self.variant = variant
+        self._tree = tree
+        self._i = i
+        self._stop = tree.ends[i]
+        # The path of the current term, as a linked list of `(index,
+        # parent)` cells, and the ends of the subterms enclosing it, as
+        # `(end, rest)` cells, innermost first. Both are shared by copies.
+        self._path = ()
+        self._open = () if variant in _tracked else None
+        self._fresh = True
+
+    def __iter__(self):
+        return iter(self.__next__, END)
+
+    def __next__(self):
+        i = self._i
+        if self._fresh:
+            self._fresh = False
+        elif i < self._stop:
+            if self._open is None:
+                # Inlined `next`, as there are no paths to keep
+                tree = self._tree
+                i = self._i = i + 1 if tree.arities[i] else tree.ends[i]
+            else:
+                self.next()
+                self._fresh = False
+                i = self._i
+        if i >= self._stop:
+            raise StopIteration
+        term = _view(FlatTerm, (self._tree, i))
+        variant = self.variant
+        if variant == 'path':
+            return term, _unlink_path(self._path)
+        elif variant == 'arity':
+            return term, self._tree.arities[i]
+        return term
+
+    def copy(self):
+        """Copy the traverser in its current state."""
+
+        new = object.__new__(FlatTraverser)
+        new.context = self.context
+        new.variant = self.variant
+        new._tree = self._tree
+        new._i = self._i
+        new._stop = self._stop
+        new._path = self._path
+        new._open = self._open
+        new._fresh = self._fresh
+        return new
+
+    @property
+    def term(self):
+        if self._i >= self._stop:
+            return END
+        return _view(FlatTerm, (self._tree, self._i))
+
+    @property
+    def current(self):
+        if self._i >= self._stop:
+            return END
+        tree = self._tree
+        return tree.symbols[tree.heads[self._i]]
+
+    @property
+    def arity(self):
+        if self._i >= self._stop:
+            return 0
+        return self._tree.arities[self._i]
+
+    @property
+    def path(self):
+        """The path index of the current term, for the ``"path"`` and
+        ``"tracked"`` variants"""
+        if self._open is None:
+            raise ValueError("Paths are only kept by the 'path' and "
+                             "'tracked' variants")
+        return _unlink_path(self._path)
+
+    def next(self):
+        """Proceed to the next term in the preorder traversal."""
+
+        i = self._i
+        tree = self._tree
+        if not tree.arities[i]:
+            return self.skip()
+        if self._open is not None:
+            self._open = (tree.ends[i], self._open)
+            self._path = (0, self._path)
+        self._i = i + 1
+        self._fresh = True
+
+    def skip(self):
+        """Skip over all subterms of the current level in the traversal"""
+
+        i = self._i = self._tree.ends[self._i]
+        opened = self._open
+        if opened is not None:
+            path = self._path
+            while opened and opened[0] == i:
+                opened = opened[1]
+                path = path[1]
+            if opened:
+                path = (path[0] + 1, path[1])
+            self._open = opened
+            self._path = path
+        self._fresh = True
+
+
+flat_context = Context(head, args, subs, rebuild, FlatTraverser)
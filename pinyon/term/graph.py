@@ -0,0 +1,331 @@
+"""Terms in dask style graphs, with shared subterms.
+
+A graph is a dict mapping keys to tasks, as in `pinyon.term.sexpr`. An
+argument of a task that is a key of the graph refers to the task stored
+there, which may be shared by many others. The terms of `graph_context` are
+`Ref`s into a `GraphView` of the graph, whose heads and arguments are found
+by following references lazily, so graphs are matched without inlining
+them. There is a single `Ref` per key, and each is resolved at most once, so
+a shared task is only visited once however many tasks refer to it.
+
+Plain tasks are also terms of `graph_context`, so patterns, right hand sides
+of rules, and rewritten terms are written as usual. Use `to_task` to convert
+a term back into a task, referring to the keys of the graph."""
+
+from __future__ import absolute_import, division, print_function
+from heapq import heapify, heappop, heappush
+
+from pinyon.core import Context
+from pinyon.rewrite import rewrite
+from pinyon.term import sexpr
+from pinyon.term.sexpr import istask
+
+
+class GraphView(object):
+    """A view of a dask style graph, making the `Ref`s to its tasks.
+
+    Parameters
+    ----------
+    dsk : dict
+        The graph, mapping keys to tasks.
+    """
+
+    def __init__(self, dsk):
+        self.dsk = dsk
+        self._refs = {}
+
+    def is_key(self, expr):
+        """Whether `expr` is a key of the graph"""
+        try:
+            return expr in self.dsk
+        except TypeError:
+            return False
+
+    def ref(self, key):
+        """The `Ref` to the task at a key"""
+        ref = self._refs.get(key)
+        if ref is None:
+            ref = self._refs[key] = Ref(self, key)
+        return ref
+
+    def update(self, key, task):
+        """Replace the task at a key. `Ref`s to it see the new task."""
+        self.dsk[key] = task
+        ref = self._refs.get(key)
+        if ref is not None:
+            ref._node = None
+
+    def _wrap(self, expr):
+        """Make an argument of a task into a term"""
+        if self.is_key(expr):
+            return self.ref(expr)
+        elif istask(expr) or isinstance(expr, list):
+            return Ref(self, expr)
+        return expr
+
+
+class Ref(object):
+    """A task in a graph, or a reference to one by its key.
+
+    The head and arguments are found on first use, and kept. Arguments that
+    are keys are `Ref`s to the tasks they refer to. `Ref`s compare equal to
+    terms of the same structure, and aren't hashable."""
+
+    __slots__ = ('view', 'expr', '_node')
+
+    def __init__(self, view, expr):
+        self.view = view
+        self.expr = expr
+        self._node = None
+
+    def __repr__(self):
+        return "Ref({0!r})".format(self.expr)
+
+    def head_args(self):
+        node = self._node
+        if node is not None:
+            return node
+        view = self.view
+        expr = self.expr
+        if view.is_key(expr):
+            expr = view.dsk[expr]
+            if view.is_key(expr):
+                # An alias, found through the `Ref` to the other key, so
+                # that it sees updates to it
+                return view.ref(expr).head_args()
+        h, args = sexpr.head_args(expr)
+        node = self._node = (h, tuple(view._wrap(a) for a in args))
+        return node
+
+    def __eq__(self, other):
+        return _equal(self, other)
+
+    def __ne__(self, other):
+        return not _equal(self, other)
+
+    # Equal to the tasks they resolve to, which may change with
+    # `GraphView.update`, so there's no hash consistent with equality.
+    # Matchers and rewriters only key subterms by identity.
+    __hash__ = None
+
+
+def head_args(term):
+    """Return the head and the arguments of a term at once"""
+
+    if isinstance(term, Ref):
+        return term.head_args()
+    return sexpr.head_args(term)
+
+
+def head(term):
+    """Return the top level node of a term"""
+
+    if isinstance(term, Ref):
+        return term.head_args()[0]
+    return sexpr.head(term)
+
+
+def args(term):
+    """Get the arguments of a term"""
+
+    if isinstance(term, Ref):
+        return term.head_args()[1]
+    return sexpr.args(term)
+
+
+def subs(expr, sub_dict):
+    """Perform direct matching substitution."""
+
+    if isinstance(expr, Ref):
+        return expr
+    return sexpr.subs(expr, sub_dict)
+
+
+rebuild = sexpr.rebuild
+
+
+def _equal(a, b):
+    """Structural equality of terms, comparing each pair of `Ref`s once"""
+
+    seen = set()
+    stack = [(a, b)]
+    while stack:
+        a, b = stack.pop()
+        if a is b:
+            continue
+        if isinstance(a, Ref) or isinstance(b, Ref):
+            pair = (id(a), id(b))
+            if pair in seen:
+                continue
+            seen.add(pair)
+            (ha, aa), (hb, ab) = head_args(a), head_args(b)
+            if ha != hb or len(aa) != len(ab):
+                return False
+            stack.extend(zip(aa, ab))
+        elif istask(a) or isinstance(a, list):
+            ha, aa = sexpr.head_args(a)
+            hb, ab = sexpr.head_args(b)
+            if ha != hb or len(aa) != len(ab):
+                return False
+            stack.extend(zip(aa, ab))
+        elif a != b:
+            return False
+    return True
+
+
+graph_context = Context(head, args, subs, rebuild, head_args=head_args)
+
+
+def to_task(term):
+    """Convert a term of `graph_context` into a task.
+
+    References to keys of the graph are kept as the key, so shared tasks
+    stay shared. Runs iteratively, so deep terms don't overflow the stack."""
+
+    # Converted subterms, by id. Children are converted before their parent.
+    done = {}
+    stack = [(term, False)]
+    while stack:
+        t, expanded = stack.pop()
+        if id(t) in done:
+            continue
+        if isinstance(t, Ref):
+            done[id(t)] = t.expr
+        elif istask(t):
+            if expanded:
+                done[id(t)] = (t[0],) + tuple(done[id(a)] for a in t[1:])
+            else:
+                stack.append((t, True))
+                stack.extend((a, False) for a in t[1:])
+        elif isinstance(t, list):
+            if expanded:
+                done[id(t)] = [done[id(a)] for a in t]
+            else:
+                stack.append((t, True))
+                stack.extend((a, False) for a in t)
+        else:
+            done[id(t)] = t
+    return done[id(term)]
+
+
+def dependencies(dsk, task):
+    """The keys of `dsk` directly referred to by a task"""
+
+    view = dsk if isinstance(dsk, GraphView) else GraphView(dsk)
+    deps = set()
+    stack = [task]
+    while stack:
+        t = stack.pop()
+        if view.is_key(t):
+            deps.add(t)
+        elif istask(t):
+            stack.extend(t[1:])
+        elif isinstance(t, list):
+            stack.extend(t)
+    return deps
+
+
+def _toposort(dsk, deps):
+    """Order the keys of a graph with dependencies first"""
+
+    order = {}
+    for root in dsk:
+        if root in order:
+            continue
+        stack = [(root, False)]
+        while stack:
+            key, ready = stack.pop()
+            if ready:
+                order.setdefault(key, len(order))
+                continue
+            if key in order:
+                continue
+            stack.append((key, True))
+            stack.extend((d, False) for d in deps[key] if d not in order)
+    return order
+
+
+def match(pset, dsk, keys=None):
+    """Match the task at every key of a graph against a pattern set.
+
+    Parameters
+    ----------
+    pset : PatternSet
+        A pattern set built with `graph_context`.
+    dsk : dict
+        The graph.
+    keys : iterable, optional
+        The keys to match. Defaults to all keys.
+
+    Returns
+    -------
+    A dict mapping each key to a list of `(pat, subs)` tuples, as
+    `PatternSet.match_all`. Subterms found through references are `Ref`s.
+    """
+
+    view = GraphView(dsk)
+    if keys is None:
+        keys = dsk
+    return dict((k, pset.match_all(view.ref(k))) for k in keys)
+
+
+def optimize(dsk, rules, strategy='innermost'):
+    """Rewrite every task of a graph with a set of rules.
+
+    Keys are rewritten in dependency order, with a worklist. Patterns see
+    through references, so a task may match differently once a task it
+    refers to is rewritten. Only the keys referring to rewritten keys are
+    then rewritten again, all others are visited once.
+
+    Rewriting a task doesn't rewrite the tasks it refers to in place, they
+    are left as references.
+
+    Parameters
+    ----------
+    dsk : dict
+        The graph. It isn't modified.
+    rules : RuleSet
+        A rule set built with `graph_context`.
+    strategy : str, optional
+        The rewriting strategy, see `pinyon.rewrite.rewrite`.
+
+    Returns
+    -------
+    The rewritten graph, as a new dict.
+    """
+
+    view = GraphView(dict(dsk))
+    deps = dict((k, dependencies(view, v)) for (k, v) in dsk.items())
+    dependents = dict((k, set()) for k in dsk)
+    for k, ds in deps.items():
+        for d in ds:
+            dependents[d].add(k)
+    # Rewrites only ever refer to tasks found below the rewritten one, so
+    # the order stays valid as the graph changes
+    order = _toposort(dsk, deps)
+
+    todo = [(i, k) for (k, i) in order.items()]
+    heapify(todo)
+    queued = set(dsk)
+    while todo:
+        i, key = heappop(todo)
+        queued.discard(key)
+        ref = view.ref(key)
+        # The tasks referred to are already rewritten, don't go into them
+        memo = dict((id(r), (r, r)) for r in map(view.ref, deps[key]))
+        new = rewrite(rules, ref, strategy, memo)
+        if new is ref:
+            continue
+        task = to_task(new)
+        view.update(key, task)
+        new_deps = dependencies(view, task)
+        for d in deps[key] - new_deps:
+            dependents[d].discard(key)
+        for d in new_deps - deps[key]:
+            dependents[d].add(key)
+        deps[key] = new_deps
+        for k in dependents[key]:
+            if k not in queued:
+                queued.add(k)
+                heappush(todo, (order[k], k))
+    return view.dsk
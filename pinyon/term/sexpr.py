@@ -2,7 +2,9 @@
 
 from __future__ import absolute_import, division, print_function
 from itertools import count
+from weakref import WeakValueDictionary
 
+from pinyon.compatibility import PY3, Queue
 from pinyon.core import Context
 
 
@@ -45,6 +47,25 @@ def args(task):
         return ()
 
 
+def head_args(task):
+    """Return the head and the arguments of a task at once"""
+
+    if isinstance(task, tuple) and task and callable(task[0]):
+        return task[0], task[1:]
+    elif isinstance(task, list):
+        return list, task
+    else:
+        return task, ()
+
+
+def child(task, i):
+    """Return the `i`th argument of a task, without slicing the task"""
+
+    if isinstance(task, list):
+        return task[i]
+    return task[i + 1]
+
+
 def subs(expr, sub_dict):
     """Perform direct matching substitution."""
     if expr in sub_dict:
@@ -59,20 +80,333 @@ def rebuild(func, args):
     return (func,) + tuple(args)
 
 
-sexpr_context = Context(head, args, subs, rebuild)
+# Plain tasks don't keep a structural hash, and computing one for each
+# nonlinear check costs more than comparing, which stops at the first
+# difference. Tasks interned by a `TermStore` cache theirs, see
+# `TermStore.context`.
+sexpr_context = Context(head, args, subs, rebuild, head_args=head_args,
+                        child=child)
+
+
+class HTask(tuple):
+    """A task shared through a `TermStore`.
+
+    Behaves as a plain task tuple, but caches its hash. Two tasks interned by
+    the same store are only equal if they're the same object."""
+
+    def __new__(cls, store, items):
+        self = tuple.__new__(cls, items)
+        # `None` for tasks that couldn't be interned
+        self._store = store
+        try:
+            self._hash = tuple.__hash__(self)
+        except TypeError:
+            self._hash = None
+        return self
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if (type(other) is HTask and self._store is not None and
+                other._store is self._store):
+            return False
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        if self._hash is None:
+            raise TypeError("unhashable task: {0!r}".format(self))
+        return self._hash
+
+    def __reduce__(self):
+        # Stores aren't pickled, tasks are unpickled as plain tuples
+        return (tuple, (tuple(self),))
+
+
+class TermStore(object):
+    """A table of hash-consed tasks.
+
+    Structurally equal tasks made through the store are the same `HTask`
+    object, so that large terms with repeated subterms are kept only once,
+    and compared in constant time. Only weak references to the tasks are
+    kept, tasks are removed from the table once they're no longer used and
+    have been garbage collected.
+
+    Attributes
+    ----------
+    context : Context
+        A context for tasks in the store, with `rebuild` and `subs` returning
+        shared tasks.
+    """
+
+    def __init__(self):
+        # Maps the items of each task to its `_Ref`
+        self._table = WeakValueDictionary()
+        # The cached hash of `HTask`s is structural
+        self.context = Context(head, args, self.subs, self.rebuild,
+                               hash=hash, head_args=head_args, child=child)
+
+    def __len__(self):
+        return len(self._table)
+
+    def __contains__(self, term):
+        return type(term) is HTask and term._store is self
+
+    def _make(self, func, args):
+        items = (func,) + args
+        # Shared arguments are keyed by identity, so that the table doesn't
+        # keep them alive. Keyed on the types too, so that e.g. `1` and
+        # `True` stay distinct.
+        key = tuple(id(i) if type(i) is HTask and i._store is self else i
+                    for i in items) + tuple(type(i) for i in items)
+        try:
+            ref = self._table.get(key)
+        except TypeError:
+            return HTask(None, items)
+        if ref is None:
+            task = HTask(self, items)
+            task._ref = ref = self._table[key] = _Ref(task)
+        return ref.task
+
+    def intern(self, term):
+        """Return the shared copy of a term.
+
+        All tasks in `term`, including those in lists, are replaced by their
+        shared copies. Leaves are left as is."""
+
+        if not _unshared(self, term):
+            return term
+        done = {}
+        stack = [(term, False)]
+        while stack:
+            t, expanded = stack.pop()
+            if id(t) in done:
+                continue
+            children = args(t)
+            if not expanded:
+                stack.append((t, True))
+                stack.extend((a, False) for a in children
+                             if _unshared(self, a) and id(a) not in done)
+                continue
+            new = tuple(done.get(id(a), a) for a in children)
+            if isinstance(t, list):
+                done[id(t)] = list(new)
+            else:
+                done[id(t)] = self._make(t[0], new)
+        return done[id(term)]
+
+    def rebuild(self, func, args):
+        """Make the shared task with head `func` and arguments `args`"""
+
+        return self._make(func, tuple(self.intern(a) for a in args))
+
+    def subs(self, expr, sub_dict):
+        """Perform direct matching substitution.
+
+        Subterms shared in `expr` are only substituted into once."""
+
+        expr = self.intern(expr)
+        # Without a recursive closure, the memo isn't kept alive by a
+        # reference cycle, nor the tasks in it
+        memo = {}
+        stack = [(expr, False)]
+        while stack:
+            t, expanded = stack.pop()
+            if id(t) in memo:
+                continue
+            if expanded:
+                memo[id(t)] = self.rebuild(head(t),
+                                           [memo[id(a)] for a in args(t)])
+            elif t in sub_dict:
+                memo[id(t)] = self.intern(sub_dict[t])
+            elif not args(t):
+                memo[id(t)] = t
+            else:
+                stack.append((t, True))
+                stack.extend((a, False) for a in args(t) if id(a) not in memo)
+        return memo[id(expr)]
+
+
+class _Ref(object):
+    """A weak referenceable handle to a `HTask`.
+
+    Tuple subclasses can't be weakly referenced. Each task and its handle
+    refer to each other, so that the handle is collected along with the
+    task."""
+
+    __slots__ = ('task', '__weakref__')
+
+    def __init__(self, task):
+        self.task = task
+
+
+def _unshared(store, term):
+    """Whether `term` may contain tasks not yet shared in `store`"""
+
+    if type(term) is HTask:
+        return term._store is not store
+    return istask(term) or isinstance(term, list)
 
 
 # Other fun things for a term implementation:
 
 
-def run(task):
-    """Run a task"""
+def run(task, pool=None):
+    """Run a task.
 
-    if istask(task):
-        func = task[0]
-        return func(*(run(i) for i in task[1:]))
-    else:
+    Runs iteratively, so deep tasks don't overflow the stack. Structurally
+    equal subtasks are only run once, so functions in the task are assumed
+    to be pure.
+
+    Parameters
+    ----------
+    task : task
+    pool : Pool, optional
+        A `multiprocessing.Pool`, or `multiprocessing.pool.ThreadPool`, to
+        run independent subtasks concurrently on. With a process pool, the
+        functions, arguments and results must be picklable.
+    """
+
+    if not istask(task):
         return task
+    funcs, argspecs = _plan(task)
+    if pool is not None:
+        return _run_pool(funcs, argspecs, pool)
+    uses = _uses(argspecs)
+    values = []
+    for func, spec in zip(funcs, argspecs):
+        args = [values[a] if node else a for (node, a) in spec]
+        _release(spec, values, uses)
+        values.append(func(*args))
+    return values[-1]
+
+
+def _uses(argspecs):
+    """Count the uses of each planned subtask as an argument"""
+
+    uses = [0] * len(argspecs)
+    for spec in argspecs:
+        for node, a in spec:
+            if node:
+                uses[a] += 1
+    return uses
+
+
+def _release(spec, values, uses):
+    """Drop the values of subtasks once all their uses have taken them"""
+
+    for node, a in spec:
+        if node:
+            uses[a] -= 1
+            if not uses[a]:
+                values[a] = None
+
+
+def _plan(task):
+    """Find the distinct subtasks of a task, children first.
+
+    Returns the function of each, and its arguments as a list of `(node,
+    arg)`, where `arg` is the index of a subtask if `node` is true, and a
+    value otherwise. The last subtask is `task`."""
+
+    funcs = []
+    argspecs = []
+    # Subtasks are keyed on their function and the indices of their
+    # arguments, so finding equal ones takes constant time. Subtasks already
+    # planned are also found by identity, so shared ones are visited once.
+    index = {}
+    seen = {}
+    stack = [task]
+    while stack:
+        t = stack[-1]
+        if id(t) in seen:
+            stack.pop()
+            continue
+        todo = [a for a in t[1:] if istask(a) and id(a) not in seen]
+        if todo:
+            stack.extend(reversed(todo))
+            continue
+        stack.pop()
+        spec = [(True, seen[id(a)]) if istask(a) else (False, a)
+                for a in t[1:]]
+        try:
+            key = (t[0], tuple(_arg_key(node, a) for (node, a) in spec))
+            ind = index.get(key)
+        except TypeError:
+            key = ind = None
+        if ind is None:
+            ind = len(funcs)
+            funcs.append(t[0])
+            argspecs.append(spec)
+            if key is not None:
+                index[key] = ind
+        seen[id(t)] = ind
+    return funcs, argspecs
+
+
+# Types of values that are only equal if they behave the same. Other values
+# are only the same argument if they're the same object.
+_literals = (int, str, bytes, bool, type(None))
+
+
+def _arg_key(node, a):
+    if node or type(a) in _literals:
+        return (node, type(a), a)
+    return (node, None, id(a))
+
+
+def _run_pool(funcs, argspecs, pool):
+    """Run planned subtasks on a pool, each as soon as its arguments are
+    ready"""
+
+    n = len(funcs)
+    values = [None] * n
+    uses = _uses(argspecs)
+    waiting = [0] * n
+    parents = [[] for i in range(n)]
+    for i, spec in enumerate(argspecs):
+        for node, a in spec:
+            if node:
+                waiting[i] += 1
+                parents[a].append(i)
+    finished = Queue()
+
+    def submit(i):
+        args = [values[a] if node else a for (node, a) in argspecs[i]]
+        _release(argspecs[i], values, uses)
+        kwargs = {}
+        if PY3:
+            # Also report failures of the pool itself, e.g. pickling
+            kwargs['error_callback'] = lambda e: finished.put((i, (False, e)))
+        pool.apply_async(_call, (funcs[i], args),
+                         callback=lambda res: finished.put((i, res)),
+                         **kwargs)
+
+    for i in range(n):
+        if not waiting[i]:
+            submit(i)
+    for j in range(n):
+        i, (ok, value) = finished.get()
+        if not ok:
+            raise value
+        values[i] = value
+        if i == n - 1:
+            return value
+        for p in parents[i]:
+            waiting[p] -= 1
+            if not waiting[p]:
+                submit(p)
+
+
+def _call(func, args):
+    """Call a function in a pool, returning the exception if it fails"""
+
+    try:
+        return True, func(*args)
+    except Exception as e:
+        return False, e
 
 
 def funcify(args, task):
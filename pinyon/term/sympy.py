@@ -23,6 +23,18 @@ def args(term):
     return term.args
 
 
+def head_args(term):
+    """Return the head and the arguments of a term at once"""
+
+    if isleaf(term):
+        return term, term.args
+    return type(term), term.args
+
+
+def child(term, i):
+    return term.args[i]
+
+
 def rebuild(head, args):
     return head(*args)
 
@@ -31,4 +43,6 @@ def subs(term, sd):
     return term.subs(sd)
 
 
-sympy_context = Context(head, args, subs, rebuild)
+# Sympy expressions cache their hash, which is structural
+sympy_context = Context(head, args, subs, rebuild, hash=hash,
+                        head_args=head_args, child=child)
@@ -0,0 +1,118 @@
+import pickle
+
+from pinyon import Engine
+from pinyon.term.flat import (FlatTerm, flatten, unflatten, head, args, subs,
+        rebuild, flat_context)
+
+
+def inc(x):
+    return x + 1
+
+
+def add(x, y):
+    return x + y
+
+
+def double(x):
+    return x * 2
+
+
+term = (add, (inc, 1), (double, (inc, 2)))
+
+
+def test_flatten():
+    t = flatten(term)
+    tree = t.tree
+    assert [tree.symbols[h] for h in tree.heads] == [add, inc, 1, double,
+                                                     inc, 2]
+    assert list(tree.arities) == [2, 1, 0, 1, 1, 0]
+    assert list(tree.ends) == [6, 3, 3, 6, 6, 6]
+    assert unflatten(t) == term
+    assert unflatten(flatten(1)) == 1
+    # Heads that compare equal, but are of different types, stay distinct
+    t = flatten((add, 1, True))
+    assert len(t.tree.symbols) == 3
+    assert type(unflatten(t)[2]) is bool
+    t = flatten(term)
+    t2 = pickle.loads(pickle.dumps(t))
+    assert t2 == t
+    assert unflatten(t2) == term
+
+
+def test_flat_context():
+    t = flatten(term)
+    assert head(t) == add
+    a, b = args(t)
+    assert unflatten(a) == (inc, 1)
+    assert unflatten(b) == (double, (inc, 2))
+    assert args(args(a)[0]) == ()
+    # Leaves are interchangeable with their heads
+    assert args(a)[0] == 1
+    assert hash(args(a)[0]) == hash(1)
+    # Subterms are compared structurally
+    assert args(b)[0] == flatten((inc, 2))
+    assert args(b)[0] != a
+    assert hash(args(b)[0]) == hash(flatten((inc, 2)))
+    assert unflatten(rebuild(add, [a, 2])) == (add, (inc, 1), 2)
+    assert unflatten(subs(flatten((add, 'x', (inc, 'x'))), {'x': a})) == (
+        add, (inc, 1), (inc, (inc, 1)))
+    assert unflatten(subs(t, {a: 'y'})) == (add, 'y', (double, (inc, 2)))
+
+
+def test_flat_traversal():
+    t = flatten(term)
+    pot = list(flat_context.traverse(t))
+    assert [unflatten(i) for i in pot] == [term, (inc, 1), 1,
+            (double, (inc, 2)), (inc, 2), 2]
+    pot = list(flat_context.traverse(t, 'arity'))
+    assert [a for (i, a) in pot] == [2, 1, 0, 1, 1, 0]
+    pot = list(flat_context.traverse(t, 'path'))
+    assert [p for (i, p) in pot] == [(), (0,), (0, 0), (1,), (1, 0),
+                                     (1, 0, 0)]
+    pot = flat_context.traverse(t, 'path')
+    next(pot)
+    next(pot)
+    pot.skip()
+    assert [p for (i, p) in pot] == [(1,), (1, 0), (1, 0, 0)]
+    pot = flat_context.traverse(t, 'tracked')
+    assert [pot.path for i in pot] == [(), (0,), (0, 0), (1,), (1, 0),
+                                       (1, 0, 0)]
+    # Traversal of a subterm stops at its end
+    a = args(t)[0]
+    assert list(flat_context.traverse(a)) == [a, 1]
+
+    S = flat_context.traverse(t, 'copyable')
+    S2 = S.copy()
+    S.next()
+    assert S.current == inc
+    S.skip()
+    assert S.current == double
+    assert S.arity == 1
+    assert S2.current == add
+    assert list(map(head, S2)) == [add, inc, 1, double, inc, 2]
+
+
+def test_flat_matching():
+    eng = Engine(flat_context)
+    x, y = vars = ('x', 'y')
+    pats = [eng.pattern(flatten(p), vars) for p in [(add, x, y),
+                                                  (add, x, (double, x)),
+                                                  (add, (inc, x), y)]]
+    t = flatten((add, (inc, 1), (double, (inc, 1))))
+    for type in ['static', 'dynamic', 'lazy']:
+        pset = eng.patternset(pats, type)
+        res = pset.match_all(t)
+        assert len(res) == 3
+        for pat, sub in res:
+            assert unflatten(subs(pat.pat, sub)) == unflatten(t)
+
+
+def test_flat_deep_term():
+    t = 1
+    for i in range(5000):
+        t = (inc, t)
+    ft = flatten(t)
+    assert len(ft.tree) == 5001
+    assert flatten(unflatten(ft)) == ft
+    last = list(flat_context.traverse(ft, 'path'))[-1]
+    assert last == (1, (0,) * 5000)
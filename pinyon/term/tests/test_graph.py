@@ -0,0 +1,118 @@
+import pytest
+
+from pinyon import Engine
+from pinyon.term.graph import (GraphView, Ref, graph_context, to_task,
+        dependencies, match, optimize)
+
+
+def inc(x):
+    return x + 1
+
+
+def add(x, y):
+    return x + y
+
+
+def double(x):
+    return x * 2
+
+
+a, b = vars = ('a', 'b')
+eng = Engine(graph_context)
+
+
+def test_ref():
+    dsk = {'x': 1, 'y': (inc, 'x'), 'z': (add, 'y', (double, 'y')),
+           'w': 'z'}
+    view = GraphView(dsk)
+    z = view.ref('z')
+    assert view.ref('z') is z
+    assert graph_context.head(z) is add
+    y, d = graph_context.args(z)
+    assert y is view.ref('y')
+    assert graph_context.args(d)[0] is y
+    assert graph_context.head(view.ref('x')) == 1
+    # Aliases, and equality through references
+    assert view.ref('w') == z
+    assert z == (add, (inc, 1), (double, (inc, 1)))
+    assert z != (add, (inc, 1), (double, (inc, 2)))
+    assert to_task(d) == (double, 'y')
+    assert to_task((add, y, [d, 2])) == (add, 'y', [(double, 'y'), 2])
+    assert dependencies(dsk, dsk['z']) == set(['y'])
+
+    view.update('y', (inc, 2))
+    assert z == (add, (inc, 2), (double, (inc, 2)))
+    assert view.ref('w') == z
+    with pytest.raises(TypeError):
+        hash(z)
+
+
+def test_match_shared():
+    # Inlined, the task at 'x30' would have 2**30 leaves
+    dsk = {'x0': 1}
+    for i in range(1, 31):
+        dsk['x%d' % i] = (add, 'x%d' % (i - 1), 'x%d' % (i - 1))
+    for type in ['static', 'dynamic', 'compiled', 'bottomup']:
+        pset = eng.patternset([eng.pattern((add, a, a), vars),
+                               eng.pattern((add, (add, a, b), 1), vars)],
+                              type)
+        found = match(pset, dsk, ['x30', 'x1', 'x0'])
+        (pat, subs), = found['x30']
+        assert pat.pat == (add, a, a)
+        assert isinstance(subs['a'], Ref) and subs['a'].expr == 'x29'
+        assert len(found['x1']) == 1
+        assert found['x0'] == []
+    assert Ref(GraphView(dsk), 'x30') == Ref(GraphView(dict(dsk)), 'x30')
+
+    from pinyon.matching import MatchSession
+    session = MatchSession(pset, GraphView(dsk).ref('x30'))
+    assert session.match_all() == found['x30']
+    new = session.replace((0, 0), 2)
+    assert graph_context.args(graph_context.args(new)[0])[0] == 2
+    assert session.match_all() == []
+
+
+def test_optimize():
+    rules = eng.ruleset([(eng.pattern((inc, (double, a)), vars), (add, a, a)),
+                         (eng.pattern((add, a, a), vars), (double, a))])
+    dsk = {'x': 1,
+           'y': (double, 'x'),
+           'z': (inc, 'y'),
+           'w': (add, 'z', (inc, 'y')),
+           'v': (inc, 2)}
+    out = optimize(dsk, rules)
+    assert dsk['z'] == (inc, 'y')
+    assert out['x'] == 1 and out['v'] == (inc, 2) and out['y'] == dsk['y']
+    # Shared tasks stay referred to by key
+    assert out['z'] == (double, 'x')
+    assert out['w'] == (double, 'z')
+
+    calls = []
+    apply = rules.apply
+
+    def counting(term):
+        calls.append(term)
+        return apply(term)
+    rules.apply = counting
+    big = dict(('k%d' % i, (inc, 'k%d' % (i - 1))) for i in range(1, 50))
+    big['k0'] = 1
+    big['top'] = (double, (double, 'k49'))
+    out = optimize(big, rules)
+    assert out == big
+    # Every task is only visited once
+    assert len(calls) == 52
+
+
+def test_optimize_deep():
+    rules = eng.ruleset([(eng.pattern((add, a, 0), vars), a)])
+    task = (add, 1, 0)
+    for i in range(3000):
+        task = (add, 2, task)
+    out = optimize({'a': task, 'b': (add, 'a', 0)}, rules)
+    assert out['b'] == 'a'
+    t = out['a']
+    for i in range(3000):
+        assert t[:2] == (add, 2)
+        t = t[2]
+    assert t == 1
+    assert to_task([1, (inc, 'b')]) == [1, (inc, 'b')]
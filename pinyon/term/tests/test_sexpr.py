@@ -1,5 +1,12 @@
-from pinyon.term.sexpr import (istask, head, args, subs, rebuild, run, funcify,
-        sexpr_context)
+import gc
+import pickle
+
+import pytest
+
+from pinyon.term.sexpr import (istask, head, args, head_args, child, subs,
+        rebuild, run, funcify, sexpr_context, TermStore)
+from pinyon.matching import StaticPatternSet, DynamicPatternSet
+from pinyon.matching.core import Pattern
 
 
 def inc(x):
@@ -30,6 +37,12 @@ def test_args():
     assert args([1, 2, 3]) == [1, 2, 3]
 
 
+def test_head_args():
+    for t in [(inc, 1), (add, (inc, 1), 2), [1, 2], 1, (1, 2), ()]:
+        assert head_args(t) == (head(t), args(t))
+        assert [child(t, i) for i in range(len(args(t)))] == list(args(t))
+
+
 def test_subs():
     assert subs((add, (add, 1, 'x')), {'x': 2}) == (add, (add, 1, 2))
     assert subs((add, (add, 'x', 'x')), {'x': 2}) == (add, (add, 2, 2))
@@ -44,6 +57,86 @@ def test_rebuild():
 def test_run():
     assert run((add, 1, 2)) == 3
     assert run((add, (add, 1, 2), 2)) == 5
+    assert run(1) == 1
+    assert run((sum, [1, 2])) == 3
+
+    calls = []
+
+    def count_inc(x):
+        calls.append(x)
+        return x + 1
+    # Equal subtasks are run once
+    assert run((add, (count_inc, 1), (count_inc, 1))) == 4
+    assert calls == [1]
+    # Also when shared, without visiting them again
+    t = 1
+    for i in range(100):
+        t = (add, t, t)
+    assert run(t) == 2 ** 100
+    # Deep tasks don't overflow the stack
+    t = 0
+    for i in range(10000):
+        t = (inc, t)
+    assert run(t) == 10000
+
+
+def test_run_distinct_literals():
+    from decimal import Decimal
+    pair = lambda a, b: (a, b)
+    # Equal values that behave differently aren't merged
+    assert run((pair, (str, 0.0), (str, -0.0))) == ('0.0', '-0.0')
+    assert run((pair, (str, Decimal('1.0')), (str, Decimal('1.00')))) == \
+        ('1.0', '1.00')
+    calls = []
+
+    def count_str(x):
+        calls.append(x)
+        return str(x)
+    assert run((pair, (count_str, 1), (count_str, True))) == ('1', 'True')
+    assert calls == [1, True]
+
+
+class Blob(object):
+    pass
+
+
+def test_run_releases_values():
+    import weakref
+    live = []
+
+    def step(prev):
+        # Only the argument of the current step is still alive
+        assert sum(r() is not None for r in live) <= 1
+        new = Blob()
+        live.append(weakref.ref(new))
+        return new
+    t = None
+    for i in range(20):
+        t = (step, t)
+    run(t)
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(2)
+    try:
+        del live[:]
+        run(t, pool)
+    finally:
+        pool.terminate()
+
+
+def test_run_pool():
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(2)
+    try:
+        t = (add, (inc, (add, 2, 2)), (add, (inc, 1), (add, 2, 2)))
+        assert run(t, pool) == run(t) == 11
+        t = 1
+        for i in range(50):
+            t = (add, t, (inc, t))
+        assert run(t, pool) == run(t)
+        with pytest.raises(TypeError):
+            run((add, (inc, 'a'), 1), pool)
+    finally:
+        pool.terminate()
 
 
 def test_funcify():
@@ -76,3 +169,48 @@ def test_context():
     assert sexpr_context.index(term, ()) == term
     assert sexpr_context.index(term, (0, 0)) == (add, (add, 1, 2), 2)
     assert sexpr_context.index(term, (0, 0, 0, 1)) == 2
+
+
+def test_termstore():
+    store = TermStore()
+    a = store.intern((add, (inc, 1), (inc, 1)))
+    assert a == (add, (inc, 1), (inc, 1))
+    assert hash(a) == hash((add, (inc, 1), (inc, 1)))
+    assert a[1] is a[2]
+    assert a in store and (add, 1, 2) not in store
+    assert store.intern(a) is a
+    assert store.intern((add, (inc, 1), (inc, 1))) is a
+    assert store.rebuild(add, [(inc, 1), a[2]]) is a
+    # Distinct shared tasks are unequal without comparing them
+    assert store.rebuild(inc, (1,)) != store.rebuild(inc, (True,))
+    assert store.rebuild(inc, (1,)) != store.rebuild(inc, (2,))
+    # Lists are kept, with the tasks in them shared
+    b = store.intern((sum, [(inc, 1), 2]))
+    assert b == (sum, [(inc, 1), 2])
+    assert b[1][0] is a[1]
+    # Unhashable tasks are made, but not shared
+    c = store.rebuild(sum, ([1],))
+    assert c == (sum, [1]) and c not in store
+    assert store.rebuild(sum, ([1],)) == c
+    # Substitution
+    d = store.subs((add, (inc, 'x'), (inc, 'x')), {'x': 1})
+    assert d is a
+    assert store.subs(a, {(inc, 1): 2}) == (add, 2, 2)
+    assert store.context.subs(a, {1: 'x'}) == (add, (inc, 'x'), (inc, 'x'))
+    # Pickled as plain tuples
+    assert pickle.loads(pickle.dumps(store.intern((add, 1, 2)))) == \
+        (add, 1, 2)
+    # Tasks no longer used are removed
+    del a, b, c, d
+    gc.collect()
+    assert len(store) == 0
+
+
+def test_termstore_matching():
+    store = TermStore()
+    pats = [Pattern(store.context, (add, 'x', 'x'), ('x',))]
+    t = store.intern((add, (inc, (inc, 1)), (inc, (inc, 1))))
+    for cls in [StaticPatternSet, DynamicPatternSet]:
+        pset = cls(store.context, pats)
+        assert pset.match_one(t)[1] == {'x': (inc, (inc, 1))}
+        assert pset.match_one(store.intern((add, (inc, 1), (inc, 2))))[0] is None
@@ -1,5 +1,6 @@
 from sympy import symbols, Function, MatrixSymbol, sympify, Add
-from pinyon.term.sympy import isleaf, head, args, subs, rebuild, sympy_context
+from pinyon.term.sympy import (isleaf, head, args, head_args, child, subs,
+        rebuild, sympy_context)
 
 f = Function('f')
 g = Function('g')
@@ -29,6 +30,12 @@ def test_args():
     assert args(g(a)) == (a,)
 
 
+def test_head_args():
+    for t in [a, sympify(1), f(g(a), b), a + b]:
+        assert head_args(t) == (head(t), args(t))
+        assert tuple(child(t, i) for i in range(len(args(t)))) == args(t)
+
+
 def test_subs():
     assert subs(f(a, b, c), {a: g(a), b: g(b)}) == f(g(a), g(b), c)
     assert subs(f(a, b, c), {a: b}) == f(b, b, c)
@@ -1,6 +1,7 @@
 from pinyon.term.sexpr import sexpr_context
 from pinyon.core import PreorderTraversal, Engine
-from pinyon.matching import Pattern, StaticPatternSet, DynamicPatternSet
+from pinyon.matching import (Pattern, StaticPatternSet, DynamicPatternSet,
+        LazyPatternSet, BottomUpPatternSet, CompiledPatternSet)
 
 
 def inc(x):
@@ -45,6 +46,18 @@ def test_preorder_traversal():
             (1, (1, 0, 0))]
 
 
+def test_engine_cache_dir(tmpdir):
+    eng = Engine(sexpr_context)
+    pats = [eng.pattern((add, 'a', 'b'), ('a', 'b'))]
+    cache_dir = str(tmpdir)
+    pset = eng.patternset(pats, 'static', cache_dir=cache_dir)
+    assert len(tmpdir.listdir()) == 1
+    pset2 = eng.patternset(pats, 'static', cache_dir=cache_dir)
+    assert isinstance(pset2, StaticPatternSet)
+    assert pset2._net == pset._net
+    assert pset2.match_all((add, 1, 2)) == [(pats[0], {'a': 1, 'b': 2})]
+
+
 def test_engine():
     # Just check that the interface for eng actually works
     eng = Engine(sexpr_context)
@@ -58,3 +71,31 @@ def test_engine():
     dynamic_pset = eng.patternset(pats, 'dynamic')
     assert isinstance(dynamic_pset, DynamicPatternSet)
     assert dynamic_pset.patterns == pats
+    lazy_pset = eng.patternset(pats, 'lazy')
+    assert isinstance(lazy_pset, LazyPatternSet)
+    assert lazy_pset.patterns == pats
+    bottomup_pset = eng.patternset(pats, 'bottomup')
+    assert isinstance(bottomup_pset, BottomUpPatternSet)
+    assert bottomup_pset.patterns == pats
+    compiled_pset = eng.patternset(pats, 'compiled')
+    assert isinstance(compiled_pset, CompiledPatternSet)
+    assert compiled_pset.patterns == pats
+
+
+def test_traversal_deep_term():
+    term = 1
+    for i in range(5000):
+        term = (inc, term)
+    assert len(list(sexpr_context.traverse(term))) == 5001
+    last = list(sexpr_context.traverse(term, 'path'))[-1]
+    assert last == (1, (0,) * 5000)
+    last = list(sexpr_context.traverse(term, 'arity'))[-1]
+    assert last == (1, 0)
+
+    eng = Engine(sexpr_context)
+    pats = [eng.pattern((inc, (inc, 'x')), ('x',))]
+    for type in ['static', 'dynamic', 'lazy']:
+        pset = eng.patternset(pats, type)
+        pat, subs = pset.match_one(term)
+        assert pat is pats[0]
+        assert subs['x'] is term[1][1]
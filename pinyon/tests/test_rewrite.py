@@ -0,0 +1,131 @@
+from pinyon.core import Engine
+from pinyon.rewrite import RuleSet, rewrite
+from pinyon.term.sexpr import sexpr_context, run
+
+
+def inc(x):
+    return x + 1
+
+
+def add(x, y):
+    return x + y
+
+
+def double(x):
+    return x * 2
+
+
+eng = Engine(sexpr_context)
+x, y = vars = ('x', 'y')
+rules = eng.ruleset([(eng.pattern((add, x, x), vars), (double, x)),
+                     (eng.pattern((double, (inc, x)), vars),
+                      (add, (double, x), 2)),
+                     (eng.pattern((add, x, 0), vars), x)])
+
+
+def test_ruleset_apply():
+    assert isinstance(rules, RuleSet)
+    assert rules.apply((add, 1, 1)) == (double, 1)
+    assert rules.apply((add, 1, 2)) is None
+    # Only rewrites at the root
+    assert rules.apply((inc, (add, 1, 1))) is None
+
+
+def test_strategies():
+    term = (add, (inc, 1), (inc, 1))
+    assert rewrite(rules, term, 'innermost') == (add, (double, 1), 2)
+    assert rewrite(rules, term, 'outermost') == (add, (double, 1), 2)
+    assert rewrite(rules, term, 'bottomup') == (double, (inc, 1))
+    # Rewriting preserves the value of the term
+    for strategy in ['innermost', 'outermost', 'bottomup']:
+        assert run(rewrite(rules, term, strategy)) == run(term)
+    # Outermost rewrites the root before the arguments
+    term = (add, (add, (inc, 1), 0), (add, (inc, 1), 0))
+    assert rewrite(rules, term, 'innermost') == (add, (double, 1), 2)
+    assert rewrite(rules, term, 'outermost') == (add, (double, 1), 2)
+    assert rewrite(rules, term, 'bottomup') == (double, (inc, 1))
+    # Terms in normal form are returned unchanged
+    term = (inc, (add, 1, 2))
+    assert rewrite(rules, term) is term
+
+
+def test_shared_subterms():
+    counts = []
+    apply = rules.apply
+
+    class CountingRules(RuleSet):
+        def apply(self, term):
+            counts.append(term)
+            return apply(term)
+
+    r = CountingRules.__new__(CountingRules)
+    r.__dict__.update(rules.__dict__)
+    shared = (add, (add, (inc, 1), 0), 3)
+    term = (add, (add, shared, shared), (add, shared, shared))
+    memo = {}
+    res = rewrite(r, term, 'innermost', memo)
+    assert res == (double, (double, (add, (inc, 1), 3)))
+    n = len(counts)
+    # The shared subterm is only rewritten once
+    assert counts.count((add, (inc, 1), 3)) == 1
+    # Reusing the memo skips all work
+    assert rewrite(r, term, 'innermost', memo) is res
+    assert len(counts) == n
+
+
+def test_deep_terms():
+    # Deeper than the recursion limit
+    term = 1
+    for i in range(5000):
+        term = (add, term, 0)
+    for strategy in ['innermost', 'outermost', 'bottomup']:
+        assert rewrite(rules, term, strategy) == 1
+    term = 1
+    for i in range(5000):
+        term = (inc, term)
+    for strategy in ['innermost', 'outermost', 'bottomup']:
+        assert rewrite(rules, term, strategy) is term
+        assert rewrite(rules, (inc, None), strategy) == (inc, None)
+
+
+def test_engine_rewrite():
+    lhs = eng.pattern((add, x, 0), vars)
+    assert eng.rewrite((inc, (add, 1, 0)), [(lhs, x)]) == (inc, 1)
+    assert eng.rewrite((inc, (add, 1, 0)), rules, 'outermost') == (inc, 1)
+    try:
+        eng.rewrite(1, rules, 'sideways')
+        assert False
+    except ValueError:
+        pass
+
+
+def test_engine_rewrite_rule_list():
+    eng = Engine(sexpr_context)
+    lhs = eng.pattern((add, x, 0), vars)
+    memo = {}
+    assert eng.rewrite((add, 2, 0), [(lhs, x)], memo=memo) == 2
+    built = eng._rules[1]
+    # The same rules reuse the rule set, and so the memo
+    assert eng.rewrite((add, 3, 0), [(lhs, x)], memo=memo) == 3
+    assert eng._rules[1] is built
+    # Other rules build a new one, which can't share the memo
+    other = eng.pattern((add, 0, x), vars)
+    assert eng.rewrite((add, 0, 4), [(other, x)]) == 4
+    assert eng._rules[1] is not built
+    try:
+        eng.rewrite((add, 0, 4), [(other, x)], memo=memo)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_memo_rules():
+    memo = {}
+    rewrite(rules, (add, 1, 1), 'innermost', memo)
+    other = eng.ruleset([(eng.pattern((add, x, 0), vars), x)])
+    for (r, strategy) in [(rules, 'outermost'), (other, 'innermost')]:
+        try:
+            rewrite(r, (add, 1, 1), strategy, memo)
+            assert False
+        except ValueError:
+            pass